@@ -3,6 +3,9 @@
 import argparse, sys, shutil, os, logging
 import SimpleITK as sitk
 import json
+import numpy as np
+import itertools
+import ablation_roi as roi
 #import sitkUtils
 
 anatomDict = {
@@ -11,8 +14,22 @@ anatomDict = {
     3 : 'NVB'
 }
 
+# Cache of the structure labels resampled onto the grids of ablation labels.
+# Each entry is a list of [structureLabel, geometry, resampledLabel, volumes].
+structureCacheSize = 4
+structureCache = []
 
-def computeDistanceFromAblationVolume(anatomLabel, ablationLabel):
+
+def computeDistanceFromAblationVolume(anatomLabel, ablationLabel, useROI=False):
+
+    # If useROI is True, the distance map is computed only within the bounding box
+    # of the two labels (padded by one voxel). The two labels must be on the same grid.
+    if useROI:
+        bbox = roi.unionBoundingBox(roi.getLabelBoundingBox(anatomLabel), roi.getLabelBoundingBox(ablationLabel))
+        if bbox:
+            bbox = roi.padBoundingBox(bbox, 1, ablationLabel)
+            anatomLabel = roi.cropImage(anatomLabel, bbox)
+            ablationLabel = roi.cropImage(ablationLabel, bbox)
 
     distMapFilter = sitk.SignedDanielssonDistanceMapImageFilter()
     distMap = distMapFilter.Execute(ablationLabel)
@@ -33,14 +50,199 @@ def computeDistanceFromAblationVolume(anatomLabel, ablationLabel):
     return minDistances
 
 
-def addMargin(srcLabel, margin):
-    
-    dilate = sitk.BinaryDilateImageFilter()
-    dilate.SetBackgroundValue(0.0)
-    dilate.SetKernelRadius(int(margin))
-    dilate.SetForegroundValue(1.0)
-    
-    dstLabel = resampler.Execute(srcLabel)
+# Offsets of the neighbours of a voxel (z, y, x): face and edge neighbours (18), and all (26)
+neighbourOffsets18 = [o for o in itertools.product([-1, 0, 1], repeat=3) if 0 < sum(map(abs, o)) <= 2]
+neighbourOffsets26 = [o for o in itertools.product([-1, 0, 1], repeat=3) if o != (0, 0, 0)]
+
+
+def getBoundaryVoxels(mask, offsets):
+    # Indices (z, y, x) of the voxels in 'mask' (a 3D boolean array) that have a neighbour
+    # outside the mask. Voxels beyond the edges of the array are not outside the mask.
+    nonZero = np.nonzero(mask)
+    if len(nonZero[0]) == 0:
+        return np.empty((0, 3), dtype=np.intp)
+
+    # Work within the bounding box padded by one voxel
+    lower = [max(int(idx.min()) - 1, 0) for idx in nonZero]
+    upper = [min(int(idx.max()) + 2, n) for (idx, n) in zip(nonZero, mask.shape)]
+    sub = mask[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+    outside = ~np.pad(sub, 1, mode='constant', constant_values=True)
+
+    (nz, ny, nx) = sub.shape
+    hasOutside = np.zeros(sub.shape, dtype=bool)
+    for (dz, dy, dx) in offsets:
+        hasOutside |= outside[1+dz:1+dz+nz, 1+dy:1+dy+ny, 1+dx:1+dx+nx]
+
+    return np.argwhere(sub & hasOutside) + np.array(lower)
+
+
+def getNearestDistances(points, targets, reach=None, blockSize=256):
+    # Distance from each point to the nearest target, by brute force over blocks of
+    # 'blockSize' points. If 'reach' is given, the nearest target of each point is known
+    # to be within reach[i], and only the targets in the box around the block extended by
+    # the reach are searched. The points should be ordered so that each block is compact.
+    distances = np.empty(len(points))
+    for i in range(0, len(points), blockSize):
+        p = points[i:i+blockSize]
+        t = targets
+        if reach is not None:
+            r = reach[i:i+blockSize].max()
+            t = targets[np.all((targets >= p.min(axis=0) - r) & (targets <= p.max(axis=0) + r), axis=1)]
+        d2 = (p ** 2).sum(axis=1)[:,np.newaxis] + (t ** 2).sum(axis=1)[np.newaxis,:] - 2.0 * np.dot(p, t.T)
+        distances[i:i+blockSize] = d2.min(axis=1)
+    return np.sqrt(np.maximum(distances, 0.0))
+
+
+def getExtremeDistance(points, targets, indices, scale, findMax, cellSize=8, reach=None):
+    # Minimum (or maximum if 'findMax' is True) over the points of the distance to the
+    # nearest target. 'points' and 'targets' are physical coordinates, and 'indices' are
+    # the voxel indices of the points. 'reach' is an upper bound of the distance of each
+    # point (see getNearestDistances()), if known.
+    #
+    # The points are grouped into cells of cellSize^3 voxels, and the distance is first
+    # computed for one point per cell. Since the distance differs by at most the cell
+    # diagonal within a cell, only the cells that may contain the extreme point are
+    # searched further, with cells of half the size, and the nearest target of each point
+    # in a cell is within the distance of the cell plus the diagonal.
+
+    if cellSize <= 1:
+        distances = getNearestDistances(points, targets, reach)
+        return distances.max() if findMax else distances.min()
+
+    cells = indices // cellSize
+    keys = np.ravel_multi_index(cells.T, tuple(cells.max(axis=0) + 1))
+    (_, first, cellOfPoint) = np.unique(keys, return_index=True, return_inverse=True)
+    cellDiagonal = float(np.linalg.norm((cellSize - 1) * scale))
+
+    cellDistances = getNearestDistances(points[first], targets, None if reach is None else reach[first])
+    if findMax:
+        bound = cellDistances.max()
+        candidateCells = (cellDistances + cellDiagonal > bound)
+    else:
+        bound = cellDistances.min()
+        candidateCells = (cellDistances - cellDiagonal < bound)
+
+    # Candidates ordered by cell, so that the blocks of getNearestDistances() are compact
+    candidates = np.flatnonzero(candidateCells[cellOfPoint])
+    candidates = candidates[np.argsort(cellOfPoint[candidates], kind='stable')]
+    if len(candidates) == 0:
+        return bound
+    candidateReach = cellDistances[cellOfPoint[candidates]] + cellDiagonal
+    if reach is not None:
+        candidateReach = np.minimum(candidateReach, reach[candidates])
+
+    distance = getExtremeDistance(points[candidates], targets, indices[candidates], scale, findMax,
+                                  cellSize // 2, candidateReach)
+    return max(bound, distance) if findMax else min(bound, distance)
+
+
+def computeMinimumDistances(anatomLabel, ablationLabel, useImageSpacing=False):
+    # Same as computeDistanceFromAblationVolume(), but computed from the boundary voxels
+    # of the labels instead of a distance map of the whole volume. The two labels must be
+    # on the same grid. The distances are in voxels, as those of the distance map, or in
+    # mm if useImageSpacing is True, and rounded to float32 as those of the distance map.
+    # They are exact Euclidean distances, while the distance map is an approximation, which
+    # may differ in rare configurations.
+    #
+    # For each structure, the result is the minimum of the signed distance from the
+    # boundary of the ablation label (negative inside) over the structure:
+    #  - If the structure overlaps the ablation label, minus the largest distance from a
+    #    voxel in the overlap to the inner boundary of the ablation label (the ablation
+    #    voxels with a face or edge neighbour outside).
+    #  - Otherwise, the smallest distance between the boundary voxels of the structure
+    #    and of the ablation label.
+
+    ablation = sitk.GetArrayViewFromImage(ablationLabel) != 0
+    if not ablation.any():
+        return computeDistanceFromAblationVolume(anatomLabel, ablationLabel)
+    structure = sitk.GetArrayViewFromImage(anatomLabel)
+
+    # Physical scale of the (z, y, x) indices. The direction does not change the distances.
+    if useImageSpacing:
+        scale = np.array(list(reversed(ablationLabel.GetSpacing())))
+    else:
+        scale = np.ones(3)
+
+    innerBoundary = None
+    outerBoundary = None
+    minDistances = {}
+    for i in np.flatnonzero(np.bincount(structure.ravel())):
+        if i == 0:
+            continue
+        mask = (structure == i)
+        overlap = mask & ablation
+        if overlap.any():
+            if innerBoundary is None:
+                innerBoundary = getBoundaryVoxels(ablation, neighbourOffsets18) * scale
+            indices = np.argwhere(overlap)
+            depth = getExtremeDistance(indices * scale, innerBoundary, indices, scale, True)
+            minDistances[int(i)] = -float(np.float32(depth)) if depth > 0.0 else 0.0
+        else:
+            if outerBoundary is None:
+                outerBoundary = getBoundaryVoxels(ablation, neighbourOffsets26) * scale
+            indices = getBoundaryVoxels(mask, neighbourOffsets26)
+            minDistances[int(i)] = float(np.float32(getExtremeDistance(indices * scale, outerBoundary, indices, scale, False)))
+
+    return minDistances
+
+
+def computeSignedDistanceMap(label, useImageSpacing=True):
+    # Signed distance from the boundary of the label (negative inside).
+    # The distance is in mm if useImageSpacing is True, otherwise in voxels.
+    distMapFilter = sitk.SignedDanielssonDistanceMapImageFilter()
+    distMapFilter.SetUseImageSpacing(useImageSpacing)
+    distMap = distMapFilter.Execute(label)
+    return distMap
+
+
+def thresholdDistanceMap(distMap, margin):
+    # If margin > 0, the label is dilated by the margin.
+    # If margin < 0, the label is eroded by the margin.
+    newLabel = sitk.BinaryThreshold(distMap, -float('inf'), margin, 1, 0)
+    return newLabel
+
+
+def sweepMargins(label, margins, useImageSpacing=True, useROI=False):
+    # Apply each margin in 'margins' to the label. The distance map is computed only
+    # once and shared by all margins. Returns a dictionary of labels keyed by margin.
+    # A margin of 0.0 returns the original label.
+    # If useROI is True, the distance map is computed only within the bounding box of
+    # the label, padded to cover the largest margin, and the results are pasted back
+    # onto the full grid.
+    labels = {}
+    distMap = None
+    bbox = None
+    if useROI:
+        bbox = roi.getLabelBoundingBox(label)
+        if bbox is None:
+            # Empty label
+            emptyLabel = sitk.Image(label.GetSize(), sitk.sitkUInt8)
+            emptyLabel.CopyInformation(label)
+            for margin in margins:
+                labels[margin] = label if margin == 0.0 else emptyLabel
+            return labels
+        maxMargin = max([0.0] + list(margins))
+        bbox = roi.padBoundingBox(bbox, roi.paddingInVoxels(maxMargin, label, useImageSpacing), label)
+
+    for margin in margins:
+        if margin == 0.0:
+            labels[margin] = label
+            continue
+        if distMap is None:
+            if bbox:
+                distMap = computeSignedDistanceMap(roi.cropImage(label, bbox), useImageSpacing)
+            else:
+                distMap = computeSignedDistanceMap(label, useImageSpacing)
+        labels[margin] = thresholdDistanceMap(distMap, margin)
+        if bbox:
+            labels[margin] = roi.uncropImage(labels[margin], bbox, label)
+
+    return labels
+
+
+def addMargin(srcLabel, margin, useROI=False):
+    # Dilate (margin > 0) or erode (margin < 0) the label by the margin in mm.
+    dstLabel = sweepMargins(srcLabel, [margin], useROI=useROI)[margin]
     return dstLabel
     
 
@@ -65,16 +267,66 @@ def resampleImage(srcImage, refImage):
     return dstImage
 
 
-def getLabelVolume(srcLabel):
+def getGeometry(image):
+    return (image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection())
 
-    # Get the voxel volume
-    dimension = srcLabel.GetDimension()
-    spacing = srcLabel.GetSpacing()
+
+def isSameGeometry(image1, image2, tolerance=1e-6):
+    # True if the two images have the same size, origin, spacing and direction.
+    if image1.GetSize() != image2.GetSize():
+        return False
+    for (a, b) in [(image1.GetOrigin(), image2.GetOrigin()),
+                   (image1.GetSpacing(), image2.GetSpacing()),
+                   (image1.GetDirection(), image2.GetDirection())]:
+        for i in range(len(a)):
+            if abs(a[i] - b[i]) > tolerance:
+                return False
+    return True
+
+
+def getResampledStructure(structureLabel, refImage):
+    # Resample the structure label onto the grid of 'refImage' and compute the volumes
+    # of the structures. The results are cached for the same structure label (object)
+    # and grid, and the resampling is skipped if the grids already match.
+    # NOTE: The returned label is shared by the callers. Do not modify it in place.
+
+    geometry = getGeometry(refImage)
+    for entry in structureCache:
+        if entry[0] is structureLabel and entry[1] == geometry:
+            return (entry[2], dict(entry[3]))
+
+    if isSameGeometry(structureLabel, refImage):
+        resampledLabel = structureLabel
+        if resampledLabel.GetPixelID() != sitk.sitkUInt16:
+            resampledLabel = sitk.Cast(resampledLabel, sitk.sitkUInt16)
+    else:
+        resampledLabel = resampleImage(structureLabel, refImage)
+    volumes = getLabelVolume(resampledLabel)
+
+    structureCache.insert(0, [structureLabel, geometry, resampledLabel, volumes])
+    del structureCache[structureCacheSize:]
+
+    return (resampledLabel, dict(volumes))
+
+
+def getVoxelVolume(image):
+
+    # Voxel volume in cc
+    dimension = image.GetDimension()
+    spacing = image.GetSpacing()
     
     voxelVolume = 1.0
     for i in range(dimension):
         voxelVolume = voxelVolume * (spacing[i] / 10.0)
 
+    return voxelVolume
+
+
+def getLabelVolume(srcLabel):
+
+    # Get the voxel volume
+    voxelVolume = getVoxelVolume(srcLabel)
+
     #print('voxel spacing = %s' % str(spacing))
     #print('voxel volume = %f' % voxelVolume)
     labelStatistics = sitk.LabelStatisticsImageFilter()
@@ -94,18 +346,48 @@ def getLabelVolume(srcLabel):
     return volumes
         
 
-def measureOverlap(srcLabel, maskLabel):
+def measureOverlap(srcLabel, maskLabel, overlapLabelFile=None):
     
     maskFilter = sitk.MaskImageFilter()
     maskFilter.SetMaskingValue(0.0)
     maskFilter.SetOutsideValue(0.0)
     overlapLabel = maskFilter.Execute(srcLabel, maskLabel)
-    sitk.WriteImage(overlapLabel, 'overlap-label.nrrd')
+    if overlapLabelFile:
+        sitk.WriteImage(overlapLabel, overlapLabelFile)
     
     volumes = getLabelVolume(overlapLabel)
     return volumes
 
 
+def measureAblation(structureLabel, ablationLabel):
+    # Compute the ablation volume (voxels labeled 1) and the volume of each structure
+    # within the ablation label (voxels labeled non-zero) in a single pass.
+    # Equivalent to getLabelVolume(ablationLabel)[1] and
+    # measureOverlap(structureLabel, ablationLabel), but without intermediate images.
+    # The two labels must be on the same grid.
+
+    voxelVolume = getVoxelVolume(ablationLabel)
+
+    structure = sitk.GetArrayViewFromImage(structureLabel)
+    ablation = sitk.GetArrayViewFromImage(ablationLabel)
+
+    # Combined code = structure * 3 + ablation class, where the structure is clipped to
+    # 0..nStructures (nStructures for the labels not in anatomDict), and the ablation
+    # class is 0 (outside), 1 (non-zero other than 1) or 2 (labeled 1).
+    nStructures = max(anatomDict) + 1
+    codes = np.minimum(structure, nStructures).astype(np.intp) * 3
+    codes += (ablation != 0)
+    codes += (ablation == 1)
+    counts = np.bincount(codes.ravel(), minlength=(nStructures + 1) * 3)
+
+    ablationVolume = float(counts[2::3].sum()) * voxelVolume
+    overlapVolumes = {}
+    for i in anatomDict:
+        overlapVolumes[i] = float(counts[i*3+1] + counts[i*3+2]) * voxelVolume
+
+    return (ablationVolume, overlapVolumes)
+
+
 def evaluateAblation(structureLabel, ablationLabel, param, fMinDist=True):
     
     results = {
@@ -118,22 +400,23 @@ def evaluateAblation(structureLabel, ablationLabel, param, fMinDist=True):
     results['AblationVolume'] = 0.0        
 
     margin = param['margin']
+    useROI = ('useROI' in param) and param['useROI']
 
-    resampledStructureLabel = resampleImage(structureLabel, ablationLabel)
-    
-    structureVolumes = getLabelVolume(resampledStructureLabel)
+    (resampledStructureLabel, structureVolumes) = getResampledStructure(structureLabel, ablationLabel)
     for key in structureVolumes:
         results['Structure.'+anatomDict[key]] = structureVolumes[key]
         
     
-    if margin > 0.0:
-        ablationLabel = addMargin(ablationLabel, margin)
+    if margin != 0.0:
+        ablationLabel = addMargin(ablationLabel, margin, useROI)
         
-    ablationVolumes = getLabelVolume(ablationLabel)
-    if len(ablationVolumes) > 0:
-        results['AblationVolume'] = ablationVolumes[1]
+    (ablationVolume, overlapVolumes) = measureAblation(resampledStructureLabel, ablationLabel)
+    results['AblationVolume'] = ablationVolume
+
+    # For debugging, the overlap label is saved if 'overlapLabelFile' is specified.
+    if 'overlapLabelFile' in param and param['overlapLabelFile']:
+        measureOverlap(resampledStructureLabel, ablationLabel, param['overlapLabelFile'])
 
-    overlapVolumes = measureOverlap(resampledStructureLabel, ablationLabel)
     for key in overlapVolumes:
         results['Involved.'+anatomDict[key]] = overlapVolumes[key]
         #print('Involved.'+anatomDict[key]+': '+str(overlapVolumes[key]))
@@ -141,8 +424,13 @@ def evaluateAblation(structureLabel, ablationLabel, param, fMinDist=True):
     # The following step is skipped if fMinDist == False.
     # It has become optional, after adding a new feature to calculate overlap with inner-iceball,
     # because the minimum distance is equivalent to the new feature.
+    # param['minDistEngine'] selects the computation: 'distanceMap' (default; distance map of
+    # the ablation label) or 'boundary' (computeMinimumDistances(), from the boundary voxels).
     if fMinDist: 
-        minDistances = computeDistanceFromAblationVolume(resampledStructureLabel, ablationLabel)
+        if ('minDistEngine' in param) and param['minDistEngine'] == 'boundary':
+            minDistances = computeMinimumDistances(resampledStructureLabel, ablationLabel)
+        else:
+            minDistances = computeDistanceFromAblationVolume(resampledStructureLabel, ablationLabel, useROI)
         for key in minDistances:
             results['MinDist.'+anatomDict[key]] = minDistances[key]
             #print('MinDist.'+anatomDict[key]+': '+str(minDistances[key]))
@@ -159,10 +447,14 @@ def ablation_evaluation_main(argv):
                             help='A label map of critical structures.')
         parser.add_argument('intra', metavar='INTRA_LABEL_FILE', type=str, nargs=1,
                             help='A label map of ablatio volume.')
+        parser.add_argument('--roi', dest='useROI', action='store_true',
+                            help='Compute the distance maps only within the bounding box of the labels.')
         #parser.add_argument('-c', dest='numberOfControlPoints', default='4,4,4',
         #                    help='Number of control points (default: 4,4,4)')
         parser.add_argument('-m', dest='ablationMargin', default='0.0',
-                            help='Ablation Margin (default: 0.0)')
+                            help='Ablation Margin in mm. Positive to dilate, negative to erode the ablation label. (default: 0.0)')
+        parser.add_argument('--min-dist-engine', dest='minDistEngine', choices=['distanceMap', 'boundary'], default='distanceMap',
+                            help='Compute the minimum distances from a distance map of the ablation label (distanceMap), or from the boundary voxels of the labels (boundary). (default: distanceMap)')
         #parser.add_argument('-b', dest='bSplineOrder', default='3',
         #                    help='B-Spline order (default: 3)')
         #parser.add_argument('-s', dest='shrinkFactor', default='4',
@@ -179,7 +471,9 @@ def ablation_evaluation_main(argv):
     planFile = args.plan[0]
     intraFile = args.intra[0]
     param = {
-        'margin': float(args.ablationMargin)
+        'margin': float(args.ablationMargin),
+        'useROI': args.useROI,
+        'minDistEngine': args.minDistEngine,
     }
 
     structureLabel = sitk.ReadImage(planFile, sitk.sitkUInt16)
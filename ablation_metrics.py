@@ -5,103 +5,259 @@ import SimpleITK as sitk
 import json
 import csv
 import numpy as np
+import itertools
+import time
 
 
-def computeMetrics(mesHeader, mesTable, volNamesAnatom, volNamesAblation, volNamesAblationDist):
-    
-    colTime       = mesHeader.index('Time')
-    #colSer        = mesHeader.index('Ser')
+volNamesAnatom = ['V_TG','V_EUS','V_NVB']
+volNamesAblation = ['V_ablation','V_INV_TG','V_INV_EUS','V_INV_NVB']
+volNamesAblationDist = ['MIN_DIST_TG','MIN_DIST_EUS','MIN_DIST_NVB']
 
-    time1 = mesTable[:,colTime]
-    time0 = np.roll(time1, 1)
-    time0[0] = 0.0
-    timeInterval = time1-time0
 
-    metrics = {}
-    
+def getResultHeader():
+
+    resHeader = ['Case', 'Cycle'] + volNamesAnatom
     for name in volNamesAblation:
-        col = mesHeader.index(name)
-        v = mesTable[:,col]
-        v_max = np.max(v)
-        v_dur = np.sum(timeInterval[v > 0.0])
-        metrics[name+'_max'] = v_max
-        metrics[name+'_duration'] = v_dur
+        resHeader.append(name+'_max')
+        resHeader.append(name+'_duration')
         
     for name in volNamesAblationDist:
-        col = mesHeader.index(name)
-        v = mesTable[:,col]
-        v_min = np.min(v)
-        metrics[name] = v_min
-        
-    for name in volNamesAnatom:
-        col = mesHeader.index(name)
-        metrics[name] = mesTable[:,col][0]
+        resHeader.append(name)
+
+    return resHeader
+
+
+def getMeasurementColumns(mesHeader):
+    # Column indices of the measurement table used by the group metrics.
+    return {
+        'case'         : mesHeader.index('Case'),
+        'cycle'        : mesHeader.index('Cycle'),
+        'time'         : mesHeader.index('Time'),
+        'anatom'       : [mesHeader.index(name) for name in volNamesAnatom],
+        'ablation'     : [mesHeader.index(name) for name in volNamesAblation],
+        'ablationDist' : [mesHeader.index(name) for name in volNamesAblationDist],
+    }
+
+
+def updateGroupMetrics(mesHeader, mesTable, state):
+    # Update the metrics of all (Case, Cycle) groups with the rows in 'mesTable'.
+    # The result is the same as computeMetrics() applied to the rows of each group, up
+    # to the rounding of the durations, which are summed in a different order when the
+    # table is processed in chunks. The table is grouped by sorting, and the statistics
+    # of all the groups are computed in a single vectorized pass.
+    #
+    # 'state' is a dictionary keyed by (case, cycle), which holds the running metrics of
+    # each group, so that a large table can be processed in chunks (in the order of the rows):
+    #   'anatom'   : Values of volNamesAnatom in the first row
+    #   'lastTime' : Time of the last row
+    #   'max'      : Maximum of volNamesAblation
+    #   'duration' : Total time interval with positive volNamesAblation
+    #   'min'      : Minimum of volNamesAblationDist
+
+    if len(mesTable) == 0:
+        return state
+
+    columns = getMeasurementColumns(mesHeader)
+    colCase = columns['case']
+    colCycle = columns['cycle']
+    colTime = columns['time']
+    colsAnatom = columns['anatom']
+    colsAblation = columns['ablation']
+    colsAblationDist = columns['ablationDist']
+
+    # Sort the rows by (Case, Cycle). The sort is stable, so the rows in each group
+    # remain in the original order.
+    order = np.lexsort((mesTable[:,colCycle], mesTable[:,colCase]))
+    table = mesTable[order]
+    cases = table[:,colCase]
+    cycles = table[:,colCycle]
+
+    isStart = np.ones(len(table), dtype=bool)
+    isStart[1:] = (cases[1:] != cases[:-1]) | (cycles[1:] != cycles[:-1])
+    starts = np.flatnonzero(isStart)
+    keys = [(case, cycle) for (case, cycle) in zip(cases[starts], cycles[starts])]
+
+    # Time interval from the previous row in the same group. The previous time of the
+    # first row of each group is taken from the state (0.0 for a new group).
+    time1 = table[:,colTime]
+    time0 = np.empty(len(table))
+    time0[1:] = time1[:-1]
+    time0[starts] = [state[key]['lastTime'] if key in state else 0.0 for key in keys]
+    timeInterval = time1 - time0
+
+    ablation = table[:,colsAblation]
+    vMax = np.maximum.reduceat(ablation, starts, axis=0)
+    vDur = np.add.reduceat(np.where(ablation > 0.0, timeInterval[:,np.newaxis], 0.0), starts, axis=0)
+    vMin = np.minimum.reduceat(table[:,colsAblationDist], starts, axis=0)
+    ends = np.append(starts[1:], len(table)) - 1
+
+    for (i, key) in enumerate(keys):
+        if key in state:
+            s = state[key]
+            s['max'] = np.maximum(s['max'], vMax[i])
+            s['duration'] = s['duration'] + vDur[i]
+            s['min'] = np.minimum(s['min'], vMin[i])
+        else:
+            state[key] = {
+                'anatom'   : table[starts[i], colsAnatom],
+                'max'      : vMax[i],
+                'duration' : vDur[i],
+                'min'      : vMin[i],
+            }
+        state[key]['lastTime'] = time1[ends[i]]
+
+    return state
+
+
+def updateRowMetrics(columns, row, state):
+    # Update the metrics of the (Case, Cycle) group of a single measurement row, in
+    # constant time. The result is the same as updateGroupMetrics() applied to the row,
+    # and the two can be mixed on the same 'state'. 'columns' is given by
+    # getMeasurementColumns(). Returns the (case, cycle) key of the group.
+
+    key = (row[columns['case']], row[columns['cycle']])
+    t = row[columns['time']]
+    ablation = np.array([row[c] for c in columns['ablation']])
+    ablationDist = np.array([row[c] for c in columns['ablationDist']])
+
+    if key in state:
+        s = state[key]
+        timeInterval = t - s['lastTime']
+        s['max'] = np.maximum(s['max'], ablation)
+        s['duration'] = s['duration'] + np.where(ablation > 0.0, timeInterval, 0.0)
+        s['min'] = np.minimum(s['min'], ablationDist)
+    else:
+        state[key] = {
+            'anatom'   : np.array([row[c] for c in columns['anatom']]),
+            'max'      : ablation,
+            'duration' : np.where(ablation > 0.0, t, 0.0),
+            'min'      : ablationDist,
+        }
+    state[key]['lastTime'] = t
+
+    return key
+
+
+def getGroupMetricsRow(state, key):
+    # Row of the result table for the (Case, Cycle) group
+    s = state[key]
+    r = [int(key[0]), int(key[1])]
+    r.extend(s['anatom'])
+    for i in range(len(volNamesAblation)):
+        r.append(s['max'][i])
+        r.append(s['duration'][i])
+    r.extend(s['min'])
+    return r
+
+
+def getGroupMetricsTable(state):
+    # Convert the group metrics to the rows of the result table, sorted by (Case, Cycle).
+    return [getGroupMetricsRow(state, key) for key in sorted(state)]
+
+
+def computeMetrics(mesHeader, mesTable, volNamesAnatom, volNamesAblation, volNamesAblationDist):
+    # Metrics of the rows of a single group (in the order of the rows), as a dictionary
+    # keyed by the names of the result header. The names must be among the module-level
+    # lists of the same names.
+
+    columns = getMeasurementColumns(mesHeader)
+    table = np.array(mesTable, dtype=float)
+    table[:,columns['case']] = table[0,columns['case']]
+    table[:,columns['cycle']] = table[0,columns['cycle']]
+    key = (table[0,columns['case']], table[0,columns['cycle']])
+    state = updateGroupMetrics(mesHeader, table, {})
+    allMetrics = dict(zip(getResultHeader()[2:], getGroupMetricsRow(state, key)[2:]))
 
+    metrics = {}
+    for name in volNamesAblation:
+        metrics[name+'_max'] = allMetrics[name+'_max']
+        metrics[name+'_duration'] = allMetrics[name+'_duration']
+    for name in volNamesAblationDist + volNamesAnatom:
+        metrics[name] = allMetrics[name]
     return metrics
 
 
 def processMeasurementTable(mesHeader, mesTable, param):
 
-    # Create a list of cases
-    colCase = mesHeader.index('Case')
-    colCycle = mesHeader.index('Cycle')
-    caseList = np.unique(mesTable[:,colCase])
+    state = updateGroupMetrics(mesHeader, mesTable, {})
+    return (getResultHeader(), getGroupMetricsTable(state))
 
-    volNamesAnatom = ['V_TG','V_EUS','V_NVB']
-    volNamesAblation = ['V_ablation','V_INV_TG','V_INV_EUS','V_INV_NVB']
-    volNamesAblationDist = ['MIN_DIST_TG','MIN_DIST_EUS','MIN_DIST_NVB']
 
-    resTable = []
-    resHeader = ['Case', 'Cycle'] + volNamesAnatom
-    for name in volNamesAblation:
-        resHeader.append(name+'_max')
-        resHeader.append(name+'_duration')
-        
-    for name in volNamesAblationDist:
-        resHeader.append(name)
-    
-    for case in caseList:
-        caseMesTable = mesTable[mesTable[:,colCase] == case, :]
-        cycleList = np.unique(caseMesTable[:,colCycle])
-        for cycle in cycleList:
-            cycleMesTable = caseMesTable[caseMesTable[:,colCycle] == cycle, :]
-            metrics = computeMetrics(mesHeader, cycleMesTable, volNamesAnatom, volNamesAblation, volNamesAblationDist)
-            
-            r = [int(case), int(cycle)]
-            for name in volNamesAnatom:
-                r.append(metrics[name])
-                
-            for name in volNamesAblation:
-                r.append(metrics[name+'_max'])
-                r.append(metrics[name+'_duration'])
+def processMeasurementFile(mesFile, param, chunkSize=1000000):
+    # Same as processMeasurementTable(loadMeasurements(mesFile), param), but the file
+    # is read in chunks of 'chunkSize' rows, so that it does not have to fit in memory.
 
-            for name in volNamesAblationDist:
-                r.append(metrics[name])
-                
-            resTable.append(r)
-        
-    return (resHeader, resTable)
+    state = {}
+    for (mesHeader, mesTable) in loadMeasurementChunks(mesFile, chunkSize):
+        updateGroupMetrics(mesHeader, mesTable, state)
+    return (getResultHeader(), getGroupMetricsTable(state))
             
 
+def streamGroupMetrics(mesFile, follow=False, interval=1.0):
+    # Generator that reads the measurement rows one at a time from the open file
+    # 'mesFile' (e.g. sys.stdin), and yields the result row of the (Case, Cycle) group
+    # each time its metrics change. If 'follow' is True, the rows appended to the file
+    # are read as they arrive (polled every 'interval' seconds), until interrupted.
+
+    line = readMeasurementLine(mesFile, follow, interval)
+    if line is None:
+        return
+    mesHeader = next(csv.reader([line], delimiter=','))
+    columns = getMeasurementColumns(mesHeader)
+    state = {}
+    emitted = {}   # Last row yielded for each group
+    while True:
+        line = readMeasurementLine(mesFile, follow, interval)
+        if line is None:
+            break
+        if line.strip() == '':
+            continue
+        row = [float(v) for v in line.split(',')]
+        key = updateRowMetrics(columns, row, state)
+        resRow = getGroupMetricsRow(state, key)
+        if resRow != emitted.get(key):
+            emitted[key] = resRow
+            yield resRow
+
+
+def readMeasurementLine(mesFile, follow=False, interval=1.0):
+    # Read a complete line, or return None at the end of the file. If 'follow' is True,
+    # wait for the rest of the file (or of a partly written line) instead.
+    line = ''
+    while True:
+        line = line + mesFile.readline()
+        if line.endswith('\n'):
+            return line
+        if not follow:
+            return line if line != '' else None
+        time.sleep(interval)
+
+
 def loadMeasurements(mesFile, header=True):
 
     colList = []
-    mesList = []
 
     with open(mesFile, newline='') as csvfile:
-        csvreader = csv.reader(csvfile, delimiter=',')
-        for row in csvreader:
-            if header:
-                for c in row:
-                    colList.append(c)
-                header = False
-            else:
-                r = []
-                for c in row:
-                    r.append(float(c))
-                mesList.append(r)
+        if header:
+            colList = next(csv.reader(csvfile, delimiter=','))
+        mesTable = np.loadtxt(csvfile, delimiter=',', ndmin=2)
                 
-    return (colList, np.array(mesList))
+    return (colList, mesTable)
+
+
+def loadMeasurementChunks(mesFile, chunkSize, header=True):
+    # Generator that yields (colList, mesTable) for every 'chunkSize' rows of the file.
+
+    colList = []
+
+    with open(mesFile, newline='') as csvfile:
+        if header:
+            colList = next(csv.reader(csvfile, delimiter=','))
+        while True:
+            lines = list(itertools.islice(csvfile, chunkSize))
+            if len(lines) == 0:
+                break
+            yield (colList, np.loadtxt(lines, delimiter=',', ndmin=2))
 
 
 def outputMeasurements(resHeader, resTable, outFile):
@@ -114,6 +270,28 @@ def outputMeasurements(resHeader, resTable, outFile):
             writer.writerow(srow)
     
 
+def streamMeasurements(mesFile, outFile, follow=False, interval=1.0):
+    # Write the rows of streamGroupMetrics() to 'outFile' as they are produced.
+    # '-' reads from stdin or writes to stdout.
+
+    inFile = sys.stdin if mesFile == '-' else open(mesFile, newline='')
+    f = sys.stdout if outFile == '-' else open(outFile, 'w', newline='')
+    try:
+        writer = csv.writer(f)
+        writer.writerow(getResultHeader())
+        f.flush()
+        for row in streamGroupMetrics(inFile, follow, interval):
+            writer.writerow([str(s) for s in row])
+            f.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if inFile != sys.stdin:
+            inFile.close()
+        if f != sys.stdout:
+            f.close()
+
+
 def ablation_metrics_main(argv):
 
     args = []
@@ -123,6 +301,14 @@ def ablation_metrics_main(argv):
                             help='Measurement results in the CSV format. (Input)')
         parser.add_argument('out_csv', metavar='OUTPUT_FILE', type=str, nargs=1,
                             help='Computation results in the CSV format. (Ouput)')
+        parser.add_argument('-c', dest='chunkSize', type=int, default=0,
+                            help='Read the measurement file in chunks of CHUNK_SIZE rows, for files too large to fit in memory. (default: 0 (no chunks))')
+        parser.add_argument('--stream', dest='stream', action='store_true',
+                            help='Read the measurement rows one at a time (MEASUREMENT_FILE may be - for stdin), and append the metrics of a (Case, Cycle) group to OUTPUT_FILE (- for stdout) each time they change.')
+        parser.add_argument('--follow', dest='follow', action='store_true',
+                            help='With --stream, keep reading the rows appended to MEASUREMENT_FILE until interrupted.')
+        parser.add_argument('--interval', dest='interval', type=float, default=1.0,
+                            help='Polling interval in seconds for --follow (default: 1.0)')
 
         args = parser.parse_args(argv)
         
@@ -133,11 +319,17 @@ def ablation_metrics_main(argv):
     mesFile = args.mes_csv[0]
     outFile = args.out_csv[0]
 
-    (mesHeader, mesTable) = loadMeasurements(mesFile)
-    
     param = {}
 
-    (resHeader, resTable) = processMeasurementTable(mesHeader, mesTable, param)
+    if args.stream:
+        streamMeasurements(mesFile, outFile, args.follow, args.interval)
+        return
+
+    if args.chunkSize > 0:
+        (resHeader, resTable) = processMeasurementFile(mesFile, param, args.chunkSize)
+    else:
+        (mesHeader, mesTable) = loadMeasurements(mesFile)
+        (resHeader, resTable) = processMeasurementTable(mesHeader, mesTable, param)
     
     outputMeasurements(resHeader, resTable, outFile)
         
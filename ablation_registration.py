@@ -3,6 +3,11 @@
 import argparse, sys, shutil, os, logging
 import SimpleITK as sitk
 import json
+import threading
+import concurrent.futures
+import numpy as np
+import ablation_roi as roi
+import pipeline_profile as pp
 #import sitkUtils
 
 
@@ -11,6 +16,13 @@ def command_iteration(method):
     pass
 
 
+def command_level_iteration(levelIterations):
+    # Count the optimizer iterations of the current resolution level.
+    if len(levelIterations) == 0:
+        levelIterations.append(0)
+    levelIterations[-1] = levelIterations[-1] + 1
+
+
 def resampleImage(srcImage, refImage, transform, interp='linear'):
     
     dimension = srcImage.GetDimension()
@@ -76,13 +88,145 @@ def createMaskFromAnatomLabel(anatomLabel, image, dilation=0):
     return maskLabel
 
 
-def registerImages(fixedImage, movingImage, param, mask=None, maskType='moving'):
-  # maskType specifies which image will be masked. It should be either 'moving' or 'fixed'.
+def evaluateMetric(fixedImage, movingImage, transform, param, mask=None, maskType='moving', fixedState=None):
+    # Evaluate the registration metric for 'transform' without optimization.
+    # A fixed seed is used for the sampling, so that values from different
+    # transforms can be compared.
+
+    R = sitk.ImageRegistrationMethod()
+    R.SetMetricAsMattesMutualInformation(numberOfHistogramBins = param['numberOfBins'])
+    if mask:
+      if maskType == 'moving':
+        R.SetMetricMovingMask(mask)
+      else:
+        R.SetMetricFixedMask(mask)
+    setMetricSampling(R, fixedImage, param, mask, maskType, [1], 1, fixedState)
+    R.SetInterpolator(sitk.sitkLinear)
+    R.SetInitialTransform(transform)
+
+    return R.MetricEvaluate(fixedImage, movingImage)
+
+
+# Parameters that affect the result of registerImages()
+registrationParameterKeys = [
+    'numberOfBins',
+    'samplingPercentage',
+    'samplingPercentages',
+    'shrinkFactors',
+    'smoothingSigmas',
+    'learningRate',
+    'numberOfIterations',
+    'minStep',
+    'relaxationFactor',
+    'gradientMagnitudeTolerance',
+    'maximumStepSizeInPhysicalUnits',
+    'initialOffset',
+    'samplingSeed',
+    'numberOfSamples',
+    'refinementSamples',
+    'refinementLearningRate',
+]
+
+
+def getSampleDomainSize(fixedImage, mask=None):
+    # Number of voxels of the fixed image grid from which the samples can be taken,
+    # i.e. the volume of the mask in voxels of the fixed image (or the whole image).
+
+    if mask:
+        maskVoxels = np.count_nonzero(sitk.GetArrayViewFromImage(mask))
+        if maskVoxels > 0:
+            return maskVoxels * np.prod(mask.GetSpacing()) / np.prod(fixedImage.GetSpacing())
+    return np.prod(fixedImage.GetSize())
+
+
+def prepareFixedImage(fixedImage, mask=None, maskType='moving'):
+    # State derived from the fixed image and the mask, which can be shared by the
+    # registrations of many moving images (see registerSeries()).
+    fixedState = {
+        'domainSize'    : getSampleDomainSize(fixedImage, mask),
+        'virtualDomain' : None,
+    }
+    if mask and maskType != 'moving':
+        bbox = roi.getLabelBoundingBox(mask)
+        if bbox:
+            fixedState['virtualDomain'] = roi.cropImage(mask, bbox)
+    return fixedState
+
+
+def setMetricSampling(R, fixedImage, param, mask=None, maskType='moving', shrinkFactors=[1], seed=None, fixedState=None):
+    # Set the random sampling of the metric for the levels given by 'shrinkFactors'.
+    #
+    # By default, 'samplingPercentage' (or 'samplingPercentages' for multiple levels) of
+    # the voxels of the fixed image are sampled, and the samples that fall outside the mask
+    # are discarded. If 'numberOfSamples' is given, about that many samples remain in the
+    # mask at each level. The samples are still drawn over the whole virtual domain (with a
+    # fixed mask, the bounding box of the mask) and those outside the mask discarded, but the
+    # sampling percentage is computed from the mask volume rather than from the domain, so
+    # that about 'numberOfSamples' x (domain / mask volume) samples are drawn. E.g. with a
+    # mask that fills a quarter of its bounding box, about 4 x 'numberOfSamples' are drawn.
+    #
+    # 'seed' (or 'samplingSeed') makes the sampling reproducible; the default is the
+    # wall clock. 'fixedState' is the result of prepareFixedImage() for the fixed image
+    # and the mask, if already computed.
+
+    if seed is None:
+        seed = param['samplingSeed'] if 'samplingSeed' in param and param['samplingSeed'] is not None else sitk.sitkWallClock
+
+    R.SetMetricSamplingStrategy(R.RANDOM)
+
+    numberOfSamples = param['numberOfSamples'] if 'numberOfSamples' in param and param['numberOfSamples'] else 0
+    if numberOfSamples > 0:
+        if fixedState is None:
+            fixedState = prepareFixedImage(fixedImage, mask, maskType)
+        if fixedState['virtualDomain']:
+            R.SetVirtualDomainFromImage(fixedState['virtualDomain'])
+        dimension = fixedImage.GetDimension()
+        percentages = [min(1.0, float(numberOfSamples) * (s ** dimension) / fixedState['domainSize']) for s in shrinkFactors]
+        R.SetMetricSamplingPercentagePerLevel(percentages, seed)
+    elif 'samplingPercentages' in param and len(shrinkFactors) > 1:
+        R.SetMetricSamplingPercentagePerLevel(param['samplingPercentages'], seed)
+    else:
+        R.SetMetricSamplingPercentage(param['samplingPercentage'], seed)
+
+
+def setDefaultParameters(param):
 
     if not 'numberOfBins' in param:
         param['numberOfBins'] = 50
     if not 'samplingPercentage' in param:
         param['samplingPercentage'] = 0.02
+    # Optimizer (RegularStepGradientDescent)
+    if not 'learningRate' in param:
+        param['learningRate'] = 0.2
+    if not 'numberOfIterations' in param:
+        param['numberOfIterations'] = 1500
+    if not 'minStep' in param:
+        param['minStep'] = 0.005
+    if not 'relaxationFactor' in param:
+        param['relaxationFactor'] = 0.5
+    if not 'gradientMagnitudeTolerance' in param:
+        param['gradientMagnitudeTolerance'] = 1e-5
+    if not 'maximumStepSizeInPhysicalUnits' in param:
+        param['maximumStepSizeInPhysicalUnits'] = 0.2
+    # Multi-resolution pyramid. Each level is specified by a shrink factor and
+    # a smoothing sigma (in mm). The default is a single level at full resolution.
+    # 'samplingPercentages' optionally gives the sampling percentage for each level;
+    # otherwise 'samplingPercentage' is used for all levels.
+    if not 'shrinkFactors' in param:
+        param['shrinkFactors'] = [1]
+    if not 'smoothingSigmas' in param:
+        param['smoothingSigmas'] = [0]
+
+    return param
+
+
+def registerImages(fixedImage, movingImage, param, mask=None, maskType='moving', fixedState=None, statistics=None):
+  # maskType specifies which image will be masked. It should be either 'moving' or 'fixed'.
+  # fixedState is the result of prepareFixedImage() for the fixed image and the mask, if already computed.
+  # If 'statistics' is a dictionary, the optimizer statistics recorded for the profile
+  # ('registration' and 'refinement' events) are stored in it.
+
+    setDefaultParameters(param)
 
     offset = None
     if 'initialOffset' in param:
@@ -108,9 +252,73 @@ def registerImages(fixedImage, movingImage, param, mask=None, maskType='moving')
         rigid_versor_trans.SetCenter(euler_trans.GetCenter())
         rigid_versor_trans.SetTranslation(euler_trans.GetTranslation())
         rigid_versor_trans.SetMatrix(euler_trans.GetMatrix())
+
+    # 'initialTransform' optionally gives a converged VersorRigid3DTransform from a previous
+    # registration (warm start). It is used instead of the initial transform above, only if
+    # it gives a better metric value.
+    warmStarted = False
+    if 'initialTransform' in param and param['initialTransform']:
+        warm_trans = sitk.VersorRigid3DTransform(param['initialTransform'])
+        metric = evaluateMetric(fixedImage, movingImage, rigid_versor_trans, param, mask, maskType, fixedState)
+        warmMetric = evaluateMetric(fixedImage, movingImage, warm_trans, param, mask, maskType, fixedState)
+        # Mattes mutual information is negative; smaller is better.
+        if warmMetric < metric:
+            rigid_versor_trans = warm_trans
+            warmStarted = True
+    
+    (transform, Reg2, levelIterations) = runRegistration(fixedImage, movingImage, rigid_versor_trans, param, mask, maskType,
+                                                         param['shrinkFactors'], param['smoothingSigmas'], param['learningRate'], fixedState,
+                                                         statistics is not None)
+
+    if pp.enabled or statistics is not None:
+        stats = {
+            'iterations'      : sum(levelIterations),
+            'levelIterations' : levelIterations,
+            'metric'          : Reg2.GetMetricValue(),
+            'stopCondition'   : Reg2.GetOptimizerStopConditionDescription(),
+            'warmStart'       : warmStarted,
+        }
+        pp.record('registration', **stats)
+        if statistics is not None:
+            statistics.update(stats)
+
+    # Adaptive sampling: once the optimizer has converged with 'numberOfSamples', the
+    # transform is refined at full resolution with 'refinementSamples', starting from a
+    # small step ('refinementLearningRate', 4 x minStep by default).
+    if 'refinementSamples' in param and param['refinementSamples']:
+        refinementParam = dict(param)
+        refinementParam['numberOfSamples'] = param['refinementSamples']
+        learningRate = param['minStep'] * 4
+        if 'refinementLearningRate' in param and param['refinementLearningRate']:
+            learningRate = param['refinementLearningRate']
+        (transform, Reg2, levelIterations) = runRegistration(fixedImage, movingImage, rigid_versor_trans, refinementParam, mask, maskType,
+                                                             [1], [0], learningRate, fixedState, statistics is not None)
+        if pp.enabled or statistics is not None:
+            stats = {
+                'iterations'    : sum(levelIterations),
+                'metric'        : Reg2.GetMetricValue(),
+                'stopCondition' : Reg2.GetOptimizerStopConditionDescription(),
+            }
+            pp.record('refinement', **stats)
+            if statistics is not None:
+                statistics['refinement'] = stats
     
+    # print("-------")
+    # print(transform)
+    # print(f"Optimizer stop condition: {R.GetOptimizerStopConditionDescription()}")
+    # print(f" Iteration: {R.GetOptimizerIteration()}")
+    # print(f" Metric value: {R.GetMetricValue()}")
+
+    return transform
+    
+
+def runRegistration(fixedImage, movingImage, initialTransform, param, mask, maskType, shrinkFactors, smoothingSigmas, learningRate, fixedState=None, countIterations=False):
+    # Optimize 'initialTransform' (in place) with the levels given by 'shrinkFactors' and
+    # 'smoothingSigmas'. Returns (transform, registration method, iterations per level).
+    # The iterations are counted only if the instrumentation is enabled.
+
     Reg2=sitk.ImageRegistrationMethod()
-    Reg2.SetInitialTransform(rigid_versor_trans,inPlace=True)
+    Reg2.SetInitialTransform(initialTransform,inPlace=True)
     
     # Reg2.SetMetricAsCorrelation()
     Reg2.SetMetricAsMattesMutualInformation(numberOfHistogramBins = param['numberOfBins'])
@@ -122,38 +330,85 @@ def registerImages(fixedImage, movingImage, param, mask=None, maskType='moving')
         Reg2.SetMetricFixedMask(mask)
         
     Reg2.SetInterpolator(sitk.sitkLinear)
-    Reg2.SetOptimizerAsRegularStepGradientDescent(learningRate=0.2,
-                                                  numberOfIterations=1500,
-                                                  minStep=0.005,
-                                                  relaxationFactor = 0.5,
-                                                  gradientMagnitudeTolerance=1e-5,
-                                                  maximumStepSizeInPhysicalUnits=0.2)
+    Reg2.SetOptimizerAsRegularStepGradientDescent(learningRate=learningRate,
+                                                  numberOfIterations=param['numberOfIterations'],
+                                                  minStep=param['minStep'],
+                                                  relaxationFactor = param['relaxationFactor'],
+                                                  gradientMagnitudeTolerance=param['gradientMagnitudeTolerance'],
+                                                  maximumStepSizeInPhysicalUnits=param['maximumStepSizeInPhysicalUnits'])
     
     Reg2.SetOptimizerScales([1.0,1.0,1.0,1.0/1000,1.0/1000,1.0/1000])
     
-    smoothingSigmas=[0]
     Reg2.SetSmoothingSigmasPerLevel(smoothingSigmas)
     
-    Reg2.SetMetricSamplingStrategy(Reg2.RANDOM)
-    Reg2.SetMetricSamplingPercentage(param['samplingPercentage'])
+    setMetricSampling(Reg2, fixedImage, param, mask, maskType, shrinkFactors, None, fixedState)
     
     Reg2.SetSmoothingSigmasAreSpecifiedInPhysicalUnits(True)
     
-    shrinkFactors=[1]
     Reg2.SetShrinkFactorsPerLevel(shrinkFactors)
     
     # execute
     Reg2.AddCommand( sitk.sitkIterationEvent, lambda: command_iteration(Reg2))
+
+    # Optimizer statistics are collected only if the instrumentation is enabled, or
+    # requested with 'countIterations'.
+    levelIterations = []
+    if pp.enabled or countIterations:
+        Reg2.AddCommand( sitk.sitkMultiResolutionIterationEvent, lambda: levelIterations.append(0))
+        Reg2.AddCommand( sitk.sitkIterationEvent, lambda: command_level_iteration(levelIterations))
+
     transform = Reg2.Execute(fixedImage, movingImage)
-    
-    # print("-------")
-    # print(transform)
-    # print(f"Optimizer stop condition: {R.GetOptimizerStopConditionDescription()}")
-    # print(f" Iteration: {R.GetOptimizerIteration()}")
-    # print(f" Metric value: {R.GetMetricValue()}")
 
-    return transform
-    
+    return (transform, Reg2, levelIterations)
+
+
+def copyImage(image):
+    # Deep copy of the image, which does not share the pixel buffer with 'image'.
+    copy = sitk.GetImageFromArray(sitk.GetArrayViewFromImage(image), isVector=(image.GetNumberOfComponentsPerPixel() > 1))
+    copy.CopyInformation(image)
+    return copy
+
+
+def registerSeries(fixedImage, movingImages, param, mask=None, maskType='moving', seriesParams=None, numberOfThreads=1):
+    # Register each of 'movingImages' to the same fixed image (e.g. all intraop series of an
+    # exam to the plan image), and return the list of the transforms.
+    #
+    # 'param' is shared by all series; 'seriesParams' optionally gives a dictionary of
+    # parameters for each series (e.g. 'initialOffset'), which override 'param'. The state
+    # derived from the fixed image and the mask (used with 'numberOfSamples', see
+    # setMetricSampling()) is computed once; otherwise nothing on the fixed side is shared,
+    # and the gain comes only from the threads. With 'numberOfThreads' > 1,
+    # the series are registered in parallel threads, each with its own copy of the fixed
+    # image and the mask; consider reducing the number of SimpleITK threads accordingly.
+    #
+    # The transforms are the same as those of registerImages() called for each series
+    # (with 'samplingSeed' set, since the wall-clock seed is different for each call).
+
+    setDefaultParameters(param)
+    fixedState = prepareFixedImage(fixedImage, mask, maskType)
+
+    # Fixed image and mask used by each thread
+    local = threading.local()
+    def getFixed():
+        if numberOfThreads <= 1:
+            return (fixedImage, mask)
+        if not hasattr(local, 'images'):
+            local.images = (copyImage(fixedImage), copyImage(mask) if mask else None)
+        return local.images
+
+    def register(i):
+        p = dict(param)
+        if seriesParams:
+            p.update(seriesParams[i])
+        (fixed, fixedMask) = getFixed()
+        return registerImages(fixed, movingImages[i], p, fixedMask, maskType, fixedState)
+
+    if numberOfThreads <= 1:
+        return [register(i) for i in range(len(movingImages))]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfThreads) as executor:
+        return list(executor.map(register, range(len(movingImages))))
+
 
 def registration_main(argv):
 
@@ -170,6 +425,20 @@ def registration_main(argv):
                             help='Anatom label map for masking.')
         parser.add_argument('-t', dest='initialOffset', default='',
                             help='Number of control points (default: None)')
+        parser.add_argument('-s', dest='shrinkFactors', default='1',
+                            help='Shrink factors for the multi-resolution levels, coarse to fine (e.g. 4,2,1) (default: 1)')
+        parser.add_argument('-g', dest='smoothingSigmas', default='',
+                            help='Smoothing sigmas in mm for the multi-resolution levels (e.g. 2,1,0) (default: 0 for all levels)')
+        parser.add_argument('-p', dest='samplingPercentages', default='',
+                            help='Metric sampling percentages for the multi-resolution levels (e.g. 0.32,0.02) (default: 0.02 for all levels)')
+        parser.add_argument('-n', dest='numberOfSamples', type=int, default=0,
+                            help='Number of metric samples per level that remain in the mask (more are drawn over the mask bounding box, and those outside are discarded). Overrides -p. (default: 0 (use the sampling percentages))')
+        parser.add_argument('-r', dest='refinementSamples', type=int, default=0,
+                            help='Refine the transform with this number of samples after convergence. (default: 0 (no refinement))')
+        parser.add_argument('--seed', dest='samplingSeed', type=int, default=None,
+                            help='Seed for the metric sampling (default: wall clock)')
+        parser.add_argument('-d', dest='maskDilation', type=int, default=25,
+                            help='Dilation of the anatomy label for the mask (default: 25)')
 
         args = parser.parse_args(argv)
         
@@ -188,12 +457,33 @@ def registration_main(argv):
         offset = [float(f) for f in offset]
         param['initialOffset'] = offset
 
+    param['shrinkFactors'] = [int(f) for f in args.shrinkFactors.split(',')]
+    if args.smoothingSigmas != '':
+        param['smoothingSigmas'] = [float(f) for f in args.smoothingSigmas.split(',')]
+    else:
+        param['smoothingSigmas'] = [0.0] * len(param['shrinkFactors'])
+    if len(param['smoothingSigmas']) != len(param['shrinkFactors']):
+        print('The numbers of shrink factors and smoothing sigmas do not match.')
+        sys.exit()
+    if args.samplingPercentages != '':
+        param['samplingPercentages'] = [float(f) for f in args.samplingPercentages.split(',')]
+        if len(param['samplingPercentages']) != len(param['shrinkFactors']):
+            print('The numbers of shrink factors and sampling percentages do not match.')
+            sys.exit()
+
+    if args.numberOfSamples > 0:
+        param['numberOfSamples'] = args.numberOfSamples
+    if args.refinementSamples > 0:
+        param['refinementSamples'] = args.refinementSamples
+    if args.samplingSeed is not None:
+        param['samplingSeed'] = args.samplingSeed
+
     fixedImage = sitk.ReadImage (fixedImageFile, sitk.sitkFloat32)
     movingImage = sitk.ReadImage(movingImageFile, sitk.sitkFloat32)
 
     movingImageMasked = movingImage
     maskImage = None
-    dilation = 25
+    dilation = args.maskDilation
     if args.anatomLabel != '':
         anatomLabel = sitk.ReadImage(args.anatomLabel, sitk.sitkInt8)
         #movingImageMasked = mask(movingImage, anatomLabel, dilation=dilation)
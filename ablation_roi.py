@@ -0,0 +1,118 @@
+#! /usr/bin/python
+
+import math
+import numpy as np
+import SimpleITK as sitk
+
+#
+# Region-of-interest (ROI) helpers.
+#
+# A bounding box is a pair of lists (index, size) in the voxel coordinates (x, y, z)
+# of an image, as used by sitk.RegionOfInterest(). Heavy filters can be applied to the
+# cropped sub-volume, and the results are pasted back onto the full grid.
+#
+
+
+def getLabelBoundingBox(label):
+    # Bounding box of the non-zero voxels in the label, or None if the label is empty.
+    array = sitk.GetArrayViewFromImage(label)
+    dimension = label.GetDimension()
+    index = [0] * dimension
+    size = [0] * dimension
+    for axis in range(dimension):
+        # The array is indexed as (z, y, x)
+        arrayAxis = dimension - 1 - axis
+        otherAxes = tuple(a for a in range(dimension) if a != arrayAxis)
+        nonZero = np.flatnonzero(np.any(array, axis=otherAxes))
+        if len(nonZero) == 0:
+            return None
+        index[axis] = int(nonZero[0])
+        size[axis] = int(nonZero[-1] - nonZero[0] + 1)
+    return (index, size)
+
+
+def padBoundingBox(bbox, padding, image):
+    # Pad the bounding box by 'padding' voxels (a number or a list for each axis)
+    # and clip it to the image.
+    (index, size) = bbox
+    imageSize = image.GetSize()
+    dimension = len(index)
+    if not isinstance(padding, (list, tuple)):
+        padding = [padding] * dimension
+    newIndex = [0] * dimension
+    newSize = [0] * dimension
+    for axis in range(dimension):
+        lower = max(index[axis] - int(padding[axis]), 0)
+        upper = min(index[axis] + size[axis] + int(padding[axis]), imageSize[axis])
+        newIndex[axis] = lower
+        newSize[axis] = upper - lower
+    return (newIndex, newSize)
+
+
+def unionBoundingBox(bbox1, bbox2):
+    if bbox1 is None:
+        return bbox2
+    if bbox2 is None:
+        return bbox1
+    index = [min(bbox1[0][i], bbox2[0][i]) for i in range(len(bbox1[0]))]
+    upper = [max(bbox1[0][i] + bbox1[1][i], bbox2[0][i] + bbox2[1][i]) for i in range(len(bbox1[0]))]
+    size = [upper[i] - index[i] for i in range(len(index))]
+    return (index, size)
+
+
+def paddingInVoxels(distance, image, useImageSpacing=True):
+    # Number of voxels along each axis that covers 'distance' (mm, or voxels if
+    # useImageSpacing is False), plus one voxel.
+    spacing = image.GetSpacing()
+    padding = []
+    for axis in range(image.GetDimension()):
+        d = distance / spacing[axis] if useImageSpacing else distance
+        padding.append(int(math.ceil(d)) + 1)
+    return padding
+
+
+def getBoundingBoxInImage(label, image, paddingMM=0.0):
+    # Bounding box of the non-zero voxels of the label, mapped onto the grid of 'image'
+    # (the label and the image may have different grids) and padded by 'paddingMM'.
+    # Returns None if the label is empty.
+    bbox = getLabelBoundingBox(label)
+    if bbox is None:
+        return None
+    (index, size) = bbox
+    dimension = label.GetDimension()
+
+    lower = [float('inf')] * dimension
+    upper = [-float('inf')] * dimension
+    for corner in range(2 ** dimension):
+        labelIndex = [index[axis] + (size[axis] - 1 if (corner >> axis) & 1 else 0) for axis in range(dimension)]
+        point = label.TransformIndexToPhysicalPoint(labelIndex)
+        imageIndex = image.TransformPhysicalPointToContinuousIndex(point)
+        for axis in range(dimension):
+            lower[axis] = min(lower[axis], imageIndex[axis])
+            upper[axis] = max(upper[axis], imageIndex[axis])
+
+    imageSize = image.GetSize()
+    imageBBoxIndex = [0] * dimension
+    imageBBoxSize = [0] * dimension
+    for axis in range(dimension):
+        lo = max(int(math.floor(lower[axis])), 0)
+        hi = min(int(math.ceil(upper[axis])) + 1, imageSize[axis])
+        imageBBoxIndex[axis] = lo
+        imageBBoxSize[axis] = max(hi - lo, 0)
+    if 0 in imageBBoxSize:
+        return None
+
+    return padBoundingBox((imageBBoxIndex, imageBBoxSize), paddingInVoxels(paddingMM, image), image)
+
+
+def cropImage(image, bbox):
+    (index, size) = bbox
+    return sitk.RegionOfInterest(image, size, index)
+
+
+def uncropImage(croppedImage, bbox, refImage):
+    # Paste the cropped image onto a zero image with the grid of 'refImage'.
+    (index, size) = bbox
+    fullImage = sitk.Image(refImage.GetSize(), croppedImage.GetPixelID())
+    fullImage.CopyInformation(refImage)
+    return sitk.Paste(fullImage, croppedImage, size, [0] * len(index), index)
@@ -0,0 +1,92 @@
+#! /usr/bin/python
+
+import collections
+import concurrent.futures
+import image_store as ims
+
+#
+# Background reading (prefetch) and writing (write-behind) of images.
+#
+# prefetch() loads the next items on a background thread while the current one is
+# being processed. A writer (createWriter()) writes images on a background thread; the
+# errors are raised by writeImage() or flushWriter() in the calling thread.
+#
+# With a depth of 0, images are read and written synchronously.
+#
+
+
+def completedFuture(func, *args):
+    # Call func(*args) now, and return a future with its result (or exception).
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def prefetch(items, load, depth=2):
+    # Generator that yields (item, future) for each item, where future.result() returns
+    # load(item). Up to 'depth' items after the current one are loaded in advance.
+
+    items = list(items)
+    if depth <= 0:
+        for item in items:
+            yield (item, completedFuture(load, item))
+        return
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    futures = collections.deque()
+    try:
+        nextItem = 0
+        for i in range(len(items)):
+            while nextItem < len(items) and nextItem <= i + depth:
+                futures.append(executor.submit(load, items[nextItem]))
+                nextItem = nextItem + 1
+            yield (items[i], futures.popleft())
+    finally:
+        # Stop loading if the caller did not consume all the items.
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def createWriter(depth=2):
+    # Writer that keeps up to 'depth' images pending.
+    writer = {
+        'depth'    : depth,
+        'executor' : concurrent.futures.ThreadPoolExecutor(max_workers=1) if depth > 0 else None,
+        'pending'  : collections.deque(),
+    }
+    return writer
+
+
+def writeImage(writer, image, path, compressionLevel=-1):
+    # Write 'image' to 'path' (see image_store.writeImage()). The image must not be
+    # modified afterwards.
+
+    if writer['executor'] is None:
+        ims.writeImage(image, path, compressionLevel)
+        return
+
+    pending = writer['pending']
+    # Wait for the oldest write if the queue is full. Its error (if any) is raised here.
+    while len(pending) >= writer['depth']:
+        pending.popleft().result()
+    pending.append(writer['executor'].submit(ims.writeImage, image, path, compressionLevel))
+
+
+def flushWriter(writer):
+    # Wait until all pending images are written. The first error is raised.
+    pending = writer['pending']
+    while len(pending) > 0:
+        pending.popleft().result()
+
+
+def closeWriter(writer):
+    # Wait for the pending images and stop the thread. Errors are not raised; call
+    # flushWriter() first to check them.
+    if writer['executor'] is not None:
+        writer['executor'].shutdown(wait=True)
+        writer['executor'] = None
+    writer['pending'].clear()
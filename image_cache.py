@@ -0,0 +1,190 @@
+#! /usr/bin/python
+
+import argparse, sys, os
+import hashlib
+import json
+import numpy as np
+import SimpleITK as sitk
+import image_catalog as ic
+
+#
+# On-disk cache of decoded input images.
+#
+# ingest() converts the images referenced by the image list file into the cache
+# directory. Each image is stored as '<key>.npy' (the raw voxel array) and '<key>.json'
+# (the source file, its modification time and size, and the geometry). When read, the
+# array is memory-mapped and copied once into the image: the gain is that no
+# decompression is needed, and no intermediate array is allocated. The key is a hash of
+# the absolute path, the modification time and the size of the source file, so an
+# updated file is not found in the cache.
+#
+# Once setCacheDir() is called, readImage() returns the cached image if it is up to date,
+# and otherwise reads the source file. cacheStats counts the images found in the cache
+# (hits) and read from the source file (misses) while the cache is enabled.
+#
+
+cacheDir = None
+cacheStats = {
+    'hits'   : 0,
+    'misses' : 0,
+}
+
+# Voxel types of the arrays for the pixel types given to readImage()
+pixelTypeDTypes = {
+    sitk.sitkUInt8   : np.uint8,
+    sitk.sitkInt8    : np.int8,
+    sitk.sitkUInt16  : np.uint16,
+    sitk.sitkInt16   : np.int16,
+    sitk.sitkUInt32  : np.uint32,
+    sitk.sitkInt32   : np.int32,
+    sitk.sitkUInt64  : np.uint64,
+    sitk.sitkInt64   : np.int64,
+    sitk.sitkFloat32 : np.float32,
+    sitk.sitkFloat64 : np.float64,
+}
+
+
+def setCacheDir(path):
+    # Read the images from the cache in 'path' (None to disable).
+    global cacheDir
+    cacheDir = path
+
+
+def getSourceSignature(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+
+def getCacheKey(signature):
+    return hashlib.sha256(json.dumps(list(signature)).encode()).hexdigest()
+
+
+def getCachePaths(directory, path):
+    key = getCacheKey(getSourceSignature(path))
+    return (os.path.join(directory, key + '.npy'), os.path.join(directory, key + '.json'))
+
+
+def ingestImage(directory, path):
+    # Add the image at 'path' to the cache. Returns False if it is already up to date.
+
+    (arrayPath, sidecarPath) = getCachePaths(directory, path)
+    if os.path.exists(sidecarPath):
+        return False
+
+    image = sitk.ReadImage(path)
+    signature = getSourceSignature(path)
+    sidecar = {
+        'source'     : signature[0],
+        'mtime'      : signature[1],
+        'size'       : signature[2],
+        'pixelType'  : image.GetPixelIDTypeAsString(),
+        'components' : image.GetNumberOfComponentsPerPixel(),
+        'origin'     : list(image.GetOrigin()),
+        'spacing'    : list(image.GetSpacing()),
+        'direction'  : list(image.GetDirection()),
+    }
+
+    # Write to temporary files first; the sidecar is written last, so an entry with a
+    # sidecar is always complete.
+    os.makedirs(directory, exist_ok=True)
+    tmpArrayPath = '%s.%d.tmp.npy' % (arrayPath[:-4], os.getpid())
+    np.save(tmpArrayPath, sitk.GetArrayViewFromImage(image))
+    os.replace(tmpArrayPath, arrayPath)
+    tmpSidecarPath = '%s.%d.tmp' % (sidecarPath, os.getpid())
+    with open(tmpSidecarPath, 'w') as f:
+        json.dump(sidecar, f, indent=1)
+    os.replace(tmpSidecarPath, sidecarPath)
+
+    return True
+
+
+def readCachedImage(directory, path, pixelType=sitk.sitkUnknown):
+    # Return the cached image for 'path', or None if it is not in the cache (or is stale).
+
+    (arrayPath, sidecarPath) = getCachePaths(directory, path)
+    if not os.path.exists(sidecarPath):
+        return None
+    with open(sidecarPath, 'r') as f:
+        sidecar = json.load(f)
+
+    array = np.load(arrayPath, mmap_mode='r')
+    if pixelType in pixelTypeDTypes and array.dtype != pixelTypeDTypes[pixelType]:
+        array = array.astype(pixelTypeDTypes[pixelType])
+    image = sitk.GetImageFromArray(array, isVector=(sidecar['components'] > 1))
+    if pixelType != sitk.sitkUnknown and image.GetPixelID() != pixelType:
+        image = sitk.Cast(image, pixelType)
+
+    image.SetOrigin(sidecar['origin'])
+    image.SetSpacing(sidecar['spacing'])
+    image.SetDirection(sidecar['direction'])
+    return image
+
+
+def readImage(path, pixelType=sitk.sitkUnknown):
+    # Same as sitk.ReadImage(path, pixelType), but the image is taken from the cache if
+    # the cache is enabled and up to date.
+
+    if cacheDir:
+        image = readCachedImage(cacheDir, path, pixelType)
+        if image is not None:
+            cacheStats['hits'] = cacheStats['hits'] + 1
+            return image
+        cacheStats['misses'] = cacheStats['misses'] + 1
+    return sitk.ReadImage(path, pixelType)
+
+
+def getInputFiles(catalog):
+    # Paths of the input images of run_registration.py and run_evaluation.py.
+
+    files = []
+    for exam in ic.getExams(catalog):
+        planImages = ic.getPlanImages(catalog, exam)
+        if planImages:
+            files.append('PC%03d/NRRD/%s' % (exam, planImages[0]))
+            files.append('PC%03d/NIFTY-Anatomy-label/%s' % (exam, planImages[1]))
+        for record in ic.getExamImages(catalog, exam):
+            files.append('PC%03d/NIFTY-Iceball-AXTSE/%s' % (exam, record.imageFile))
+            files.append('PC%03d/NIFTY-Iceball-AXTSE-label/%s' % (exam, record.labelFile))
+    return files
+
+
+def ingest(catalog, directory):
+    # Add all input images to the cache. Missing files are skipped.
+    # Returns the numbers of (added, up-to-date, missing) files.
+
+    added = 0
+    upToDate = 0
+    missing = 0
+    for path in getInputFiles(catalog):
+        if not os.path.exists(path):
+            missing = missing + 1
+            continue
+        if ingestImage(directory, path):
+            added = added + 1
+        else:
+            upToDate = upToDate + 1
+    return (added, upToDate, missing)
+
+
+def main(argv):
+
+    args = []
+    try:
+        parser = argparse.ArgumentParser(description="Convert the images listed in the image list file into the image cache.")
+        parser.add_argument('list', metavar='IMAGE_LIST', type=str, nargs=1,
+                            help='A JSON file that lists planning and intraprocedural images.')
+        parser.add_argument('cache', metavar='CACHE_DIR', type=str, nargs=1,
+                            help='Cache directory')
+        args = parser.parse_args(argv)
+
+    except Exception as e:
+        print(e)
+        sys.exit()
+
+    catalog = ic.loadCatalog(args.list[0])
+    (added, upToDate, missing) = ingest(catalog, args.cache[0])
+    print ('Added: %d, up to date: %d, missing: %d' % (added, upToDate, missing))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,114 @@
+#! /usr/bin/python
+
+import json
+import collections
+
+#
+# Catalog of the images listed in the image list file (image_list.json).
+#
+# The file is parsed once into records, which are indexed by exam and by
+# (exam, cycle, series). The time interval from the previous series in the same
+# freeze cycle is computed for each record.
+#
+
+# A row of INTRA_IMAGES
+#   index     : Row index in INTRA_IMAGES
+#   exam      : Exam (case) number
+#   cycle     : Freeze cycle
+#   time      : Time (min)
+#   series    : Series number
+#   freg      : 0: No registration; 1: Registration w/o mask; 2: Registration w/ mask; 3: registration w/mask w/offset
+#   imageFile : Intraop image file
+#   labelFile : Ablation label file
+#   offset    : Manual offset (freg == 3), or None
+#   dt        : Time interval from the previous series in the same cycle (from 0 for the first series)
+#   data      : The original row
+IntraImage = collections.namedtuple('IntraImage', ['index', 'exam', 'cycle', 'time', 'series', 'freg',
+                                                   'imageFile', 'labelFile', 'offset', 'dt', 'data'])
+
+
+def loadCatalog(imageListFile):
+
+    imageList = None
+    with open(imageListFile, "r") as read_file:
+        imageList = json.load(read_file)
+
+    return createCatalog(imageList)
+
+
+def createCatalog(imageList):
+
+    planImageDict = imageList['PLAN_IMAGES']
+    intraImageList = imageList['INTRA_IMAGES']
+
+    records = []
+    lastTime = {}
+    for (index, line) in enumerate(intraImageList):
+        exam = int(line[0])
+        cycle = int(line[1])
+        time = line[2]
+        offset = None
+        if len(line) > 7:
+            offset = [float(v) for v in line[7]]
+
+        # Time interval from the previous series in the same cycle
+        key = (exam, cycle)
+        dt = float(time) - (lastTime[key] if key in lastTime else 0.0)
+        lastTime[key] = float(time)
+
+        records.append(IntraImage(index, exam, cycle, time, int(line[3]), int(line[4]),
+                                  line[5], line[6], offset, dt, line))
+
+    examIndex = collections.OrderedDict()
+    seriesIndex = {}
+    for record in records:
+        if not record.exam in examIndex:
+            examIndex[record.exam] = []
+        examIndex[record.exam].append(record)
+        key = (record.exam, record.cycle, record.series)
+        if not key in seriesIndex:
+            seriesIndex[key] = record
+
+    catalog = {
+        'planImages'  : planImageDict,
+        'intraImages' : records,
+        'exams'       : examIndex,
+        'series'      : seriesIndex,
+    }
+    return catalog
+
+
+def getExams(catalog):
+    # Exams in the order of their first appearance in INTRA_IMAGES
+    return list(catalog['exams'].keys())
+
+
+def getExamImages(catalog, exam):
+    # Records of the exam in the order of INTRA_IMAGES
+    if not int(exam) in catalog['exams']:
+        return []
+    return catalog['exams'][int(exam)]
+
+
+def getCycles(catalog, exam):
+    return sorted(set([record.cycle for record in getExamImages(catalog, exam)]))
+
+
+def getCycleImages(catalog, exam, cycle):
+    # Records of the freeze cycle in the order of INTRA_IMAGES
+    return [record for record in getExamImages(catalog, exam) if record.cycle == int(cycle)]
+
+
+def getIntraImage(catalog, exam, cycle, series):
+    key = (int(exam), int(cycle), int(series))
+    if not key in catalog['series']:
+        return None
+    return catalog['series'][key]
+
+
+def getPlanImages(catalog, exam):
+    # [plan image file, anatomy label file] for the exam, or None
+    key = str(int(exam))
+    if not key in catalog['planImages']:
+        return None
+    return catalog['planImages'][key]
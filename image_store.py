@@ -0,0 +1,185 @@
+#! /usr/bin/python
+
+import argparse, sys, os
+import json
+import zipfile
+import numpy as np
+import SimpleITK as sitk
+
+#
+# Output formats for the intermediate images (resampled series and duration maps).
+#
+# The format is one of:
+#   'same'      : The name (and the format) of the input file, e.g. REG-ICEBALL-<input>.nii.gz
+#   'nii.gz', 'nii', 'nrrd', 'mha' : The stem of the file name with this extension
+#   'container' : All images in the directory are stored in a single zip file
+#                 (<directory>/<containerName>.zip), one uncompressed .npy member per image
+#                 and a .json member with its geometry. Each image is added as soon as it is
+#                 written, and can be read without reading the others.
+#
+# The path of an image in a container is given as '<zip file>#<name>'.
+#
+# 'compressionLevel' (1-9) compresses 'nrrd', 'mha' and 'container' images at this level;
+# with 0 or -1, they are not compressed. '.nii.gz' is always compressed with the default
+# level of the NIfTI writer. Images can be exported to .nii.gz with exportImages().
+#
+
+outputFormats = ['same', 'nii.gz', 'nii', 'nrrd', 'mha', 'container']
+
+# Extensions removed by stripExtension(), longest first
+imageExtensions = ['.nii.gz', '.nrrd.gz', '.nii', '.nrrd', '.nhdr', '.mha', '.mhd']
+
+containerSeparator = '#'
+
+
+def stripExtension(fileName):
+    for ext in imageExtensions:
+        if fileName.endswith(ext):
+            return fileName[:-len(ext)]
+    return fileName
+
+
+def getImagePath(directory, fileName, outputFormat='same', containerName='images'):
+    # Path of the image 'fileName' (the name in the 'same' format) in the directory.
+    if outputFormat == 'same':
+        return '%s/%s' % (directory, fileName)
+    if outputFormat == 'container':
+        return '%s/%s.zip%s%s' % (directory, containerName, containerSeparator, stripExtension(fileName))
+    return '%s/%s.%s' % (directory, stripExtension(fileName), outputFormat)
+
+
+def getFilePath(path):
+    # The file that holds the image at 'path' (the zip file for a container).
+    return path.split(containerSeparator)[0]
+
+
+def getFilePaths(paths):
+    # File paths of the images, without duplicates, in the order of 'paths'.
+    files = []
+    for path in paths:
+        f = getFilePath(path)
+        if not f in files:
+            files.append(f)
+    return files
+
+
+def isContainerPath(path):
+    return containerSeparator in path
+
+
+def removeContainer(path):
+    # Remove the container that holds 'path', so that the images are written to a new one.
+    if isContainerPath(path) and os.path.exists(getFilePath(path)):
+        os.remove(getFilePath(path))
+
+
+def getGeometry(image):
+    return {
+        'origin'    : list(image.GetOrigin()),
+        'spacing'   : list(image.GetSpacing()),
+        'direction' : list(image.GetDirection()),
+    }
+
+
+def writeContainerImage(image, path, compressionLevel=-1):
+
+    (zipPath, name) = path.split(containerSeparator)
+    if compressionLevel > 0:
+        (compression, level) = (zipfile.ZIP_DEFLATED, compressionLevel)
+    else:
+        (compression, level) = (zipfile.ZIP_STORED, None)
+
+    with zipfile.ZipFile(zipPath, 'a', compression=compression, compresslevel=level) as z:
+        # An image written again replaces the previous one, which remains in the file
+        # until the container is removed.
+        with z.open(name + '.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, sitk.GetArrayViewFromImage(image), allow_pickle=False)
+        z.writestr(name + '.json', json.dumps(getGeometry(image)))
+
+
+def readContainerImage(path):
+
+    (zipPath, name) = path.split(containerSeparator)
+    with zipfile.ZipFile(zipPath, 'r') as z:
+        with z.open(name + '.npy') as f:
+            array = np.lib.format.read_array(f, allow_pickle=False)
+        geometry = json.loads(z.read(name + '.json'))
+
+    image = sitk.GetImageFromArray(array)
+    image.SetOrigin(geometry['origin'])
+    image.SetSpacing(geometry['spacing'])
+    image.SetDirection(geometry['direction'])
+    return image
+
+
+def getContainerNames(zipPath):
+    # Names of the images in the container, in the order they were added.
+    names = []
+    with zipfile.ZipFile(zipPath, 'r') as z:
+        for member in z.namelist():
+            if member.endswith('.npy') and not member[:-4] in names:
+                names.append(member[:-4])
+    return names
+
+
+def writeImage(image, path, compressionLevel=-1):
+
+    if isContainerPath(path):
+        writeContainerImage(image, path, compressionLevel)
+    elif compressionLevel > 0:
+        sitk.WriteImage(image, path, True, compressionLevel)
+    else:
+        sitk.WriteImage(image, path)
+
+
+def readImage(path, pixelType=sitk.sitkUnknown):
+
+    if isContainerPath(path):
+        image = readContainerImage(path)
+        if pixelType != sitk.sitkUnknown and image.GetPixelID() != pixelType:
+            image = sitk.Cast(image, pixelType)
+        return image
+    return sitk.ReadImage(path, pixelType)
+
+
+def exportImages(path, outputDir):
+    # Export the image at 'path', or all the images in the container file 'path', to
+    # '<outputDir>/<name>.nii.gz'. Returns the paths of the exported files.
+
+    if zipfile.is_zipfile(path):
+        paths = ['%s%s%s' % (path, containerSeparator, name) for name in getContainerNames(path)]
+    else:
+        paths = [path]
+
+    os.makedirs(outputDir, exist_ok=True)
+    exported = []
+    for p in paths:
+        name = p.split(containerSeparator)[1] if isContainerPath(p) else stripExtension(os.path.basename(p))
+        outputPath = '%s/%s.nii.gz' % (outputDir, name)
+        sitk.WriteImage(readImage(p), outputPath)
+        exported.append(outputPath)
+    return exported
+
+
+def main(argv):
+
+    args = []
+    try:
+        parser = argparse.ArgumentParser(description="Export images (or all images in containers) to NIfTI (.nii.gz).")
+        parser.add_argument('input', metavar='INPUT', type=str, nargs='+',
+                            help='Image files or containers (.zip)')
+        parser.add_argument('-o', dest='outputDir', default='.',
+                            help='Output directory (default: .)')
+        args = parser.parse_args(argv)
+
+    except Exception as e:
+        print(e)
+        sys.exit()
+
+    for path in args.input:
+        for outputPath in exportImages(path, args.outputDir):
+            print (outputPath)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
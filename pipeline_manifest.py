@@ -0,0 +1,100 @@
+#! /usr/bin/python
+
+import os
+import json
+
+#
+# Build manifest for incremental processing.
+#
+# The manifest is a JSON file that records, for each stage (e.g. 'registration' or
+# 'evaluation') and each exam, the input files, the settings, the output files and
+# the result rows of the last successful run:
+#
+#   {
+#     STAGE : {
+#       EXAM : {
+#         'inputs'   : { PATH : [MTIME, SIZE], ... },
+#         'settings' : { ... },
+#         'outputs'  : { PATH : [MTIME, SIZE], ... },
+#         'rows'     : { ... }
+#       }
+#     }
+#   }
+#
+# An exam is processed again only if any of its inputs or settings has changed, or
+# any of its outputs is missing or has been modified. The entry for an exam is saved
+# as soon as the exam is finished, so an interrupted run resumes from there.
+#
+
+
+def fileSignature(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def fileSignatures(paths):
+    signatures = {}
+    for path in paths:
+        signatures[path] = fileSignature(path)
+    return signatures
+
+
+def loadManifest(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def saveManifest(manifest, path):
+    # Write to a temporary file first, so that the manifest is never left
+    # partially written.
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmpPath, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmpPath, path)
+
+
+def normalize(settings):
+    # Convert the settings to the form they take after a round trip through JSON
+    # (e.g. tuples become lists, integer keys become strings).
+    return json.loads(json.dumps(settings, sort_keys=True))
+
+
+def getEntry(manifest, stage, exam, inputs, settings):
+    # Return the recorded entry for the exam if it is up to date, otherwise None.
+    # 'inputs' is a list of the input file paths.
+
+    if not stage in manifest or not str(exam) in manifest[stage]:
+        return None
+    entry = manifest[stage][str(exam)]
+
+    if entry['settings'] != normalize(settings):
+        return None
+    if entry['inputs'] != normalize(fileSignatures(inputs)):
+        return None
+    for path in entry['outputs']:
+        if fileSignature(path) != entry['outputs'][path]:
+            return None
+
+    return entry
+
+
+def recordEntry(path, stage, exam, inputs, settings, outputs, rows):
+    # Record the exam in the manifest file at 'path'. The file is read again before
+    # being updated, so that entries recorded by other stages are preserved.
+
+    manifest = loadManifest(path)
+    if not stage in manifest:
+        manifest[stage] = {}
+
+    manifest[stage][str(exam)] = normalize({
+        'inputs'   : fileSignatures(inputs),
+        'settings' : settings,
+        'outputs'  : fileSignatures(outputs),
+        'rows'     : rows,
+    })
+
+    saveManifest(manifest, path)
@@ -0,0 +1,161 @@
+#! /usr/bin/python
+
+import os, sys, time
+import json
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#
+# Opt-in instrumentation of the processing stages.
+#
+# When enabled, each stage records its wall time and the peak resident set size (RSS)
+# of the process during the stage as a JSON line:
+#
+#   {"event": "stage", "stage": "register", "exam": 1, "series": 12, "time": 1.23, "peakRSS": 123456, "pid": 1234}
+#
+# The peak of the stage is measured on Linux, where the high-water mark of the process
+# (VmHWM in /proc/self/status) is reset at the start of each stage by writing '5' to
+# /proc/self/clear_refs. The peak of a stage includes those of the stages nested in it.
+# Stages run at the same time in different threads of a process share the mark, so
+# their peaks are those of the process over the stage. Where the mark cannot be reset,
+# the lifetime peak of the process (ru_maxrss) is recorded as 'processPeakRSS' instead;
+# it is the largest value of any stage so far, not the peak of the stage.
+#
+# Other events (e.g. 'registration', with the optimizer statistics of registerImages())
+# are recorded with record(). The fields set by setContext() (e.g. the exam and series
+# being processed) are added to every line. When disabled, stage() returns a shared
+# no-op context manager and record() returns immediately.
+#
+
+enabled = False
+outputFile = None
+context = {}
+
+# True if the high-water mark can be reset (None until checked)
+canResetPeak = None
+# Peak RSS (kB) so far of each open stage, outermost first
+openStagePeaks = []
+
+nullStage = contextlib.nullcontext()
+
+
+def enable(path):
+    # Start recording to 'path' ('-' for stderr). The file is opened in append mode,
+    # so that worker processes can write to the same file.
+    global enabled, outputFile
+    if path == '-':
+        outputFile = sys.stderr
+    else:
+        outputFile = open(path, 'a')
+    enabled = True
+
+
+def disable():
+    global enabled, outputFile
+    if outputFile and outputFile != sys.stderr:
+        outputFile.close()
+    outputFile = None
+    enabled = False
+
+
+def setContext(**fields):
+    # Replace the fields added to every line.
+    global context
+    context = fields
+
+
+def getProcessPeakRSS():
+    # Peak resident set size of the process since it started in kB, or None if not
+    # available.
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes on macOS
+        peak = peak // 1024
+    return peak
+
+
+def record(event, **fields):
+    if not enabled:
+        return
+    line = {'event' : event}
+    line.update(context)
+    line.update(fields)
+    line['pid'] = os.getpid()
+    # A single write per line, so that lines from different processes are not mixed.
+    outputFile.write(json.dumps(line) + '\n')
+    outputFile.flush()
+
+
+def readHighWaterMark():
+    # VmHWM of the process in kB
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    raise Exception('No VmHWM in /proc/self/status')
+
+
+def resetHighWaterMark():
+    # Reset VmHWM to the current RSS. Returns False if not possible.
+    global canResetPeak
+    if canResetPeak is False:
+        return False
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        readHighWaterMark()
+        canResetPeak = True
+    except Exception:
+        canResetPeak = False
+    return canResetPeak
+
+
+def updateOpenStagePeaks(peak):
+    for i in range(len(openStagePeaks)):
+        openStagePeaks[i] = max(openStagePeaks[i], peak)
+
+
+def beginStagePeak():
+    # Start measuring the peak RSS of a stage. The peak so far is passed on to the open
+    # stages first, since the reset discards it.
+    if canResetPeak is False:
+        return
+    if len(openStagePeaks) > 0:
+        updateOpenStagePeaks(readHighWaterMark())
+    if resetHighWaterMark():
+        openStagePeaks.append(0)
+
+
+def endStagePeak(stats):
+    # Add the peak RSS of the stage to 'stats'.
+    if canResetPeak and len(openStagePeaks) > 0:
+        peak = max(openStagePeaks.pop(), readHighWaterMark())
+        updateOpenStagePeaks(peak)
+        stats['peakRSS'] = peak
+    else:
+        stats['processPeakRSS'] = getProcessPeakRSS()
+
+
+@contextlib.contextmanager
+def timeStage(name, fields):
+    beginStagePeak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = {'time' : time.perf_counter() - start}
+        endStagePeak(stats)
+        record('stage', stage=name, **stats, **fields)
+
+
+def stage(name, **fields):
+    # Context manager that records the wall time and the peak RSS of the stage.
+    if not enabled:
+        return nullStage
+    return timeStage(name, fields)
@@ -0,0 +1,77 @@
+#! /usr/bin/python
+
+import os
+import collections
+import SimpleITK as sitk
+import ablation_registration as ar
+import image_cache as icache
+
+#
+# In-process cache for the plan data shared by all intraop series of an exam
+# (plan image, anatomy label and the mask derived from the label).
+#
+# Entries are keyed by exam, file path and modification time, so an updated file
+# is decoded again. The least recently used entry is evicted once the number of
+# entries exceeds the limit set by setCacheSize().
+#
+# NOTE: The cached images are shared by the callers. Do not modify them in place.
+#
+
+cacheSize = 8
+cacheEntries = collections.OrderedDict()
+cacheStats = {
+    'hits'   : 0,
+    'misses' : 0,
+}
+
+
+def setCacheSize(size):
+    global cacheSize
+    cacheSize = max(size, 0)
+    evict()
+
+
+def clearCache():
+    cacheEntries.clear()
+
+
+def evict():
+    while len(cacheEntries) > cacheSize:
+        cacheEntries.popitem(last=False)
+
+
+def fileKey(path):
+    return (os.path.abspath(path), os.path.getmtime(path))
+
+
+def lookup(key, create):
+    # Return the cached object for 'key', or call create() and cache its result.
+    if key in cacheEntries:
+        cacheEntries.move_to_end(key)
+        cacheStats['hits'] = cacheStats['hits'] + 1
+        return cacheEntries[key]
+
+    cacheStats['misses'] = cacheStats['misses'] + 1
+    obj = create()
+    if cacheSize > 0:
+        cacheEntries[key] = obj
+        evict()
+    return obj
+
+
+def readImage(exam, path, pixelType=sitk.sitkFloat32):
+    key = ('image', str(exam), fileKey(path), pixelType)
+    return lookup(key, lambda: icache.readImage(path, pixelType))
+
+
+def getMaskFromAnatomLabel(exam, labelPath, imagePath, dilation=0):
+    # Mask derived from the anatomy label by ar.createMaskFromAnatomLabel(),
+    # defined on the grid of the image at 'imagePath'.
+    key = ('mask', str(exam), fileKey(labelPath), fileKey(imagePath), dilation)
+
+    def create():
+        anatomLabel = readImage(exam, labelPath, sitk.sitkUInt16)
+        image = readImage(exam, imagePath, sitk.sitkFloat32)
+        return ar.createMaskFromAnatomLabel(anatomLabel, image, dilation=dilation)
+
+    return lookup(key, create)
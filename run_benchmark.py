@@ -0,0 +1,428 @@
+#! /usr/bin/python
+
+import argparse, sys, os, time
+import platform
+import json
+import numpy as np
+import SimpleITK as sitk
+import ablation_evaluation as ae
+import ablation_registration as ar
+import ablation_metrics as am
+import run_evaluation as ev
+
+#
+# Benchmarks for the registration and evaluation steps on synthetic images.
+#
+# A T2-like prostate phantom (plan image and anatomy label: 1: TG, 2: EUS, 3: NVB) and
+# the intraprocedural images of a freeze cycle (a shifted phantom with a growing iceball)
+# are generated, and the time of each step is measured for each combination of volume
+# size and number of series. The results are written as JSON, and can be compared with
+# the results of a previous run (--baseline).
+#
+# With --pyramid, the multi-resolution configurations of registerImages() are compared
+# instead: the phantom is moved by known rigid transforms, and the time, the number of
+# iterations at the finest level and the error of the registration are printed as the
+# tables in README.md.
+#
+
+# Multi-resolution configurations compared by --pyramid: (name, registration parameters)
+pyramidConfigs = [
+    ('1 / 0 / 0.02 (current)',         {}),
+    ('2,1 / 1,0 / 0.08,0.02',          {'shrinkFactors' : [2, 1], 'smoothingSigmas' : [1, 0], 'samplingPercentages' : [0.08, 0.02]}),
+    ('4,1 / 2,0 / 0.32,0.02',          {'shrinkFactors' : [4, 1], 'smoothingSigmas' : [2, 0], 'samplingPercentages' : [0.32, 0.02]}),
+    ('4,2,1 / 2,1,0 / 0.32,0.08,0.02', {'shrinkFactors' : [4, 2, 1], 'smoothingSigmas' : [2, 1, 0], 'samplingPercentages' : [0.32, 0.08, 0.02]}),
+    ('4,2,1 / 2,1,0 / 0.02',           {'shrinkFactors' : [4, 2, 1], 'smoothingSigmas' : [2, 1, 0]}),
+]
+
+# Motions of the moving image for --pyramid: (name, rotation about z (deg), translation (mm))
+pyramidMotions = [
+    ('Small motion', 3.0, [3.0, -2.0, 1.5]),
+    ('Large motion', 8.0, [10.0, -6.0, 4.0]),
+]
+
+
+def createPhantom(size, spacing, seed=0):
+    # Returns (image, anatomLabel) with the size (x, y, z) and spacing (mm).
+    # The gland is an ellipsoid at the center of the volume, the urethra (EUS) a
+    # cylinder through the gland, and the neurovascular bundles (NVB) two cylinders
+    # posterolateral to the gland.
+
+    rng = np.random.default_rng(seed)
+    (z, y, x) = np.indices((size[2], size[1], size[0]), dtype=np.float32)
+    x = (x - (size[0] - 1) / 2.0) * spacing[0]
+    y = (y - (size[1] - 1) / 2.0) * spacing[1]
+    z = (z - (size[2] - 1) / 2.0) * spacing[2]
+
+    # Size of the gland (mm) is scaled with the field of view
+    fov = min(size[0] * spacing[0], size[1] * spacing[1])
+    r = fov * 0.2
+    rz = min(r * 0.8, size[2] * spacing[2] * 0.4)
+
+    label = np.zeros(x.shape, dtype=np.uint16)
+    label[(x / r)**2 + (y / (r * 0.8))**2 + (z / rz)**2 <= 1.0] = 1
+    label[(x**2 + (y + r * 0.2)**2 <= (r * 0.1)**2) & (np.abs(z) <= rz)] = 2
+    for side in (-1.0, 1.0):
+        label[((x - side * r * 0.7)**2 + (y - r * 0.8)**2 <= (r * 0.08)**2) & (np.abs(z) <= rz)] = 3
+
+    # Pelvic tissue around the gland, and the gland brighter with a darker
+    # peripheral rim
+    body = (x / (fov * 0.45))**2 + (y / (fov * 0.35))**2 <= 1.0
+    array = np.where(body, 60.0, 5.0).astype(np.float32)
+    array[label == 1] = 120.0
+    array[(label == 1) & ((x / r)**2 + (y / (r * 0.8))**2 + (z / rz)**2 > 0.6)] = 160.0
+    array[label == 2] = 40.0
+    array[label == 3] = 90.0
+    array = array + rng.normal(0.0, 8.0, array.shape).astype(np.float32)
+
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(spacing)
+    image.SetOrigin([-(size[i] - 1) / 2.0 * spacing[i] for i in range(3)])
+    anatomLabel = sitk.GetImageFromArray(label)
+    anatomLabel.CopyInformation(image)
+
+    return (image, anatomLabel)
+
+
+def createSeries(image, numberOfSeries, seed=1):
+    # Returns a list of (time, movingImage, iceballLabel) for a freeze cycle.
+    # Each image is the phantom shifted by a few mm, with an iceball (dark) growing
+    # from the center of the gland.
+
+    rng = np.random.default_rng(seed)
+    base = sitk.GetArrayFromImage(image)
+    spacing = image.GetSpacing()
+    size = image.GetSize()
+    (z, y, x) = np.indices(base.shape, dtype=np.float32)
+    x = (x - (size[0] - 1) / 2.0) * spacing[0]
+    y = (y - (size[1] - 1) / 2.0) * spacing[1]
+    z = (z - (size[2] - 1) / 2.0) * spacing[2]
+    fov = min(size[0] * spacing[0], size[1] * spacing[1])
+
+    series = []
+    for i in range(numberOfSeries):
+        t = 2.0 * (i + 1)
+        radius = fov * 0.05 * (1.0 + i * 0.5)
+        iceball = (x**2 + y**2 + (z * 1.5)**2) <= radius**2
+        array = np.where(iceball, 10.0, base) + rng.normal(0.0, 4.0, base.shape)
+        array = array.astype(np.float32)
+
+        shift = [1.5 + 0.2 * i, -1.0, 0.5]
+        movingImage = sitk.GetImageFromArray(array)
+        movingImage.CopyInformation(image)
+        movingImage.SetOrigin([image.GetOrigin()[k] + shift[k] for k in range(3)])
+        iceballLabel = sitk.GetImageFromArray(iceball.astype(np.uint16))
+        iceballLabel.CopyInformation(movingImage)
+        series.append((t, movingImage, iceballLabel))
+
+    return series
+
+
+def createMovedImage(image, rotation, translation, seed=3):
+    # Returns (movingImage, transform): the image resampled with a rigid transform (rotation
+    # about the z axis in degrees, translation in mm), with noise. The registration of the
+    # image to 'movingImage' should find 'transform'.
+
+    rng = np.random.default_rng(seed)
+    motion = sitk.VersorRigid3DTransform()
+    motion.SetRotation((0.0, 0.0, 1.0), np.deg2rad(rotation))
+    motion.SetTranslation(translation)
+    moved = sitk.Resample(image, image, motion, sitk.sitkLinear, 0.0)
+    array = sitk.GetArrayFromImage(moved) + rng.normal(0.0, 5.0, image.GetSize()[::-1])
+    movingImage = sitk.GetImageFromArray(array.astype(np.float32))
+    movingImage.CopyInformation(image)
+    return (movingImage, motion.GetInverse())
+
+
+def getRegistrationError(transform, truth, points):
+    # RMS distance (mm) between the points mapped by the transform and by the true transform
+    d = [np.linalg.norm(np.subtract(transform.TransformPoint(p), truth.TransformPoint(p))) for p in points]
+    return float(np.sqrt(np.mean(np.square(d))))
+
+
+def runPyramidBenchmark(size, spacing, rotation, translation, maskDilation, repeat):
+    # Register the phantom moved by (rotation, translation) with each configuration in
+    # pyramidConfigs, 'repeat' times with sampling seeds 1, 2, ... Returns a list of
+    # dictionaries with the setup time (s; the time with one iteration per level), and the
+    # times (s), the numbers of iterations at the finest level and the RMS errors (mm) over
+    # the gland of the runs.
+
+    (planImage, anatomLabel) = createPhantom(size, spacing)
+    (movingImage, truth) = createMovedImage(planImage, rotation, translation)
+    mask = ar.createMaskFromAnatomLabel(anatomLabel, planImage, dilation=maskDilation)
+
+    # Every 500th voxel of the gland
+    indices = np.argwhere(sitk.GetArrayViewFromImage(anatomLabel) == 1)[::500]
+    points = [planImage.TransformIndexToPhysicalPoint([int(i) for i in index[::-1]]) for index in indices]
+
+    results = []
+    for (name, config) in pyramidConfigs:
+        result = {'levels' : name, 'times' : [], 'iterations' : [], 'errors' : []}
+        for seed in range(1, repeat + 1):
+            param = dict(config, initialOffset=[0.0, 0.0, 0.0], samplingSeed=seed)
+            statistics = {}
+            start = time.perf_counter()
+            transform = ar.registerImages(planImage, movingImage, param, mask=mask, maskType='fixed', statistics=statistics)
+            result['times'].append(time.perf_counter() - start)
+            result['iterations'].append(statistics['levelIterations'][-1])
+            result['errors'].append(getRegistrationError(transform, truth, points))
+
+        param = dict(config, initialOffset=[0.0, 0.0, 0.0], samplingSeed=1, numberOfIterations=1)
+        result['setup'] = float(np.median(measure(lambda: ar.registerImages(planImage, movingImage, param, mask=mask, maskType='fixed'), 3)))
+        results.append(result)
+    return results
+
+
+def printPyramidTable(results):
+    print ('| Levels (shrink / sigma / sampling) | Time (s) | Setup (s) | Fine-level iterations | RMS error (mm) | Worst RMS error (mm) |')
+    print ('|---|---|---|---|---|---|')
+    for r in results:
+        print ('| %s | %.2f | %.2f | %.0f | %.2f | %.2f |' % (r['levels'], np.median(r['times']), r['setup'],
+                                                          np.median(r['iterations']), np.median(r['errors']), np.max(r['errors'])))
+
+
+def createMeasurementTable(numberOfGroups, numberOfSeries, seed=2):
+    # Measurement table in the format of the input of ablation_metrics, with
+    # 'numberOfGroups' (Case, Cycle) groups of 'numberOfSeries' rows.
+
+    rng = np.random.default_rng(seed)
+    mesHeader = ['Case', 'Cycle', 'Time', 'Ser'] + am.volNamesAnatom + am.volNamesAblation + am.volNamesAblationDist
+    n = numberOfGroups * numberOfSeries
+    mesTable = np.zeros((n, len(mesHeader)))
+    group = np.repeat(np.arange(numberOfGroups), numberOfSeries)
+    mesTable[:,0] = group // 2 + 1
+    mesTable[:,1] = group % 2 + 1
+    mesTable[:,2] = np.tile(np.arange(1, numberOfSeries + 1) * 2.5, numberOfGroups)
+    mesTable[:,3] = np.tile(np.arange(numberOfSeries) + 10, numberOfGroups)
+    mesTable[:,4:7] = [23.1, 0.5, 0.6]
+    nAblation = len(am.volNamesAblation)
+    mesTable[:,7:7+nAblation] = np.maximum(rng.normal(2.0, 3.0, (n, nAblation)), 0.0)
+    mesTable[:,7+nAblation:] = rng.normal(0.0, 5.0, (n, len(am.volNamesAblationDist)))
+
+    return (mesHeader, mesTable)
+
+
+def measure(func, repeat):
+    # Call 'func' 'repeat' times and return the elapsed times (s).
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def runBenchmarks(size, spacing, numberOfSeries, param, repeat, names):
+    # Run the benchmarks in 'names' for a volume size and a number of series.
+    # Returns a dictionary of the elapsed times (s) keyed by the benchmark name.
+
+    (planImage, anatomLabel) = createPhantom(size, spacing)
+    series = createSeries(planImage, numberOfSeries)
+    maskDilation = param['maskDilation']
+    margins = param['margins']
+    minDurations = param['minDurations']
+
+    mask = ar.createMaskFromAnatomLabel(anatomLabel, planImage, dilation=maskDilation)
+
+    # Registration and resampling of all series
+    transforms = [sitk.VersorRigid3DTransform() for s in series]
+    def registerAll():
+        for (i, (t, movingImage, iceballLabel)) in enumerate(series):
+            regParam = dict(param['registration'])
+            regParam['initialOffset'] = [0.0, 0.0, 0.0]
+            transforms[i] = ar.registerImages(planImage, movingImage, regParam, mask=mask, maskType='fixed')
+
+    def resampleAll():
+        for (i, (t, movingImage, iceballLabel)) in enumerate(series):
+            ar.resampleImage(movingImage, planImage, transforms[i], interp='linear')
+            ar.resampleImage(iceballLabel, planImage, transforms[i], interp='nearest')
+
+    # Evaluation is done on the iceball labels resampled onto the plan image
+    ablationLabels = [ar.resampleImage(iceballLabel, planImage, sitk.TranslationTransform(3, [1.5, -1.0, 0.5]), interp='nearest')
+                      for (t, movingImage, iceballLabel) in series]
+    times = [t for (t, movingImage, iceballLabel) in series]
+
+    def evaluateAll():
+        for label in ablationLabels:
+            ae.evaluateAblation(anatomLabel, label, {'margin' : 0.0})
+
+    def minimumDistancesAll():
+        for label in ablationLabels:
+            ae.computeMinimumDistances(anatomLabel, label)
+
+    durationMaps = {}
+    def sweepAll():
+        accumulator = ev.createDurationAccumulator(margins, anatomLabel)
+        for (i, label) in enumerate(ablationLabels):
+            dt = times[i] - (times[i-1] if i > 0 else 0.0)
+            marginLabels = ae.sweepMargins(label, margins, useImageSpacing=False)
+            for m in margins:
+                ev.addToDurationAccumulator(accumulator, m, marginLabels[m], dt)
+        for m in margins:
+            durationMaps[m] = ev.getDurationMap(accumulator, m)
+
+    def summarizeAll():
+        for m in margins:
+            ev.summarizeDurationMap(durationMaps[m], anatomLabel, minDurations)
+
+    (mesHeader, mesTable) = createMeasurementTable(param['numberOfGroups'], numberOfSeries)
+    def metricsAll():
+        am.processMeasurementTable(mesHeader, mesTable, {})
+
+    benchmarks = [
+        ('registerImages',            registerAll),
+        ('resampleImage',             resampleAll),
+        ('createMaskFromAnatomLabel', lambda: ar.createMaskFromAnatomLabel(anatomLabel, planImage, dilation=maskDilation)),
+        ('evaluateAblation',          evaluateAll),
+        ('computeMinimumDistances',   minimumDistancesAll),
+        ('sweepMargins',              sweepAll),
+        ('summarizeDurationMap',      summarizeAll),
+        ('processMeasurementTable',   metricsAll),
+    ]
+
+    results = {}
+    for (name, func) in benchmarks:
+        if names and not name in names:
+            continue
+        # summarizeDurationMap needs the maps computed by sweepMargins
+        if name == 'summarizeDurationMap' and len(durationMaps) == 0:
+            sweepAll()
+        results[name] = measure(func, repeat)
+    return results
+
+
+def getEnvironment():
+    return {
+        'python'    : platform.python_version(),
+        'platform'  : platform.platform(),
+        'cpuCount'  : os.cpu_count(),
+        'numpy'     : np.__version__,
+        'SimpleITK' : sitk.Version_VersionString(),
+        'threads'   : sitk.ProcessObject.GetGlobalDefaultNumberOfThreads(),
+    }
+
+
+def compareResults(results, baseline, tolerance):
+    # Print (to stderr) the ratio of the minimum time of each benchmark to that in the baseline,
+    # and return the number of benchmarks slower than the baseline by more than 'tolerance'.
+
+    baselineTimes = {}
+    for r in baseline['results']:
+        baselineTimes[(r['name'], tuple(r['size']), r['series'])] = r['min']
+
+    print ('Name,Size,Series,Min,BaselineMin,Ratio', file=sys.stderr)
+    numberOfRegressions = 0
+    for r in results:
+        key = (r['name'], tuple(r['size']), r['series'])
+        if not key in baselineTimes:
+            continue
+        ratio = r['min'] / baselineTimes[key] if baselineTimes[key] > 0 else float('inf')
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            flag = ' *'
+            numberOfRegressions = numberOfRegressions + 1
+        print ('%s,%s,%d,%f,%f,%f%s' % (r['name'], 'x'.join([str(s) for s in r['size']]), r['series'],
+                                        r['min'], baselineTimes[key], ratio, flag), file=sys.stderr)
+    return numberOfRegressions
+
+
+def main(argv):
+
+    args = []
+    try:
+        parser = argparse.ArgumentParser(description="Benchmark the registration and evaluation steps on synthetic images.")
+        parser.add_argument('-s', '--size', dest='sizes', action='append', default=None,
+                            help='Volume size X,Y,Z. Can be given more than once. (default: 64,64,24)')
+        parser.add_argument('--spacing', dest='spacing', default='1.0,1.0,3.0',
+                            help='Voxel spacing in mm (default: 1.0,1.0,3.0)')
+        parser.add_argument('-n', '--series', dest='series', default='3',
+                            help='Number of series in the freeze cycle. Comma-separated list. (default: 3)')
+        parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                            help='Number of times each benchmark is run (default: 3)')
+        parser.add_argument('-b', '--benchmark', dest='names', default='',
+                            help='Comma-separated list of the benchmarks to run (default: all)')
+        parser.add_argument('-i', '--iterations', dest='numberOfIterations', type=int, default=0,
+                            help='Maximum number of optimizer iterations for registration (default: registerImages() default)')
+        parser.add_argument('--groups', dest='numberOfGroups', type=int, default=10000,
+                            help='Number of (Case, Cycle) groups in the measurement table for processMeasurementTable (default: 10000)')
+        parser.add_argument('-o', '--output', dest='output', default='',
+                            help='Output JSON file (default: standard output)')
+        parser.add_argument('--baseline', dest='baseline', default='',
+                            help='Results of a previous run (JSON) to compare with.')
+        parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.2,
+                            help='Relative slowdown reported as a regression in the comparison (default: 0.2)')
+        parser.add_argument('--pyramid', dest='pyramid', action='store_true',
+                            help='Compare the multi-resolution configurations of the registration on the phantom moved by known transforms, and print the results as markdown tables. -r sets the number of runs (sampling seeds 1, 2, ...).')
+        args = parser.parse_args(argv)
+
+    except Exception as e:
+        print(e)
+        sys.exit()
+
+    sizes = args.sizes if args.sizes else ['64,64,24']
+    sizes = [[int(v) for v in s.split(',')] for s in sizes]
+    spacing = [float(v) for v in args.spacing.split(',')]
+    seriesCounts = [int(v) for v in args.series.split(',')]
+    names = [v for v in args.names.split(',') if v]
+
+    registrationParam = {}
+    if args.numberOfIterations > 0:
+        registrationParam['numberOfIterations'] = args.numberOfIterations
+
+    param = {
+        'registration'   : registrationParam,
+        'maskDilation'   : 30,
+        'margins'        : [0.0, -1.0, -2.0, -3.0, -4.0, -5.0],
+        'minDurations'   : [0.001, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11.0, 12.0, 13.0, 14.0, 15.0],
+        'numberOfGroups' : args.numberOfGroups,
+    }
+
+    if args.pyramid:
+        for size in sizes:
+            for (name, rotation, translation) in pyramidMotions:
+                print ('%s (%g deg, (%s) mm), %s:\n' % (name, rotation, ', '.join(['%g' % v for v in translation]), 'x'.join([str(s) for s in size])))
+                printPyramidTable(runPyramidBenchmark(size, spacing, rotation, translation, param['maskDilation'], args.repeat))
+                print ('')
+        return
+
+    results = []
+    for size in sizes:
+        for numberOfSeries in seriesCounts:
+            times = runBenchmarks(size, spacing, numberOfSeries, param, args.repeat, names)
+            for name in times:
+                results.append({
+                    'name'   : name,
+                    'size'   : size,
+                    'series' : numberOfSeries,
+                    'times'  : times[name],
+                    'min'    : min(times[name]),
+                    'median' : float(np.median(times[name])),
+                })
+                print ('%s %s %d: %f s' % (name, 'x'.join([str(s) for s in size]), numberOfSeries, min(times[name])), file=sys.stderr)
+
+    report = {
+        'environment' : getEnvironment(),
+        'parameters'  : {
+            'spacing'            : spacing,
+            'repeat'             : args.repeat,
+            'numberOfIterations' : args.numberOfIterations,
+            'maskDilation'       : param['maskDilation'],
+            'numberOfGroups'     : args.numberOfGroups,
+        },
+        'results'     : results,
+    }
+
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print (json.dumps(report, indent=1))
+
+    if args.baseline != '':
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if compareResults(results, baseline, args.tolerance) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
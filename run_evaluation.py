@@ -7,6 +7,12 @@ import ablation_evaluation as ae
 import ablation_registration as ar
 import numpy as np
 import csv
+import pipeline_manifest as pm
+import image_catalog as ic
+import pipeline_profile as pp
+import background_io as bio
+import image_store as ims
+import image_cache as icache
 
 
 anatomDict = {
@@ -17,12 +23,13 @@ anatomDict = {
 
 
 
-def erodeDilateLabelByDistance(label, distance):
+def erodeDilateLabelByDistance(label, distance, useImageSpacing=False):
     # If distance > 0, dilate the label
     # If distance < 0, erode the label
-    distMapFilter = sitk.SignedDanielssonDistanceMapImageFilter()
-    distMap = distMapFilter.Execute(label)
-    newLabel = sitk.BinaryThreshold(distMap, -np.Inf, distance, 1, 0)
+    # The distance is in voxels unless useImageSpacing is True.
+    # (Use ae.sweepMargins() to apply multiple distances to the same label.)
+    distMap = ae.computeSignedDistanceMap(label, useImageSpacing)
+    newLabel = ae.thresholdDistanceMap(distMap, distance)
     
     return newLabel
 
@@ -34,6 +41,283 @@ def thresholdDurationMap(dmap, minDuration, maxDuration=np.Inf):
     return newLabel
 
 
+def summarizeDurationMap(dmap, structureLabel, minDurations):
+    # Compute the ablation volume and the involved volumes of the structures for
+    # each minimum duration in 'minDurations'. The results are the same as those of
+    # ae.evaluateAblation(structureLabel, thresholdDurationMap(dmap, d), ...), but the
+    # map is scanned only once: the durations of the voxels in each structure are
+    # sorted, and the number of voxels above each threshold is found by binary search.
+    # Returns a list of results dictionaries, one for each minimum duration.
+
+    (resampledStructureLabel, structureVolumes) = ae.getResampledStructure(structureLabel, dmap)
+    voxelVolume = ae.getVoxelVolume(dmap)
+
+    durations = sitk.GetArrayViewFromImage(dmap).ravel()
+    structure = sitk.GetArrayViewFromImage(resampledStructureLabel).ravel()
+
+    # Only the voxels with non-zero durations are sorted.
+    nonZero = (durations != 0)
+    nZero = durations.size - np.count_nonzero(nonZero)
+    nonZeroDurations = durations[nonZero]
+    nonZeroStructure = structure[nonZero]
+    zeroStructure = np.bincount(structure[~nonZero], minlength=max(ae.anatomDict)+1)
+
+    sortedDurations = { 0 : np.sort(nonZeroDurations) }
+    nZeros = { 0 : nZero }
+    for i in ae.anatomDict:
+        sortedDurations[i] = np.sort(nonZeroDurations[nonZeroStructure == i])
+        nZeros[i] = zeroStructure[i]
+
+    def countAbove(key, threshold):
+        # Number of voxels with duration >= threshold
+        n = len(sortedDurations[key]) - np.searchsorted(sortedDurations[key], threshold, side='left')
+        if threshold <= 0:
+            n = n + nZeros[key]
+        return n
+
+    summary = []
+    for d in minDurations:
+        # BinaryThreshold compares the pixels against the threshold cast to the pixel type.
+        threshold = np.float32(d)
+        results = {}
+        for i in ae.anatomDict:
+            results['Structure.'+ae.anatomDict[i]] = structureVolumes[i]
+            results['Involved.'+ae.anatomDict[i]] = float(countAbove(i, threshold)) * voxelVolume
+        results['AblationVolume'] = float(countAbove(0, threshold)) * voxelVolume
+        summary.append(results)
+
+    return summary
+
+
+
+def createDurationAccumulator(margins, refImage, ticksPerMinute=60):
+    # Accumulator for the duration maps of all margins, on the grid of 'refImage'.
+    # The maps are kept in one preallocated array and updated in place. Durations are
+    # stored as integer ticks (1/ticksPerMinute min) in uint16; the array is promoted
+    # to uint32 if the ticks may overflow, and falls back to float32 (minutes) if a
+    # time interval is not a multiple of the tick.
+    shape = (len(margins),) + tuple(reversed(refImage.GetSize()))
+    accumulator = {
+        'margins'        : list(margins),
+        'refImage'       : refImage,
+        'ticksPerMinute' : ticksPerMinute,
+        'maps'           : np.zeros(shape, dtype=np.uint16),
+        'buffer'         : np.zeros(shape[1:], dtype=np.uint16),
+        'maxTicks'       : [0] * len(margins),   # Upper bound of the ticks in each map
+    }
+    return accumulator
+
+
+def setAccumulatorType(accumulator, dtype):
+    if dtype == np.float32:
+        accumulator['maps'] = (accumulator['maps'] / accumulator['ticksPerMinute']).astype(np.float32)
+    else:
+        accumulator['maps'] = accumulator['maps'].astype(dtype)
+    accumulator['buffer'] = np.zeros(accumulator['buffer'].shape, dtype=dtype)
+
+
+def addToDurationAccumulator(accumulator, margin, label, dt):
+    # Add 'dt' (min) to the voxels in the label (equivalent to map = label * dt + map)
+    k = accumulator['margins'].index(margin)
+    labelArray = sitk.GetArrayViewFromImage(label)
+
+    if accumulator['maps'].dtype != np.float32:
+        ticks = dt * accumulator['ticksPerMinute']
+        if ticks < 0 or abs(ticks - round(ticks)) > 1e-6:
+            setAccumulatorType(accumulator, np.float32)
+        else:
+            ticks = int(round(ticks))
+            # The output of BinaryThreshold is 0 or 1.
+            labelMax = 1 if labelArray.dtype == np.uint8 else int(labelArray.max())
+            accumulator['maxTicks'][k] = accumulator['maxTicks'][k] + ticks * labelMax
+            if accumulator['maxTicks'][k] > np.iinfo(accumulator['maps'].dtype).max:
+                setAccumulatorType(accumulator, np.uint32)
+            dt = ticks
+
+    maps = accumulator['maps']
+    buffer = accumulator['buffer']
+    np.multiply(labelArray, maps.dtype.type(dt), out=buffer, casting='unsafe')
+    np.add(maps[k], buffer, out=maps[k])
+
+
+def getDurationMap(accumulator, margin):
+    # Return the duration map (min) for the margin as a float32 image.
+    k = accumulator['margins'].index(margin)
+    maps = accumulator['maps']
+    if maps.dtype == np.float32:
+        array = maps[k]
+    else:
+        array = (maps[k] / accumulator['ticksPerMinute']).astype(np.float32)
+    dmap = sitk.GetImageFromArray(array)
+    dmap.CopyInformation(accumulator['refImage'])
+    return dmap
+
+
+# Default formats of the resampled labels ('input') and the duration maps ('output').
+# See image_store.
+defaultFormats = {
+    'input'            : 'same',
+    'output'           : 'same',
+    'compressionLevel' : -1,
+}
+
+
+def getLabelPath(exam, record, formats):
+    # Path of the resampled ablation label of the series
+    return ims.getImagePath('PC%03d/NIFTY-Iceball-Resampled-label' % int(exam), 'REG-ICEBALL-%s' % record.labelFile,
+                            formats['input'], 'REG-ICEBALL')
+
+
+def getMapPath(exam, margin, formats):
+    # Path of the duration map for the margin
+    return ims.getImagePath('PC%03d/NIFTY-Map' % int(exam), 'DurationMap_%f.nii.gz' % margin,
+                            formats['output'], 'DurationMap')
+
+
+def getExamFiles(catalog, exam, margins, formats=defaultFormats):
+    # Return the lists of the input and output files of evaluateExam() for the exam.
+
+    inputs = ['PC%03d/NIFTY-Anatomy-label/%s' % (int(exam), ic.getPlanImages(catalog, exam)[1])]
+    for record in ic.getExamImages(catalog, exam):
+        inputs.append(getLabelPath(exam, record, formats))
+
+    outputs = []
+    for m in margins:
+        outputs.append(getMapPath(exam, m, formats))
+
+    return (ims.getFilePaths(inputs), ims.getFilePaths(outputs))
+
+
+def getExamSettings(catalog, exam, margins, minDurations, marginInMM, useROI, formats=defaultFormats, minDist=False):
+    # Settings that affect the outputs of evaluateExam() for the exam.
+    return {
+        'plan'         : ic.getPlanImages(catalog, exam),
+        'rows'         : [record.data for record in ic.getExamImages(catalog, exam)],
+        'margins'      : margins,
+        'marginInMM'   : marginInMM,
+        'useROI'       : useROI,
+        'minDurations' : minDurations,
+        'formats'      : formats,
+        'minDist'      : minDist,
+    }
+
+
+def evaluateExam(catalog, exam, param, margins, minDurations, marginInMM=False, useROI=False, ioDepth=2, formats=defaultFormats, minDist=False):
+    # Evaluate all series of the exam, and output the duration maps.
+    # The margins are in voxels unless marginInMM is True.
+    # If useROI is True, the distance maps are computed within the bounding box of each label.
+    # 'ioDepth' is the number of labels read ahead, and of duration maps written behind,
+    # on background threads (0 to read and write synchronously).
+    # 'formats' gives the formats of the resampled labels and the duration maps (see defaultFormats).
+    # If minDist is True, the minimum distances from the ablation label to the structures
+    # (ae.computeMinimumDistances()) are added to the printed lines.
+    # Returns the printed lines and the summary rows for the result csv file.
+
+    lines = []
+    summary = []
+
+    planAnatomLabelPath = 'PC%03d/NIFTY-Anatomy-label/%s' % (int(exam), ic.getPlanImages(catalog, exam)[1])
+    pp.setContext(exam=int(exam))
+    with pp.stage('readPlan'):
+        structureLabel = icache.readImage(planAnatomLabelPath, sitk.sitkUInt16)
+    
+    # Create maps
+    durationAccumulator = createDurationAccumulator(margins, structureLabel)
+        
+    # The labels of the next series are read while the current one is being evaluated.
+    def readLabel(record):
+        return ims.readImage(getLabelPath(exam, record, formats), sitk.sitkUInt16)
+
+    records = [record for fz in ic.getCycles(catalog, exam) for record in ic.getCycleImages(catalog, exam, fz)]
+
+    for (record, ablationLabelFuture) in bio.prefetch(records, readLabel, ioDepth):
+        fz = record.cycle
+        time = float(record.time)
+        ser = record.series
+        freg = record.freg    # 0: No registration; 1: Registration w/o mask; 2: Registration w/ mask; 3: registration w/mask w/offset
+        ablationLabelFile = record.labelFile
+        dt = record.dt
+        
+        if freg == 3:
+            param['initialOffset'] = record.offset if record.offset else [0.0, 0.0, 0.0]
+        
+        if ic.getPlanImages(catalog, exam):
+            pp.setContext(exam=int(exam), cycle=int(fz), series=int(ser))
+            with pp.stage('read'):
+                ablationLabel = ablationLabelFuture.result()
+
+            # All margins are computed from a single distance map.
+            with pp.stage('sweepMargins'):
+                marginLabels = ae.sweepMargins(ablationLabel, margins, useImageSpacing=marginInMM, useROI=useROI)
+
+            for m in margins:
+                label = marginLabels[m]
+
+                # Update map
+                with pp.stage('accumulate', margin=m):
+                    addToDurationAccumulator(durationAccumulator, m, label, dt)
+
+                with pp.stage('evaluate', margin=m):
+                    results = ae.evaluateAblation(structureLabel, label, dict(param, minDistEngine='boundary'), fMinDist=minDist)
+            
+                line = ('%d,%d,%d,%d,%f, %f,%f,%f, %f, %f,%f,%f' %
+                       (int(exam),
+                        int(fz),
+                        int(time),
+                        int(ser),
+                        m,
+                        results['Structure.TG'],
+                        results['Structure.EUS'],
+                        results['Structure.NVB'],
+                        results['AblationVolume'],
+                        results['Involved.TG'],
+                        results['Involved.EUS'],
+                        results['Involved.NVB']))
+                if minDist:
+                    line = line + ', %f,%f,%f' % tuple(results.get('MinDist.'+name, float('nan')) for name in ['TG', 'EUS', 'NVB'])
+                print (line)
+                lines.append(line)
+                
+    
+    # Output duration map
+    mapDir = 'PC%03d/NIFTY-Map' % (int(exam))
+    if not os.path.exists(mapDir):
+        os.mkdir(mapDir)
+    ims.removeContainer(getMapPath(exam, margins[0], formats))
+
+    # The maps are written while the next ones are being summarized.
+    pp.setContext(exam=int(exam))
+    durationSummary = {}
+    writer = bio.createWriter(ioDepth)
+    try:
+        for m in margins:
+            durationMap = getDurationMap(durationAccumulator, m)
+            durationMapPath = getMapPath(exam, m, formats)
+            with pp.stage('write', margin=m):
+                bio.writeImage(writer, durationMap, durationMapPath, formats['compressionLevel'])
+            with pp.stage('summarize', margin=m):
+                durationSummary[m] = summarizeDurationMap(durationMap, structureLabel, minDurations)
+        bio.flushWriter(writer)
+    finally:
+        bio.closeWriter(writer)
+
+    # Compute summary
+    for m in margins:
+        for (d, results) in zip(minDurations, durationSummary[m]):
+            row = [str(int(exam)),
+                   str(int(fz)),
+                   str(int(time)),
+                   str(int(ser)),
+                   str(m),
+                   str(d),
+                   str(results['AblationVolume']),
+                   str(results['Involved.TG']),
+                   str(results['Involved.EUS']),
+                   str(results['Involved.NVB'])]
+            summary.append(row)
+
+    return (lines, summary)
+
 
 def main(argv):
 
@@ -44,6 +328,26 @@ def main(argv):
                             help='A JSON file that lists planning and intraprocedural images.')
         parser.add_argument('output', metavar='RESULT_CSV', type=str, nargs=1,
                             help='A csv file to store the results')
+        parser.add_argument('--manifest', dest='manifest', default='',
+                            help='Build manifest file. Exams whose inputs and settings have not changed since the last run are skipped. (default: None)')
+        parser.add_argument('--margin-mm', dest='marginInMM', action='store_true',
+                            help='Specify the margins in mm instead of voxels.')
+        parser.add_argument('--roi', dest='useROI', action='store_true',
+                            help='Compute the distance maps only within the bounding box of each label.')
+        parser.add_argument('--io-depth', dest='ioDepth', type=int, default=2,
+                            help='Number of labels read ahead, and of duration maps written behind, on background threads. 0 to read and write synchronously. (default: 2)')
+        parser.add_argument('--input-format', dest='inputFormat', choices=ims.outputFormats, default='same',
+                            help='Format of the resampled labels, as given to run_registration.py --output-format. (default: same)')
+        parser.add_argument('--output-format', dest='outputFormat', choices=ims.outputFormats, default='same',
+                            help='Format of the duration maps: nii.gz (same), nii, nrrd, mha, or one container file per exam (container). (default: same)')
+        parser.add_argument('--compression-level', dest='compressionLevel', type=int, default=-1,
+                            help='Compress the nrrd, mha or container duration maps at COMPRESSION_LEVEL (1-9). (default: no compression)')
+        parser.add_argument('--image-cache', dest='imageCache', default='',
+                            help='Read the anatomy labels from the cache created by image_cache.py, if up to date. (default: None)')
+        parser.add_argument('--min-dist', dest='minDist', action='store_true',
+                            help='Add the minimum distances from the ablation label to the structures (MinDist.TG, MinDist.EUS, MinDist.NVB; in voxels, negative inside) to the printed lines. They are computed from the boundary voxels (see ablation_evaluation.computeMinimumDistances()) and may differ from those of the distance map by a fraction of a voxel.')
+        parser.add_argument('--profile', dest='profile', default='',
+                            help='Record the time and peak memory of each stage as JSON lines in PROFILE (\'-\' for stderr). (default: None)')
         #parser.add_argument('-b', dest='bSplineOrder', default='3',
         #                    help='B-Spline order (default: 3)')
         #parser.add_argument('-s', dest='shrinkFactor', default='4',
@@ -60,12 +364,7 @@ def main(argv):
     imageListFilePath = args.list[0]
     resultFilePath = args.output[0]
     
-    imageList = None
-    with open(imageListFilePath, "r") as read_file:
-        imageList = json.load(read_file)
-
-    planImageDict = imageList['PLAN_IMAGES']
-    intraImageList = imageList['INTRA_IMAGES']
+    catalog = ic.loadCatalog(imageListFilePath)
 
     param = {
         'margin'      : 0.0,
@@ -80,140 +379,55 @@ def main(argv):
     csvWriter.writerow(resHeader)
         
 
-    # Calculate timestep
-    intraImageMeta = []
-    for line in intraImageList:
-        intraImageMeta.append(line[0:4])
-    intraImageMeta = np.array(intraImageMeta)
-    intraImageMeta = np.concatenate((intraImageMeta, np.zeros((np.shape(intraImageMeta)[0],1))),axis=1)
-
-    for exam in np.unique(intraImageMeta[:,0]):
-        examMeta = intraImageMeta[intraImageMeta[:,0]==exam]
-        for fz in np.unique(examMeta[:,1]):
-            fzMeta = examMeta[examMeta[:,1]==fz]
-            tShift = np.roll(fzMeta[:,2],1)
-            tShift[0] = 0
-            dt = fzMeta[:,2]-tShift
-            #dt = dt.reshape([len(dt),1])
-            intraImageMeta[(intraImageMeta[:,0]==exam) & (intraImageMeta[:,1]==fz),4] = dt
-        
-    print ('Case,Cycle,Time,Ser,Margin,V_TG,V_EUS,V_NVB,V_ablation,V_INV_TG,V_INV_EUS,V_INV_NVB')
-
-    intraImageList2 = []
-    for line in intraImageList:
-        if len(line) < 8:
-            line = line + [0.0, 0.0, 0.0]
-        else:
-            line = line[0:7] + line[7]
-        intraImageList2.append(line)
-    intraImageListNP = np.array(intraImageList2)
+    header = 'Case,Cycle,Time,Ser,Margin,V_TG,V_EUS,V_NVB,V_ablation,V_INV_TG,V_INV_EUS,V_INV_NVB'
+    if args.minDist:
+        header = header + ',MIN_DIST_TG,MIN_DIST_EUS,MIN_DIST_NVB'
+    print (header)
 
     margins = [0.0, -1.0, -2.0, -3.0, -4.0, -5.0]
+    minDurations = [0.001, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11.0, 12.0, 13.0, 14.0, 15.0]
 
-    for exam in np.unique(intraImageMeta[:,0]):
-        examMeta = intraImageMeta[intraImageMeta[:,0]==exam]
-        
-        if not str(int(exam)) in planImageDict:
-            continue
-        
-        planAnatomLabelPath = 'PC%03d/NIFTY-Anatomy-label/%s' % (int(exam), planImageDict[str(int(exam))][1])
-        structureLabel = sitk.ReadImage(planAnatomLabelPath, sitk.sitkUInt16)
-        
-        refSize = structureLabel.GetSize()
-        refOrigin = structureLabel.GetOrigin()
-        refSpacing = structureLabel.GetSpacing()
-        refDirection = structureLabel.GetDirection()
+    if args.profile != '':
+        pp.enable(args.profile)
+    if args.imageCache != '':
+        icache.setCacheDir(args.imageCache)
 
-        durationMap = {}
-
-        # Create maps
-        for m in margins:
-        
-            dmap = sitk.Image(refSize, sitk.sitkFloat32)
-            dmap.SetOrigin(refOrigin)
-            dmap.SetSpacing(refSpacing)
-            dmap.SetDirection(refDirection)
+    formats = {
+        'input'            : args.inputFormat,
+        'output'           : args.outputFormat,
+        'compressionLevel' : args.compressionLevel,
+    }
 
-            durationMap[m] = dmap
+    manifestPath = args.manifest if args.manifest != '' else None
+    manifest = pm.loadManifest(manifestPath)
 
-            
-        for fz in np.unique(examMeta[:,1]):
-            fzMeta = examMeta[examMeta[:,1]==fz]
-             
-            for ser in fzMeta[:,3]:
-                imageData = intraImageListNP[(intraImageListNP[:,0]==str(int(exam)))&(intraImageListNP[:,1]==str(int(fz)))&(intraImageListNP[:,3]==str(int(ser)))][0]
-                time = float(imageData[2])
-                #exam =     str(imageData[0])
-                #fz   =     imageData[1]
-                #time =     imageData[2]
-                #ser  =     imageData[3]
-                freg =     int(imageData[4])    # 0: No registration; 1: Registration w/o mask; 2: Registration w/ mask; 3: registration w/mask w/offset
-                ablationLabelFile = imageData[6]
-                
-                dt = intraImageMeta[(intraImageMeta[:,0]==exam) & (intraImageMeta[:,1]==fz) & (intraImageMeta[:,3]==ser),4]
-                
-                if freg == 3:
-                    param['initialOffset'] = [float(imageData[7]), float(imageData[8]), float(imageData[9])]
-                
-                if str(int(exam)) in planImageDict.keys():
-                    ablationLabelPath = 'PC%03d/NIFTY-Iceball-Resampled-label/REG-ICEBALL-%s' % (int(exam), ablationLabelFile)
-                      
-                    ablationLabel = sitk.ReadImage(ablationLabelPath, sitk.sitkUInt16)
-
-                    for m in margins:
-                        label = None
-                        if m == 0.0:
-                            label = ablationLabel
-                        else:
-                            label = erodeDilateLabelByDistance(ablationLabel, m)
-
-                        # Update map
-                        durationMap[m] = sitk.Cast(label, sitk.sitkFloat32)*dt + durationMap[m]
-
-                        results = ae.evaluateAblation(structureLabel, label, param, fMinDist=False)
-                    
-                        print ('%d,%d,%d,%d,%f, %f,%f,%f, %f, %f,%f,%f' %
-                               (int(exam),
-                                int(fz),
-                                int(time),
-                                int(ser),
-                                m,
-                                results['Structure.TG'],
-                                results['Structure.EUS'],
-                                results['Structure.NVB'],
-                                results['AblationVolume'],
-                                results['Involved.TG'],
-                                results['Involved.EUS'],
-                                results['Involved.NVB']))
-                        
+    for exam in sorted(ic.getExams(catalog)):
         
-        # Output duration map
-        mapDir = 'PC%03d/NIFTY-Map' % (int(exam))
-        if not os.path.exists(mapDir):
-            os.mkdir(mapDir)
+        if not ic.getPlanImages(catalog, exam):
+            continue
 
-        for m in margins:
-            durationMapPath = '%s/DurationMap_%f.nii.gz' % (mapDir, m)
-            sitk.WriteImage(durationMap[m], durationMapPath)
+        (inputs, outputs) = getExamFiles(catalog, exam, margins, formats)
+        settings = getExamSettings(catalog, exam, margins, minDurations, args.marginInMM, args.useROI, formats, args.minDist)
+
+        # Skip the exam if it is up to date in the manifest
+        entry = None
+        if manifestPath:
+            entry = pm.getEntry(manifest, 'evaluation', int(exam), inputs, settings)
+        if entry:
+            for line in entry['rows']['lines']:
+                print (line)
+            for row in entry['rows']['summary']:
+                csvWriter.writerow(row)
+            continue
 
-        # Compute summary
-        minDurations = [0.001, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11.0, 12.0, 13.0, 14.0, 15.0]
+        (lines, summary) = evaluateExam(catalog, exam, param, margins, minDurations, args.marginInMM, args.useROI, args.ioDepth, formats, args.minDist)
+        for row in summary:
+            csvWriter.writerow(row)
+        resultFile.flush()
 
-        for m in margins:
-            for d in minDurations:
-                label = thresholdDurationMap(durationMap[m], d)
-                results = ae.evaluateAblation(structureLabel, label, param, fMinDist=False)
-                row = [str(int(exam)),
-                       str(int(fz)),
-                       str(int(time)),
-                       str(int(ser)),
-                       str(m),
-                       str(d),
-                       str(results['AblationVolume']),
-                       str(results['Involved.TG']),
-                       str(results['Involved.EUS']),
-                       str(results['Involved.NVB'])]
-                csvWriter.writerow(row)
+        if manifestPath:
+            pm.recordEntry(manifestPath, 'evaluation', int(exam), inputs, settings, outputs,
+                           { 'lines' : lines, 'summary' : summary })
 
     resultFile.close()
             
@@ -3,8 +3,19 @@
 import argparse, sys, shutil, os, logging
 import SimpleITK as sitk
 import json
+import itertools
+import multiprocessing
 import ablation_evaluation as ae
 import ablation_registration as ar
+import plan_cache as pc
+import transform_cache as tc
+import pipeline_manifest as pm
+import ablation_roi as roi
+import image_catalog as ic
+import pipeline_profile as pp
+import background_io as bio
+import image_store as ims
+import image_cache as icache
 
 
 anatomDict = {
@@ -14,62 +25,94 @@ anatomDict = {
 }
 
 
-def main(argv):
+def registerExam(exam, rows, planImageDict, options):
+    # Register and resample all intraop series of one exam.
+    # 'rows' is a list of (index, imageData) pairs taken from INTRA_IMAGES.
+    # 'options' is a dictionary with the following keys:
+    #   'warmStart'      : If True, each registration is seeded with the transform of
+    #                      the previous series in the same freeze cycle.
+    #   'transformCache' : Directory to store/reuse the transforms (None to disable).
+    #   'maskDilation'   : Dilation of the anatomy label for the registration mask.
+    #   'param'          : Registration parameters passed to ar.registerImages().
+    #   'roiPadding'     : If not None, the plan image and the mask are cropped to the bounding
+    #                      box of the mask (or the anatomy label) padded by 'roiPadding' mm.
+    #   'ioDepth'        : Number of series read ahead, and of output images written behind,
+    #                      on background threads (0 to read and write synchronously).
+    #   'outputFormat'   : Format of the resampled images (see image_store).
+    #   'compressionLevel' : Compression level of the resampled images (see image_store).
+    #   'seriesThreads'  : If > 1, the series are registered in this number of parallel threads
+    #                      with ar.registerSeries() before they are resampled (ignored with
+    #                      'warmStart', where each registration depends on the previous one).
+    # Returns a list of (index, line) pairs, where 'line' is the offset table
+    # row for the series, or None if the exam has no plan images.
 
-    args = []
-    try:
-        parser = argparse.ArgumentParser(description="Process images listed in the image list file. ")
-        parser.add_argument('list', metavar='IMAGE_LIST', type=str, nargs=1,
-                            help='A JSON file that lists planning and intraprocedural images.')
-        args = parser.parse_args(argv)
-        
-    except Exception as e:
-        print(e)
-        sys.exit()
+    lines = []
 
-    imageListFile = args.list[0]
-    
-    imageList = None
-    with open(imageListFile, "r") as read_file:
-        imageList = json.load(read_file)
+    if not exam in planImageDict.keys():
+        for (index, imageData) in rows:
+            lines.append((index, None))
+        return lines
 
-    planImageDict = imageList['PLAN_IMAGES']
-    intraImageList = imageList['INTRA_IMAGES']
+    planImagePath = 'PC%03d/NRRD/%s' % (int(exam), planImageDict[exam][0])
+    planStructureLabelPath = 'PC%03d/NIFTY-Anatomy-label/%s' % (int(exam), planImageDict[exam][1])
 
-    param = {
-    }
+    pp.setContext(exam=int(exam))
 
-    print ('Case,Cycle,Time,Ser,OFF_X,OFF_Y,OFF_Z')
+    # The plan image is shared by all series in the exam.
+    with pp.stage('readPlan'):
+        planImage = pc.readImage(exam, planImagePath, sitk.sitkFloat32)
 
-    for imageData in intraImageList:
-        exam =     str(imageData[0])
-        fz   =     imageData[1]
-        time =     imageData[2]
-        ser  =     imageData[3]
-        freg =     imageData[4]    # 0: No registration; 1: Registration w/o mask; 2: Registration w/ mask; 3: registration w/mask w/offset
-        ablationImageFile = imageData[5]
-        ablationLabelFile = imageData[6]
-        if freg == 3:
-            param['initialOffset'] = imageData[7]
+    param = dict(options['param'])
+    maskDilation = options['maskDilation']
 
-        offsetDict = {}
-        
-        if freg == 3:
-            param['initialOffset'] = [-imageData[7][0], -imageData[7][1], -imageData[7][2]]
+    # Last converged transform for each freeze cycle
+    cycleTransforms = {}
+
+    # Transforms registered in parallel for the series, and the images read for them (by index)
+    batchTransforms = {}
+    batchImages = {}
+    if options['seriesThreads'] > 1 and not options['warmStart']:
+        (batchTransforms, batchImages) = registerExamSeries(exam, rows, planImage, planImagePath, planStructureLabelPath, options)
+
+    # The next series are read while the current one is being registered, and the
+    # resampled images are written while the next one is being registered.
+    def readSeries(row):
+        (index, imageData) = row
+        # An image already read by registerExamSeries() is released once it is resampled.
+        if index in batchImages:
+            ablationImage = batchImages.pop(index)
         else:
-            param['initialOffset'] = [0.0, 0.0, 0.0]
+            ablationImage = icache.readImage('PC%03d/NIFTY-Iceball-AXTSE/%s' % (int(exam), imageData[5]), sitk.sitkFloat32)
+        ablationLabel = icache.readImage('PC%03d/NIFTY-Iceball-AXTSE-label/%s' % (int(exam), imageData[6]), sitk.sitkFloat32)
+        return (ablationImage, ablationLabel)
+
+    # Images in a container are written to a new one for each run.
+    if len(rows) > 0:
+        for path in getOutputPaths(exam, rows[0][1], options):
+            ims.removeContainer(path)
+
+    writer = bio.createWriter(options['ioDepth'])
+    try:
+        for ((index, imageData), series) in bio.prefetch(rows, readSeries, options['ioDepth']):
+            fz   =     imageData[1]
+            time =     imageData[2]
+            ser  =     imageData[3]
+            freg =     imageData[4]    # 0: No registration; 1: Registration w/o mask; 2: Registration w/ mask; 3: registration w/mask w/offset
+            ablationImageFile = imageData[5]
+            ablationLabelFile = imageData[6]
+
+            if freg == 3:
+                param['initialOffset'] = [-imageData[7][0], -imageData[7][1], -imageData[7][2]]
+            else:
+                param['initialOffset'] = [0.0, 0.0, 0.0]
 
-        if exam in planImageDict.keys():
             ablationImagePath = 'PC%03d/NIFTY-Iceball-AXTSE/%s' % (int(exam), ablationImageFile)
             ablationLabelPath = 'PC%03d/NIFTY-Iceball-AXTSE-label/%s' % (int(exam), ablationLabelFile)
-            
-            planImagePath = 'PC%03d/NRRD/%s' % (int(exam), planImageDict[exam][0])
-            planStructureLabelPath = 'PC%03d/NIFTY-Anatomy-label/%s' % (int(exam), planImageDict[exam][1])
-            
-            ablationImage = sitk.ReadImage(ablationImagePath, sitk.sitkFloat32)
-            ablationLabel = sitk.ReadImage(ablationLabelPath, sitk.sitkFloat32)              
-            planImage = sitk.ReadImage(planImagePath, sitk.sitkFloat32)
-            structureLabel = sitk.ReadImage(planStructureLabelPath, sitk.sitkUInt16)
+
+            pp.setContext(exam=int(exam), cycle=fz, series=ser)
+
+            with pp.stage('read'):
+                (ablationImage, ablationLabel) = series.result()
 
             # Registration
             offset = [0.0, 0.0, 0.0]
@@ -77,37 +120,386 @@ def main(argv):
             if freg > 0:
                 movingImage = ablationImage
                 fixedImage = planImage
-                mask = None
-                if freg == 2:
-                    #movingImage = ar.mask(movingImage, structureLabel, dilation=10)
-                    mask = ar.createMaskFromAnatomLabel(structureLabel, fixedImage, dilation=30)
-                transform = ar.registerImages(fixedImage, movingImage, param, mask=mask, maskType='fixed')
+                param['initialTransform'] = None
+                if options['warmStart'] and fz in cycleTransforms:
+                    param['initialTransform'] = cycleTransforms[fz]
+
+                cacheKey = None
+                if options['transformCache']:
+                    cacheKey = getTransformKey(planImagePath, ablationImagePath, planStructureLabelPath, freg, maskDilation, options['roiPadding'], param)
+                    transform = tc.loadTransform(options['transformCache'], cacheKey)
+
+                if transform is None and index in batchTransforms:
+                    transform = batchTransforms[index]
+                elif transform is None:
+                    mask = None
+                    if freg == 2:
+                        #movingImage = ar.mask(movingImage, structureLabel, dilation=10)
+                        with pp.stage('mask'):
+                            mask = pc.getMaskFromAnatomLabel(exam, planStructureLabelPath, planImagePath, dilation=maskDilation)
+                    if options['roiPadding'] is not None:
+                        with pp.stage('roi'):
+                            (fixedImage, mask) = cropToROI(exam, planImage, mask, planStructureLabelPath, options['roiPadding'])
+                    with pp.stage('register'):
+                        transform = ar.registerImages(fixedImage, movingImage, param, mask=mask, maskType='fixed')
+                    if cacheKey:
+                        tc.saveTransform(options['transformCache'], cacheKey, transform)
                 offset = transform.GetParameters()
+                cycleTransforms[fz] = transform
             else:
                 transform = sitk.Transform()
 
-            outputImageDir = 'PC%03d/NIFTY-Iceball-Resampled' % int(exam)
-            outputLabelDir = 'PC%03d/NIFTY-Iceball-Resampled-label' % int(exam)
-            registeredImagePath = '%s/REG-ICEBALL-%s' % (outputImageDir, ablationImageFile)
-            registeredLabelPath = '%s/REG-ICEBALL-%s' % (outputLabelDir, ablationLabelFile)
-            ablationImageResampled = ar.resampleImage(ablationImage, planImage, transform, interp='linear')
-            ablationLabelResampled = ar.resampleImage(ablationLabel, planImage, transform, interp='nearest')
-
-            if not os.path.exists(outputImageDir):
-                os.mkdir(outputImageDir)
-              
-            if not os.path.exists(outputLabelDir):
-                os.mkdir(outputLabelDir)
-              
-            sitk.WriteImage(ablationImageResampled, registeredImagePath)
-            sitk.WriteImage(ablationLabelResampled, registeredLabelPath)
-            
-            print ('%d,%d,%d,%d,%f,%f,%f' % (int(exam),
+            (registeredImagePath, registeredLabelPath) = getOutputPaths(exam, imageData, options)
+            with pp.stage('resample'):
+                ablationImageResampled = ar.resampleImage(ablationImage, planImage, transform, interp='linear')
+                ablationLabelResampled = ar.resampleImage(ablationLabel, planImage, transform, interp='nearest')
+
+            os.makedirs(os.path.dirname(registeredImagePath), exist_ok=True)
+            os.makedirs(os.path.dirname(registeredLabelPath), exist_ok=True)
+
+            with pp.stage('write'):
+                bio.writeImage(writer, ablationImageResampled, registeredImagePath, options['compressionLevel'])
+                bio.writeImage(writer, ablationLabelResampled, registeredLabelPath, options['compressionLevel'])
+
+            line = '%d,%d,%d,%d,%f,%f,%f' % (int(exam),
                                              fz,
                                              time,
                                              ser,
                                              offset[0],offset[1],offset[2])
-                   )
+            lines.append((index, line))
+
+        # All outputs of the exam are written before it is recorded in the manifest.
+        bio.flushWriter(writer)
+    finally:
+        bio.closeWriter(writer)
+
+    return lines
+
+
+def registerExamSeries(exam, rows, planImage, planImagePath, planStructureLabelPath, options):
+    # Register the series of the exam that are not in the transform cache with
+    # ar.registerSeries(), in options['seriesThreads'] threads. The series registered with
+    # and without the mask are registered in separate batches, against the same fixed image.
+    # Returns dictionaries of the transforms and of the moving images read for them, by
+    # row index, so that the images are not read again for the resampling.
+
+    param = dict(options['param'])
+    maskDilation = options['maskDilation']
+
+    batches = {}
+    for (index, imageData) in rows:
+        freg = imageData[4]
+        if freg == 0:
+            continue
+        seriesParam = {'initialTransform' : None}
+        if freg == 3:
+            seriesParam['initialOffset'] = [-imageData[7][0], -imageData[7][1], -imageData[7][2]]
+        else:
+            seriesParam['initialOffset'] = [0.0, 0.0, 0.0]
+
+        ablationImagePath = 'PC%03d/NIFTY-Iceball-AXTSE/%s' % (int(exam), imageData[5])
+        cacheKey = None
+        if options['transformCache']:
+            cacheKey = getTransformKey(planImagePath, ablationImagePath, planStructureLabelPath, freg, maskDilation,
+                                       options['roiPadding'], dict(param, **seriesParam))
+            if tc.loadTransform(options['transformCache'], cacheKey) is not None:
+                continue
+        batches.setdefault(freg == 2, []).append((index, ablationImagePath, seriesParam, cacheKey))
+
+    transforms = {}
+    images = {}
+    for useMask in sorted(batches.keys()):
+        batch = batches[useMask]
+        pp.setContext(exam=int(exam))
+        mask = None
+        if useMask:
+            with pp.stage('mask'):
+                mask = pc.getMaskFromAnatomLabel(exam, planStructureLabelPath, planImagePath, dilation=maskDilation)
+        fixedImage = planImage
+        if options['roiPadding'] is not None:
+            with pp.stage('roi'):
+                (fixedImage, mask) = cropToROI(exam, planImage, mask, planStructureLabelPath, options['roiPadding'])
+        with pp.stage('read', series=len(batch)):
+            movingImages = [icache.readImage(path, sitk.sitkFloat32) for (index, path, seriesParam, cacheKey) in batch]
+        with pp.stage('registerSeries', series=len(batch)):
+            batchTransforms = ar.registerSeries(fixedImage, movingImages, dict(param), mask, 'fixed',
+                                                [seriesParam for (index, path, seriesParam, cacheKey) in batch],
+                                                options['seriesThreads'])
+        for ((index, path, seriesParam, cacheKey), transform) in zip(batch, batchTransforms):
+            if cacheKey:
+                tc.saveTransform(options['transformCache'], cacheKey, transform)
+            transforms[index] = transform
+        for ((index, path, seriesParam, cacheKey), movingImage) in zip(batch, movingImages):
+            images[index] = movingImage
+
+    return (transforms, images)
+
+
+def cropToROI(exam, planImage, mask, planStructureLabelPath, padding):
+    # Crop the plan image and the mask to the bounding box of the mask, or of the
+    # anatomy label if no mask is used, padded by 'padding' mm. The transform estimated
+    # from the cropped images is valid for the full plan image grid.
+    if mask:
+        bbox = roi.getBoundingBoxInImage(mask, planImage, padding)
+    else:
+        structureLabel = pc.readImage(exam, planStructureLabelPath, sitk.sitkUInt16)
+        bbox = roi.getBoundingBoxInImage(structureLabel, planImage, padding)
+    if bbox is None:
+        return (planImage, mask)
+
+    fixedImage = roi.cropImage(planImage, bbox)
+    if mask:
+        mask = roi.cropImage(mask, bbox)
+    return (fixedImage, mask)
+
+
+def getOutputPaths(exam, imageData, options):
+    # Paths of the resampled image and label of the series (see image_store.getImagePath()).
+    imagePath = ims.getImagePath('PC%03d/NIFTY-Iceball-Resampled' % int(exam), 'REG-ICEBALL-%s' % imageData[5],
+                                 options['outputFormat'], 'REG-ICEBALL')
+    labelPath = ims.getImagePath('PC%03d/NIFTY-Iceball-Resampled-label' % int(exam), 'REG-ICEBALL-%s' % imageData[6],
+                                 options['outputFormat'], 'REG-ICEBALL')
+    return (imagePath, labelPath)
+
+
+def getExamFiles(exam, rows, planImageDict, options):
+    # Return the lists of the input and output files of registerExam() for the exam.
+
+    inputs = [
+        'PC%03d/NRRD/%s' % (int(exam), planImageDict[exam][0]),
+        'PC%03d/NIFTY-Anatomy-label/%s' % (int(exam), planImageDict[exam][1]),
+    ]
+    outputs = []
+    for (index, imageData) in rows:
+        inputs.append('PC%03d/NIFTY-Iceball-AXTSE/%s' % (int(exam), imageData[5]))
+        inputs.append('PC%03d/NIFTY-Iceball-AXTSE-label/%s' % (int(exam), imageData[6]))
+        outputs.extend(getOutputPaths(exam, imageData, options))
+
+    return (inputs, ims.getFilePaths(outputs))
+
+
+def getExamSettings(exam, rows, planImageDict, options):
+    # Settings that affect the outputs of registerExam() for the exam.
+    return {
+        'plan'         : planImageDict[exam],
+        'rows'         : [imageData for (index, imageData) in rows],
+        'warmStart'    : options['warmStart'],
+        'maskDilation' : options['maskDilation'],
+        'roiPadding'   : options['roiPadding'],
+        'param'        : ar.setDefaultParameters(dict(options['param'])),
+        'outputFormat' : options['outputFormat'],
+        'compressionLevel' : options['compressionLevel'],
+    }
+
+
+def getTransformKey(planImagePath, ablationImagePath, planStructureLabelPath, freg, maskDilation, roiPadding, param):
+    # Cache key for the transform. It depends on the contents of the input images and
+    # all the parameters that affect the registration.
+    ar.setDefaultParameters(param)
+
+    inputFiles = [planImagePath, ablationImagePath]
+    if freg == 2 or roiPadding is not None:
+        inputFiles.append(planStructureLabelPath)
+    else:
+        maskDilation = 0
+
+    settings = {
+        'freg'         : freg,
+        'maskDilation' : maskDilation,
+        'maskType'     : 'fixed',
+        'roiPadding'   : roiPadding,
+    }
+    for key in ar.registrationParameterKeys:
+        if key in param:
+            settings[key] = param[key]
+    if param['initialTransform']:
+        settings['initialTransform'] = [list(param['initialTransform'].GetParameters()),
+                                        list(param['initialTransform'].GetFixedParameters())]
+
+    return tc.transformKey(inputFiles, settings)
+
+
+def getSamplingParameters(args):
+    # Registration parameters for the metric sampling options (see ar.setMetricSampling()).
+    param = {}
+    if args.samplingSeed is not None:
+        param['samplingSeed'] = args.samplingSeed
+    if args.numberOfSamples > 0:
+        param['numberOfSamples'] = args.numberOfSamples
+    if args.refinementSamples > 0:
+        param['refinementSamples'] = args.refinementSamples
+    return param
+
+
+def initWorker(numberOfThreads, cacheSize, profilePath, imageCacheDir):
+    # Limit the number of threads used by each SimpleITK filter in the worker process,
+    # so that the workers together do not oversubscribe the cores.
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(numberOfThreads)
+    pc.setCacheSize(cacheSize)
+    if profilePath:
+        pp.enable(profilePath)
+    icache.setCacheDir(imageCacheDir)
+
+
+def registerExamTask(task):
+    (exam, rows, planImageDict, options) = task
+    return registerExam(exam, rows, planImageDict, options)
+
+
+def groupByExam(catalog):
+    # Group the rows of INTRA_IMAGES by exam, keeping the original row index.
+    examRows = {}
+    for exam in ic.getExams(catalog):
+        examRows[str(exam)] = [(record.index, record.data) for record in ic.getExamImages(catalog, exam)]
+    return examRows
+
+
+def printLines(results):
+    # Print the offset table in the order of INTRA_IMAGES. 'results' yields the lists
+    # returned by registerExam() in any order; lines are buffered until all the
+    # preceding rows have been printed.
+    pending = {}
+    nextIndex = 0
+    for lines in results:
+        for (index, line) in lines:
+            pending[index] = line
+        while nextIndex in pending:
+            line = pending.pop(nextIndex)
+            if line:
+                print (line, flush=True)
+            nextIndex = nextIndex + 1
+
+
+def recordResults(results, examRows, planImageDict, options, manifestPath):
+    # Record the exams in the manifest as their results arrive, and pass the
+    # results on to printLines().
+    examOfIndex = {}
+    for exam in examRows:
+        for (index, imageData) in examRows[exam]:
+            examOfIndex[index] = exam
+
+    for lines in results:
+        if manifestPath and len(lines) > 0:
+            exam = examOfIndex[lines[0][0]]
+            if exam in planImageDict:
+                (inputs, outputs) = getExamFiles(exam, examRows[exam], planImageDict, options)
+                settings = getExamSettings(exam, examRows[exam], planImageDict, options)
+                rows = [line for (index, line) in lines]
+                pm.recordEntry(manifestPath, 'registration', exam, inputs, settings, outputs, rows)
+        yield lines
+
+
+def main(argv):
+
+    args = []
+    try:
+        parser = argparse.ArgumentParser(description="Process images listed in the image list file. ")
+        parser.add_argument('list', metavar='IMAGE_LIST', type=str, nargs=1,
+                            help='A JSON file that lists planning and intraprocedural images.')
+        parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                            help='Number of worker processes. Exams are distributed over the workers. (default: 1)')
+        parser.add_argument('--threads', dest='threads', type=int, default=0,
+                            help='Number of SimpleITK threads per worker (default: number of cores / number of workers)')
+        parser.add_argument('--cache-size', dest='cacheSize', type=int, default=8,
+                            help='Maximum number of plan images, labels and masks kept in memory (default: 8)')
+        parser.add_argument('--warm-start', dest='warmStart', action='store_true',
+                            help='Start each registration from the transform of the previous series in the same freeze cycle.')
+        parser.add_argument('--transform-cache', dest='transformCache', default='',
+                            help='Directory to cache the transforms. Registrations with unchanged inputs and parameters are skipped. (default: None)')
+        parser.add_argument('--mask-dilation', dest='maskDilation', type=int, default=30,
+                            help='Dilation of the anatomy label for the registration mask (default: 30)')
+        parser.add_argument('--roi', dest='roiPadding', type=float, nargs='?', const=20.0, default=None,
+                            help='Crop the plan image to the bounding box of the registration mask (or the anatomy label) padded by ROI_PADDING mm. (default padding: 20 mm)')
+        parser.add_argument('--manifest', dest='manifest', default='',
+                            help='Build manifest file. Exams whose inputs and settings have not changed since the last run are skipped. (default: None)')
+        parser.add_argument('--io-depth', dest='ioDepth', type=int, default=2,
+                            help='Number of series read ahead, and of output images written behind, on background threads. 0 to read and write synchronously. (default: 2)')
+        parser.add_argument('--series-threads', dest='seriesThreads', type=int, default=1,
+                            help='Register the series of each exam in SERIES_THREADS parallel threads against the same plan image. The speedup comes only from the threads: ITK sets up the metric of each registration again. Not used with --warm-start. (default: 1)')
+        parser.add_argument('--sampling-seed', dest='samplingSeed', type=int, default=None,
+                            help='Seed for the metric sampling, for reproducible registrations. (default: wall clock)')
+        parser.add_argument('--samples', dest='numberOfSamples', type=int, default=0,
+                            help='Number of metric samples that remain in the mask (more are drawn over the mask bounding box, and those outside are discarded), instead of a percentage of the plan image. (default: 0 (2%% of the plan image))')
+        parser.add_argument('--refinement-samples', dest='refinementSamples', type=int, default=0,
+                            help='Refine each transform with this number of samples after the optimizer has converged. (default: 0 (no refinement))')
+        parser.add_argument('--output-format', dest='outputFormat', choices=ims.outputFormats, default='same',
+                            help='Format of the resampled images: the format of the input image (same), nii.gz, nii, nrrd, mha, or one container file per exam (container). (default: same)')
+        parser.add_argument('--compression-level', dest='compressionLevel', type=int, default=-1,
+                            help='Compress the nrrd, mha or container outputs at COMPRESSION_LEVEL (1-9). (default: no compression)')
+        parser.add_argument('--image-cache', dest='imageCache', default='',
+                            help='Read the input images from the cache created by image_cache.py, if up to date. (default: None)')
+        parser.add_argument('--profile', dest='profile', default='',
+                            help='Record the time and peak memory of each stage, and the optimizer statistics, as JSON lines in PROFILE (\'-\' for stderr). (default: None)')
+        args = parser.parse_args(argv)
+        
+    except Exception as e:
+        print(e)
+        sys.exit()
+
+    imageListFile = args.list[0]
+    
+    catalog = ic.loadCatalog(imageListFile)
+    planImageDict = catalog['planImages']
+
+    examRows = groupByExam(catalog)
+
+    options = {
+        'warmStart'      : args.warmStart,
+        'transformCache' : args.transformCache if args.transformCache != '' else None,
+        'maskDilation'   : args.maskDilation,
+        'param'          : getSamplingParameters(args),
+        'roiPadding'     : args.roiPadding,
+        'ioDepth'        : args.ioDepth,
+        'outputFormat'   : args.outputFormat,
+        'compressionLevel' : args.compressionLevel,
+        'seriesThreads'  : args.seriesThreads,
+    }
+    pc.setCacheSize(args.cacheSize)
+
+    imageCacheDir = args.imageCache if args.imageCache != '' else None
+    icache.setCacheDir(imageCacheDir)
+
+    profilePath = args.profile if args.profile != '' else None
+    if profilePath:
+        pp.enable(profilePath)
+
+    manifestPath = args.manifest if args.manifest != '' else None
+    manifest = pm.loadManifest(manifestPath)
+
+    # Exams that are up to date in the manifest are not processed again.
+    # Their lines are taken from the manifest.
+    examList = []
+    doneLines = []
+    for exam in examRows:
+        entry = None
+        if manifestPath and exam in planImageDict:
+            (inputs, outputs) = getExamFiles(exam, examRows[exam], planImageDict, options)
+            settings = getExamSettings(exam, examRows[exam], planImageDict, options)
+            entry = pm.getEntry(manifest, 'registration', exam, inputs, settings)
+        if entry:
+            indices = [index for (index, imageData) in examRows[exam]]
+            doneLines.append(list(zip(indices, entry['rows'])))
+        else:
+            examList.append(exam)
+
+    print ('Case,Cycle,Time,Ser,OFF_X,OFF_Y,OFF_Z')
+
+    if args.workers <= 1:
+        results = (registerExam(exam, examRows[exam], planImageDict, options) for exam in examList)
+        results = recordResults(results, examRows, planImageDict, options, manifestPath)
+        printLines(itertools.chain(doneLines, results))
+        return
+
+    numberOfThreads = args.threads
+    if numberOfThreads <= 0:
+        numberOfThreads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    tasks = [(exam, examRows[exam], planImageDict, options) for exam in examList]
+
+    with multiprocessing.Pool(args.workers, initializer=initWorker, initargs=(numberOfThreads, args.cacheSize, profilePath, imageCacheDir)) as pool:
+        results = pool.imap_unordered(registerExamTask, tasks)
+        results = recordResults(results, examRows, planImageDict, options, manifestPath)
+        printLines(itertools.chain(doneLines, results))
             
         
 if __name__ == "__main__":
@@ -0,0 +1,417 @@
+#! /usr/bin/python
+
+import argparse, sys, os, time
+import signal
+import glob
+import json
+import csv
+import SimpleITK as sitk
+import ablation_evaluation as ae
+import ablation_registration as ar
+import plan_cache as pc
+import image_catalog as ic
+import pipeline_profile as pp
+import background_io as bio
+import image_store as ims
+import run_registration as rr
+import run_evaluation as rev
+
+#
+# Intraprocedural service for one exam.
+#
+# The plan image, the anatomy label and the registration masks of the exam are loaded
+# once. The service then watches a directory for new series; each series is registered,
+# resampled and evaluated as soon as it arrives, and the duration maps are updated. The
+# result csv file is then rewritten with the summary rows of the updated maps, and the
+# offset line of the series is appended to the offsets file.
+#
+# A new series is announced by a JSON file (*.json) in the watch directory, which holds
+# a row in the format of INTRA_IMAGES:
+#
+#   [exam, cycle, time, series, freg, imageFile, labelFile]             or
+#   [exam, cycle, time, series, freg, imageFile, labelFile, [x, y, z]]  (freg == 3)
+#
+# 'imageFile' and 'labelFile' are file names in the watch directory. The JSON file must
+# be written after the image and the label (e.g. written to a temporary name and renamed).
+# The series are processed in the order of the modification times of the JSON files;
+# a series whose files cannot be read yet is tried again at the next poll, and is skipped
+# (with a message on stderr) once its JSON file is older than a few polling intervals.
+#
+# On start, all series already in the watch directory are processed, so a restarted
+# service rebuilds the duration maps and the result files of the session.
+#
+
+
+def createServiceState(catalog, exam, options):
+    # Load the plan data of the exam and create the state of the service.
+    # 'options' is a dictionary with the keys of run_registration.registerExam(), and:
+    #   'margins'      : Margins of the duration maps
+    #   'minDurations' : Minimum durations of the summary rows
+    #   'marginInMM'   : If True, the margins are in mm
+    #   'useROI'       : If True, the distance maps are computed within the bounding box of each label
+    #   'formats'      : Formats of the duration maps (see run_evaluation.defaultFormats)
+
+    planImages = ic.getPlanImages(catalog, exam)
+    if not planImages:
+        raise Exception('No plan images for exam %d' % int(exam))
+
+    planImagePath = 'PC%03d/NRRD/%s' % (int(exam), planImages[0])
+    planStructureLabelPath = 'PC%03d/NIFTY-Anatomy-label/%s' % (int(exam), planImages[1])
+
+    pp.setContext(exam=int(exam))
+    with pp.stage('readPlan'):
+        planImage = pc.readImage(exam, planImagePath, sitk.sitkFloat32)
+        structureLabel = pc.readImage(exam, planStructureLabelPath, sitk.sitkUInt16)
+
+    param = ar.setDefaultParameters(dict(options['param']))
+
+    # Fixed image, mask and fixed state (see ar.prepareFixedImage()) for the
+    # registrations without (False) and with (True) the mask
+    fixed = {}
+    for useMask in [False, True]:
+        mask = None
+        if useMask:
+            with pp.stage('mask'):
+                mask = pc.getMaskFromAnatomLabel(exam, planStructureLabelPath, planImagePath, dilation=options['maskDilation'])
+        fixedImage = planImage
+        if options['roiPadding'] is not None:
+            with pp.stage('roi'):
+                (fixedImage, mask) = rr.cropToROI(exam, planImage, mask, planStructureLabelPath, options['roiPadding'])
+        fixed[useMask] = (fixedImage, mask, ar.prepareFixedImage(fixedImage, mask, 'fixed'))
+
+    # Images in containers are written to new ones, since the series are processed again.
+    ims.removeContainer(rev.getMapPath(exam, options['margins'][0], options['formats']))
+    for path in rr.getOutputPaths(exam, [exam, 0, 0, 0, 0, '', ''], options):
+        ims.removeContainer(path)
+
+    state = {
+        'exam'            : int(exam),
+        'options'         : options,
+        'param'           : param,
+        'planImage'       : planImage,
+        'structureLabel'  : structureLabel,
+        'fixed'           : fixed,
+        'accumulator'     : rev.createDurationAccumulator(options['margins'], structureLabel),
+        'lastTime'        : {},      # Time of the last series in each cycle
+        'cycleTransforms' : {},      # Last transform in each cycle (for 'warmStart')
+        'processed'       : set(),   # Processed JSON files
+        'mapsPending'     : False,   # True if the maps in a container are not written
+        'writer'          : bio.createWriter(options['ioDepth']),
+    }
+    return state
+
+
+def getNewSeries(state, watchDir):
+    # JSON files of the series that have not been processed, in the order of arrival.
+    paths = [p for p in glob.glob(os.path.join(watchDir, '*.json')) if not p in state['processed']]
+    return sorted(paths, key=lambda p: (os.path.getmtime(p), p))
+
+
+def readSeries(watchDir, descriptorPath):
+    # Read the row and the image and label of the series. Raises an exception if the
+    # files are not (yet) readable.
+    with open(descriptorPath, 'r') as f:
+        row = json.load(f)
+    ablationImage = sitk.ReadImage(os.path.join(watchDir, row[5]), sitk.sitkFloat32)
+    ablationLabel = sitk.ReadImage(os.path.join(watchDir, row[6]), sitk.sitkFloat32)
+    return (row, ablationImage, ablationLabel)
+
+
+def processSeries(state, row, ablationImage, ablationLabel):
+    # Register, resample and evaluate the series, and update the duration maps.
+    # Returns the offset line, the evaluation lines and the summary rows (in the formats
+    # of run_registration.py, and of the output and the result csv file of
+    # run_evaluation.py), and the time of each step.
+
+    exam = state['exam']
+    options = state['options']
+    param = dict(state['param'])
+    fz   = int(row[1])
+    t    = float(row[2])
+    ser  = int(row[3])
+    freg = int(row[4])
+
+    # Time interval from the previous series in the same cycle
+    dt = t - state['lastTime'].get(fz, 0.0)
+
+    pp.setContext(exam=exam, cycle=fz, series=ser)
+    times = {}
+
+    # Registration
+    start = time.perf_counter()
+    offset = [0.0, 0.0, 0.0]
+    if freg > 0:
+        if freg == 3 and len(row) > 7:
+            param['initialOffset'] = [-row[7][0], -row[7][1], -row[7][2]]
+        else:
+            param['initialOffset'] = [0.0, 0.0, 0.0]
+        param['initialTransform'] = None
+        if options['warmStart'] and fz in state['cycleTransforms']:
+            param['initialTransform'] = state['cycleTransforms'][fz]
+        (fixedImage, mask, fixedState) = state['fixed'][freg == 2]
+        with pp.stage('register'):
+            transform = ar.registerImages(fixedImage, ablationImage, param, mask=mask, maskType='fixed', fixedState=fixedState)
+        offset = transform.GetParameters()
+        state['cycleTransforms'][fz] = transform
+    else:
+        transform = sitk.Transform()
+    times['register'] = time.perf_counter() - start
+
+    # Resampling
+    start = time.perf_counter()
+    planImage = state['planImage']
+    with pp.stage('resample'):
+        ablationImageResampled = ar.resampleImage(ablationImage, planImage, transform, interp='linear')
+        ablationLabelResampled = ar.resampleImage(ablationLabel, planImage, transform, interp='nearest')
+    (registeredImagePath, registeredLabelPath) = rr.getOutputPaths(exam, row, options)
+    os.makedirs(os.path.dirname(registeredImagePath), exist_ok=True)
+    os.makedirs(os.path.dirname(registeredLabelPath), exist_ok=True)
+    with pp.stage('write'):
+        bio.writeImage(state['writer'], ablationImageResampled, registeredImagePath, options['compressionLevel'])
+        bio.writeImage(state['writer'], ablationLabelResampled, registeredLabelPath, options['compressionLevel'])
+    times['resample'] = time.perf_counter() - start
+
+    # Evaluation (same as run_evaluation.evaluateExam(), on the label read back as UInt16)
+    start = time.perf_counter()
+    ablationLabelResampled = sitk.Cast(ablationLabelResampled, sitk.sitkUInt16)
+    with pp.stage('sweepMargins'):
+        marginLabels = ae.sweepMargins(ablationLabelResampled, options['margins'], useImageSpacing=options['marginInMM'], useROI=options['useROI'])
+
+    lines = []
+    for m in options['margins']:
+        label = marginLabels[m]
+        with pp.stage('accumulate', margin=m):
+            rev.addToDurationAccumulator(state['accumulator'], m, label, dt)
+        with pp.stage('evaluate', margin=m):
+            results = ae.evaluateAblation(state['structureLabel'], label, {'margin' : 0.0}, fMinDist=False)
+        lines.append('%d,%d,%d,%d,%f, %f,%f,%f, %f, %f,%f,%f' %
+                     (exam, fz, int(t), ser, m,
+                      results['Structure.TG'], results['Structure.EUS'], results['Structure.NVB'],
+                      results['AblationVolume'],
+                      results['Involved.TG'], results['Involved.EUS'], results['Involved.NVB']))
+    state['lastTime'][fz] = t
+    times['evaluate'] = time.perf_counter() - start
+
+    # Duration maps. The maps are written in the background and replaced by each series.
+    # In a container, an image written again is added to the file (see
+    # ims.writeContainerImage()), so the maps are written once, when the service stops
+    # (see writeDurationMaps()).
+    start = time.perf_counter()
+    formats = options['formats']
+    summary = []
+    for m in options['margins']:
+        durationMap = rev.getDurationMap(state['accumulator'], m)
+        mapPath = rev.getMapPath(exam, m, formats)
+        if ims.isContainerPath(mapPath):
+            state['mapsPending'] = True
+        else:
+            os.makedirs(os.path.dirname(mapPath), exist_ok=True)
+            with pp.stage('write', margin=m):
+                bio.writeImage(state['writer'], durationMap, mapPath, formats['compressionLevel'])
+        with pp.stage('summarize', margin=m):
+            durationSummary = rev.summarizeDurationMap(durationMap, state['structureLabel'], options['minDurations'])
+        for (d, results) in zip(options['minDurations'], durationSummary):
+            summary.append([str(exam), str(fz), str(int(t)), str(ser), str(m), str(d),
+                            str(results['AblationVolume']),
+                            str(results['Involved.TG']),
+                            str(results['Involved.EUS']),
+                            str(results['Involved.NVB'])])
+    times['map'] = time.perf_counter() - start
+
+    offsetLine = '%d,%d,%d,%d,%f,%f,%f' % (exam, fz, int(t), ser, offset[0], offset[1], offset[2])
+    return (offsetLine, lines, summary, times)
+
+
+def writeDurationMaps(state):
+    # Write the duration maps that have not been written by processSeries() (maps in a
+    # container).
+    if not state['mapsPending']:
+        return
+    exam = state['exam']
+    formats = state['options']['formats']
+    os.makedirs('PC%03d/NIFTY-Map' % exam, exist_ok=True)
+    for m in state['options']['margins']:
+        with pp.stage('write', margin=m):
+            bio.writeImage(state['writer'], rev.getDurationMap(state['accumulator'], m), rev.getMapPath(exam, m, formats), formats['compressionLevel'])
+    state['mapsPending'] = False
+
+
+def openResultFile(path, header):
+    # Create the file and write the header. An existing file is truncated, since all
+    # series in the watch directory are processed again on start.
+    f = open(path, 'w', newline='')
+    f.write(header + '\n')
+    f.flush()
+    return f
+
+
+def writeResultFile(path, header, rows):
+    # Replace the file with the header and 'rows'. The rows are written to a temporary
+    # file first, so a reader never sees a partial file.
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmpPath, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for r in rows:
+            writer.writerow(r)
+    os.replace(tmpPath, path)
+
+
+def serve(state, watchDir, resultPath, offsetPath, interval=1.0, once=False, failAfter=5):
+    # Process the new series in the watch directory every 'interval' seconds, until
+    # interrupted (or, if 'once' is True, until no new series is left). A series that
+    # cannot be read 'failAfter' intervals after its JSON file was written is skipped.
+
+    # The result csv file holds the summary rows of the maps after the last series, as
+    # written by run_evaluation.py; the offsets file holds the output of
+    # run_registration.py.
+    resHeader = ['CASE', 'CYCLE', 'TIME', 'SERIES', 'MARGIN', 'MIN_DURATION', 'V_ABLATION', 'V_INV_TG', 'V_INV_EUS', 'V_INV_NVB']
+    writeResultFile(resultPath, resHeader, [])
+    offsetFile = openResultFile(offsetPath, 'Case,Cycle,Time,Ser,OFF_X,OFF_Y,OFF_Z')
+
+    print ('Case,Cycle,Time,Ser,Margin,V_TG,V_EUS,V_NVB,V_ablation,V_INV_TG,V_INV_EUS,V_INV_NVB', flush=True)
+
+    try:
+        while True:
+            pending = getNewSeries(state, watchDir)
+            for descriptorPath in pending:
+                start = time.perf_counter()
+                try:
+                    (row, ablationImage, ablationLabel) = readSeries(watchDir, descriptorPath)
+                except Exception as e:
+                    # The files may not be written yet. The series is tried again at the next
+                    # poll, before the later series, unless the JSON file is older than
+                    # 'failAfter' intervals (or removed); then it is skipped.
+                    age = time.time() - os.path.getmtime(descriptorPath) if os.path.exists(descriptorPath) else None
+                    if once or age is None or age > failAfter * interval:
+                        print ('Failed %s: %s' % (descriptorPath, e), file=sys.stderr, flush=True)
+                        state['processed'].add(descriptorPath)
+                        continue
+                    print ('Cannot read %s yet: %s' % (descriptorPath, e), file=sys.stderr, flush=True)
+                    break
+                if int(row[0]) != state['exam']:
+                    print ('Skipped %s: exam %d' % (descriptorPath, int(row[0])), file=sys.stderr)
+                    state['processed'].add(descriptorPath)
+                    continue
+                readTime = time.perf_counter() - start
+
+                (offsetLine, lines, summary, times) = processSeries(state, row, ablationImage, ablationLabel)
+                state['processed'].add(descriptorPath)
+
+                for line in lines:
+                    print (line, flush=True)
+                offsetFile.write(offsetLine + '\n')
+                offsetFile.flush()
+                writeResultFile(resultPath, resHeader, summary)
+
+                latency = time.perf_counter() - start
+                pp.record('latency', time=latency, read=readTime, **times)
+                print ('Series %d: %.2f s (read %.2f, register %.2f, resample %.2f, evaluate %.2f, map %.2f)' %
+                       (int(row[3]), latency, readTime, times['register'], times['resample'], times['evaluate'], times['map']),
+                       file=sys.stderr, flush=True)
+
+            if once and len(getNewSeries(state, watchDir)) == 0:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writeDurationMaps(state)
+        bio.flushWriter(state['writer'])
+        bio.closeWriter(state['writer'])
+        offsetFile.close()
+
+
+def main(argv):
+
+    args = []
+    try:
+        parser = argparse.ArgumentParser(description="Register and evaluate the new series of an exam as they arrive in a directory.")
+        parser.add_argument('list', metavar='IMAGE_LIST', type=str, nargs=1,
+                            help='A JSON file that lists planning images.')
+        parser.add_argument('exam', metavar='EXAM', type=int, nargs=1,
+                            help='Exam number')
+        parser.add_argument('watch', metavar='WATCH_DIR', type=str, nargs=1,
+                            help='Directory where the new series (JSON rows, images and labels) arrive')
+        parser.add_argument('output', metavar='RESULT_CSV', type=str, nargs=1,
+                            help='A csv file with the summary rows of the duration maps, rewritten after each series')
+        parser.add_argument('--offsets', dest='offsets', default='',
+                            help='A csv file to append the registration offsets, rewritten on start (default: RESULT_CSV with the suffix -offsets.csv)')
+        parser.add_argument('--interval', dest='interval', type=float, default=1.0,
+                            help='Polling interval in seconds (default: 1.0)')
+        parser.add_argument('--fail-after', dest='failAfter', type=int, default=5,
+                            help='Skip a series that cannot be read this number of polling intervals after its JSON file was written. (default: 5)')
+        parser.add_argument('--once', dest='once', action='store_true',
+                            help='Process the series in the directory and exit.')
+        parser.add_argument('--threads', dest='threads', type=int, default=0,
+                            help='Number of SimpleITK threads (default: number of cores)')
+        parser.add_argument('--warm-start', dest='warmStart', action='store_true',
+                            help='Start each registration from the transform of the previous series in the same freeze cycle.')
+        parser.add_argument('--roi', dest='roiPadding', type=float, nargs='?', const=20.0, default=None,
+                            help='Crop the plan image to the bounding box of the registration mask (or the anatomy label) padded by ROI_PADDING mm. (default padding: 20 mm)')
+        parser.add_argument('--sampling-seed', dest='samplingSeed', type=int, default=None,
+                            help='Seed for the metric sampling, for reproducible registrations. (default: wall clock)')
+        parser.add_argument('--samples', dest='numberOfSamples', type=int, default=0,
+                            help='Number of metric samples that remain in the mask (more are drawn over the mask bounding box, and those outside are discarded), instead of a percentage of the plan image. (default: 0 (2%% of the plan image))')
+        parser.add_argument('--refinement-samples', dest='refinementSamples', type=int, default=0,
+                            help='Refine each transform with this number of samples after the optimizer has converged. (default: 0 (no refinement))')
+        parser.add_argument('--margin-mm', dest='marginInMM', action='store_true',
+                            help='Specify the margins in mm instead of voxels.')
+        parser.add_argument('--distance-roi', dest='useROI', action='store_true',
+                            help='Compute the distance maps only within the bounding box of each label.')
+        parser.add_argument('--io-depth', dest='ioDepth', type=int, default=2,
+                            help='Number of output images written behind on a background thread. 0 to write synchronously. (default: 2)')
+        parser.add_argument('--output-format', dest='outputFormat', choices=ims.outputFormats, default='same',
+                            help='Format of the resampled images and the duration maps (see run_registration.py and run_evaluation.py). (default: same)')
+        parser.add_argument('--compression-level', dest='compressionLevel', type=int, default=-1,
+                            help='Compress the nrrd, mha or container outputs at COMPRESSION_LEVEL (1-9). (default: no compression)')
+        parser.add_argument('--profile', dest='profile', default='',
+                            help='Record the time and peak memory of each stage, and the latency of each series, as JSON lines in PROFILE (\'-\' for stderr). (default: None)')
+        args = parser.parse_args(argv)
+
+    except Exception as e:
+        print(e)
+        sys.exit()
+
+    if args.threads > 0:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(args.threads)
+    if args.profile != '':
+        pp.enable(args.profile)
+
+    options = {
+        'warmStart'        : args.warmStart,
+        'maskDilation'     : 30,
+        'param'            : rr.getSamplingParameters(args),
+        'roiPadding'       : args.roiPadding,
+        'ioDepth'          : args.ioDepth,
+        'outputFormat'     : args.outputFormat,
+        'compressionLevel' : args.compressionLevel,
+        'margins'          : [0.0, -1.0, -2.0, -3.0, -4.0, -5.0],
+        'minDurations'     : [0.001, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11.0, 12.0, 13.0, 14.0, 15.0],
+        'marginInMM'       : args.marginInMM,
+        'useROI'           : args.useROI,
+        'formats'          : {
+            'input'            : args.outputFormat,
+            'output'           : args.outputFormat,
+            'compressionLevel' : args.compressionLevel,
+        },
+    }
+
+    resultPath = args.output[0]
+    offsetPath = args.offsets if args.offsets != '' else os.path.splitext(resultPath)[0] + '-offsets.csv'
+
+    catalog = ic.loadCatalog(args.list[0])
+    start = time.perf_counter()
+    state = createServiceState(catalog, args.exam[0], options)
+    print ('Loaded exam %d in %.2f s' % (args.exam[0], time.perf_counter() - start), file=sys.stderr, flush=True)
+
+    # Stop on SIGTERM as on Ctrl-C, after the pending images are written.
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+
+    serve(state, args.watch[0], resultPath, offsetPath, args.interval, args.once, args.failAfter)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
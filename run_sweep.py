@@ -0,0 +1,306 @@
+#! /usr/bin/python
+
+import argparse, sys, os, time
+import json
+import csv
+import itertools
+import multiprocessing
+import SimpleITK as sitk
+import ablation_evaluation as ae
+import ablation_registration as ar
+import plan_cache as pc
+import transform_cache as tc
+import image_catalog as ic
+import pipeline_profile as pp
+import image_cache as icache
+import run_registration as rr
+
+#
+# Registration parameter sweep.
+#
+# Each configuration of a parameter grid (e.g. numberOfBins x samplingPercentage x mask
+# dilation x freg) is applied to every intraop series in the image list: the series is
+# registered to the plan image with ar.registerImages(), and its ablation label is
+# resampled onto the plan image and evaluated with ae.evaluateAblation(). The results are
+# written as a long-format table, one row per (configuration, series).
+#
+# The grid may vary the registration parameters (ar.registrationParameterKeys) and the
+# following settings of run_registration.py:
+#   'maskDilation' : Dilation of the anatomy label for the registration mask
+#   'freg'         : Registration mode, instead of the mode of each series in the image list
+#   'roiPadding'   : Padding (mm) of the region of interest (None to use the full plan image)
+#
+# With a cache directory, the transform of each run is stored in the same way as
+# run_registration.py --transform-cache (the two can share the directory), and the
+# results of each run as '<key>.json', so runs already computed for the same inputs and
+# settings are not repeated. A transform found in the cache (e.g. computed by
+# run_registration.py) is used without registration; its metric value and number of
+# iterations are then left empty. The CACHED column is 'result', 'transform' or empty.
+#
+
+sweepSettingKeys = ['maskDilation', 'freg', 'roiPadding']
+
+resultHeader = ['CONFIG', 'CASE', 'CYCLE', 'TIME', 'SERIES', 'FREG',
+                'VERSOR_X', 'VERSOR_Y', 'VERSOR_Z', 'TRANS_X', 'TRANS_Y', 'TRANS_Z',
+                'METRIC', 'ITERATIONS', 'STOP_CONDITION', 'RUNTIME', 'CACHED',
+                'V_ABLATION', 'V_INV_TG', 'V_INV_EUS', 'V_INV_NVB',
+                'MIN_DIST_TG', 'MIN_DIST_EUS', 'MIN_DIST_NVB']
+
+
+def parseGrid(specs, gridFile=None):
+    # Parameter grid as a list of (name, values). 'gridFile' is a JSON file with a
+    # dictionary of lists of values; 'specs' are strings 'name=value1,value2,...', where
+    # each value is parsed as JSON (e.g. 'numberOfBins=32,50', 'roiPadding=null,20').
+    grid = []
+    if gridFile:
+        with open(gridFile, 'r') as f:
+            grid.extend(json.load(f).items())
+    for spec in specs:
+        (name, values) = spec.split('=', 1)
+        grid.append((name, [json.loads(v) for v in values.split(',')]))
+
+    for (name, values) in grid:
+        if not name in ar.registrationParameterKeys and not name in sweepSettingKeys:
+            raise Exception('Unknown parameter: %s' % name)
+    return grid
+
+
+def getConfigs(grid):
+    # All combinations of the values in the grid, as a list of dictionaries.
+    names = [name for (name, values) in grid]
+    return [dict(zip(names, values)) for values in itertools.product(*[values for (name, values) in grid])]
+
+
+def writeResult(cacheDir, key, result):
+    os.makedirs(cacheDir, exist_ok=True)
+    path = os.path.join(cacheDir, '%s.json' % key)
+    # Write to a temporary file first (see tc.saveTransform())
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmpPath, 'w') as f:
+        json.dump(result, f)
+    os.replace(tmpPath, path)
+
+
+def readResult(cacheDir, key):
+    path = os.path.join(cacheDir, '%s.json' % key)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def runSeries(exam, imageData, planImages, config, options):
+    # Register and evaluate one series with a configuration. Returns a dictionary of the
+    # results (see resultHeader).
+
+    planImagePath = 'PC%03d/NRRD/%s' % (int(exam), planImages[0])
+    planStructureLabelPath = 'PC%03d/NIFTY-Anatomy-label/%s' % (int(exam), planImages[1])
+    ablationImagePath = 'PC%03d/NIFTY-Iceball-AXTSE/%s' % (int(exam), imageData[5])
+    ablationLabelPath = 'PC%03d/NIFTY-Iceball-AXTSE-label/%s' % (int(exam), imageData[6])
+
+    freg = config['freg'] if 'freg' in config else imageData[4]
+    maskDilation = config['maskDilation'] if 'maskDilation' in config else options['maskDilation']
+    roiPadding = config['roiPadding'] if 'roiPadding' in config else options['roiPadding']
+
+    param = dict(options['param'])
+    for key in config:
+        if not key in sweepSettingKeys:
+            param[key] = config[key]
+    if freg == 3 and len(imageData) > 7:
+        param['initialOffset'] = [-imageData[7][0], -imageData[7][1], -imageData[7][2]]
+    else:
+        param['initialOffset'] = [0.0, 0.0, 0.0]
+    param['initialTransform'] = None
+
+    # The result depends on the inputs and settings of the registration, and on the label.
+    cacheDir = options['cacheDir']
+    transformKey = None
+    resultKey = None
+    if cacheDir:
+        transformKey = rr.getTransformKey(planImagePath, ablationImagePath, planStructureLabelPath, freg, maskDilation, roiPadding, param)
+        # The transform key does not include the anatomy label if it is not used for the
+        # registration, but the evaluation always depends on it.
+        resultKey = tc.transformKey([ablationLabelPath, planStructureLabelPath], {'transform' : transformKey, 'evaluation' : 'sweep'})
+        result = readResult(cacheDir, resultKey)
+        if result:
+            result['cached'] = 'result'
+            return result
+
+    pp.setContext(exam=int(exam), cycle=imageData[1], series=imageData[3])
+    planImage = pc.readImage(exam, planImagePath, sitk.sitkFloat32)
+    result = {
+        'freg'          : freg,
+        'parameters'    : [0.0] * 6,
+        'metric'        : None,
+        'iterations'    : 0,
+        'stopCondition' : '',
+        'runtime'       : 0.0,
+        'cached'        : '',
+    }
+
+    transform = None
+    if freg > 0 and transformKey:
+        # Transform computed by an earlier sweep or by run_registration.py; the optimizer
+        # statistics are not known.
+        transform = tc.loadTransform(cacheDir, transformKey)
+        if transform is not None:
+            result['parameters'] = list(transform.GetParameters())
+            result['iterations'] = None
+            result['cached'] = 'transform'
+
+    if freg > 0 and transform is None:
+        movingImage = icache.readImage(ablationImagePath, sitk.sitkFloat32)
+        mask = None
+        if freg == 2:
+            mask = pc.getMaskFromAnatomLabel(exam, planStructureLabelPath, planImagePath, dilation=maskDilation)
+        fixedImage = planImage
+        if roiPadding is not None:
+            (fixedImage, mask) = rr.cropToROI(exam, planImage, mask, planStructureLabelPath, roiPadding)
+
+        statistics = {}
+        start = time.perf_counter()
+        with pp.stage('register'):
+            transform = ar.registerImages(fixedImage, movingImage, param, mask=mask, maskType='fixed', statistics=statistics)
+        result['runtime'] = time.perf_counter() - start
+        if 'refinement' in statistics:
+            statistics['iterations'] = statistics['iterations'] + statistics['refinement']['iterations']
+            statistics['metric'] = statistics['refinement']['metric']
+            statistics['stopCondition'] = statistics['refinement']['stopCondition']
+        result['parameters'] = list(transform.GetParameters())
+        result['metric'] = statistics['metric']
+        result['iterations'] = statistics['iterations']
+        result['stopCondition'] = statistics['stopCondition']
+        if transformKey:
+            tc.saveTransform(cacheDir, transformKey, transform)
+    elif freg == 0:
+        transform = sitk.Transform()
+
+    # Evaluation of the ablation label resampled onto the plan image
+    with pp.stage('evaluate'):
+        ablationLabel = icache.readImage(ablationLabelPath, sitk.sitkFloat32)
+        ablationLabel = sitk.Cast(ar.resampleImage(ablationLabel, planImage, transform, interp='nearest'), sitk.sitkUInt16)
+        structureLabel = pc.readImage(exam, planStructureLabelPath, sitk.sitkUInt16)
+        evaluation = ae.evaluateAblation(structureLabel, ablationLabel, {'margin' : 0.0, 'minDistEngine' : 'boundary'})
+    result['evaluation'] = dict((key, float(evaluation[key])) for key in evaluation)
+
+    if resultKey:
+        writeResult(cacheDir, resultKey, result)
+    return result
+
+
+def runConfigTask(task):
+    # Run one configuration on the series of one exam.
+    # Returns a list of (configIndex, rowIndex, result).
+    (configIndex, config, exam, rows, planImages, options) = task
+    return [(configIndex, index, runSeries(exam, imageData, planImages, config, options)) for (index, imageData) in rows]
+
+
+def getResultRow(configIndex, config, grid, imageData, result):
+    evaluation = result['evaluation']
+    row = [configIndex]
+    row.extend([json.dumps(config[name]) if name in config else '' for (name, values) in grid])
+    row.extend([imageData[0], imageData[1], imageData[2], imageData[3], result['freg']])
+    row.extend(result['parameters'])
+    row.extend([result['metric'] if result['metric'] is not None else '',
+                result['iterations'] if result['iterations'] is not None else '',
+                result['stopCondition'], '%f' % result['runtime'], result['cached']])
+    row.extend([evaluation['AblationVolume'],
+                evaluation['Involved.TG'], evaluation['Involved.EUS'], evaluation['Involved.NVB']])
+    row.extend([evaluation['MinDist.'+name] if 'MinDist.'+name in evaluation else '' for name in ['TG', 'EUS', 'NVB']])
+    return row
+
+
+def main(argv):
+
+    args = []
+    try:
+        parser = argparse.ArgumentParser(description="Register and evaluate the series in the image list file with each configuration of a parameter grid.")
+        parser.add_argument('list', metavar='IMAGE_LIST', type=str, nargs=1,
+                            help='A JSON file that lists planning and intraprocedural images.')
+        parser.add_argument('output', metavar='RESULT_CSV', type=str, nargs=1,
+                            help='A csv file to store the results (one row per configuration and series)')
+        parser.add_argument('-p', '--param', dest='params', action='append', default=[],
+                            help='Values of a parameter: NAME=VALUE1,VALUE2,... (repeatable), e.g. numberOfBins=32,50, samplingPercentage=0.01,0.02, maskDilation=20,30, freg=1,2')
+        parser.add_argument('--grid', dest='grid', default='',
+                            help='A JSON file with the values of the parameters, e.g. {"numberOfBins": [32, 50], "freg": [1, 2]}')
+        parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                            help='Number of worker processes. Each (configuration, exam) pair is a task. (default: 1)')
+        parser.add_argument('--threads', dest='threads', type=int, default=0,
+                            help='Number of SimpleITK threads per worker (default: number of cores / number of workers)')
+        parser.add_argument('--cache-size', dest='cacheSize', type=int, default=8,
+                            help='Maximum number of plan images, labels and masks kept in memory per worker (default: 8)')
+        parser.add_argument('--cache', dest='cacheDir', default='',
+                            help='Directory to cache the transforms and the results. Runs with unchanged inputs and settings are not repeated. (default: None)')
+        parser.add_argument('--mask-dilation', dest='maskDilation', type=int, default=30,
+                            help='Dilation of the anatomy label for the registration mask, unless given in the grid (default: 30)')
+        parser.add_argument('--roi', dest='roiPadding', type=float, nargs='?', const=20.0, default=None,
+                            help='Crop the plan image to the bounding box of the registration mask (or the anatomy label) padded by ROI_PADDING mm, unless given in the grid. (default padding: 20 mm)')
+        parser.add_argument('--sampling-seed', dest='samplingSeed', type=int, default=None,
+                            help='Seed for the metric sampling, for reproducible registrations. (default: wall clock)')
+        parser.add_argument('--samples', dest='numberOfSamples', type=int, default=0,
+                            help='Number of metric samples that remain in the mask (more are drawn over the mask bounding box, and those outside are discarded), instead of a percentage of the plan image. (default: 0 (2%% of the plan image))')
+        parser.add_argument('--refinement-samples', dest='refinementSamples', type=int, default=0,
+                            help='Refine each transform with this number of samples after the optimizer has converged. (default: 0 (no refinement))')
+        parser.add_argument('--image-cache', dest='imageCache', default='',
+                            help='Read the input images from the cache created by image_cache.py, if up to date. (default: None)')
+        parser.add_argument('--profile', dest='profile', default='',
+                            help='Record the time and peak memory of each stage, and the optimizer statistics, as JSON lines in PROFILE (\'-\' for stderr). (default: None)')
+        args = parser.parse_args(argv)
+        grid = parseGrid(args.params, args.grid if args.grid != '' else None)
+
+    except Exception as e:
+        print(e)
+        sys.exit()
+
+    catalog = ic.loadCatalog(args.list[0])
+    configs = getConfigs(grid)
+
+    options = {
+        'maskDilation' : args.maskDilation,
+        'roiPadding'   : args.roiPadding,
+        'param'        : rr.getSamplingParameters(args),
+        'cacheDir'     : args.cacheDir if args.cacheDir != '' else None,
+    }
+
+    imageCacheDir = args.imageCache if args.imageCache != '' else None
+    icache.setCacheDir(imageCacheDir)
+    profilePath = args.profile if args.profile != '' else None
+
+    # One task for each configuration and exam, so that a worker reuses the plan data
+    # of the exam for all its series.
+    examRows = rr.groupByExam(catalog)
+    tasks = []
+    for (configIndex, config) in enumerate(configs):
+        for exam in examRows:
+            planImages = ic.getPlanImages(catalog, exam)
+            if planImages:
+                tasks.append((configIndex, config, exam, examRows[exam], planImages, options))
+
+    if args.workers <= 1:
+        initWorkerThreads = args.threads if args.threads > 0 else (os.cpu_count() or 1)
+        rr.initWorker(initWorkerThreads, args.cacheSize, profilePath, imageCacheDir)
+        results = [runConfigTask(task) for task in tasks]
+    else:
+        numberOfThreads = args.threads
+        if numberOfThreads <= 0:
+            numberOfThreads = max(1, (os.cpu_count() or 1) // args.workers)
+        with multiprocessing.Pool(args.workers, initializer=rr.initWorker, initargs=(numberOfThreads, args.cacheSize, profilePath, imageCacheDir)) as pool:
+            results = list(pool.imap_unordered(runConfigTask, tasks))
+
+    # Rows in the order of the configurations and of INTRA_IMAGES
+    rowData = dict((record.index, record.data) for record in catalog['intraImages'])
+    results = sorted(itertools.chain(*results), key=lambda r: (r[0], r[1]))
+
+    with open(args.output[0], 'w', newline='') as f:
+        writer = csv.writer(f)
+        # The parameters of the grid are listed under their own names (e.g. 'numberOfBins')
+        writer.writerow(resultHeader[:1] + [name for (name, values) in grid] + resultHeader[1:])
+        for (configIndex, index, result) in results:
+            writer.writerow(getResultRow(configIndex, configs[configIndex], grid, rowData[index], result))
+
+    print ('%d runs (%d configurations), %d cached results, %d cached transforms' %
+           (len(results), len(configs), sum([1 for r in results if r[2]['cached'] == 'result']), sum([1 for r in results if r[2]['cached'] == 'transform'])))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
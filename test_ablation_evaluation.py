@@ -0,0 +1,95 @@
+#! /usr/bin/python
+
+import unittest
+import numpy as np
+import SimpleITK as sitk
+import ablation_evaluation as ae
+
+#
+# Regression tests of computeMinimumDistances() against the distance map
+# (computeDistanceFromAblationVolume()).
+#
+# Run with 'python -m unittest test_ablation_evaluation' (or 'python -m pytest') in this
+# directory.
+#
+
+# The search of computeMinimumDistances() gives exact Euclidean distances, while the
+# distance map is an approximation; in rare configurations of overlapping structures
+# the two differ by a fraction of a voxel.
+tolerance = 0.5
+
+
+def createLabels(ablation, structure, spacing=(1.0, 1.0, 1.0)):
+    ablationLabel = sitk.GetImageFromArray(ablation.astype(np.uint16))
+    structureLabel = sitk.GetImageFromArray(structure.astype(np.uint16))
+    ablationLabel.SetSpacing(spacing)
+    structureLabel.SetSpacing(spacing)
+    return (structureLabel, ablationLabel)
+
+
+def randomEllipsoid(rng, shape, indices):
+    (z, y, x) = indices
+    center = [rng.uniform(0, s) for s in shape]
+    radius = [rng.uniform(2, s / 2 + 2) for s in shape]
+    return ((z - center[0]) / radius[0]) ** 2 + ((y - center[1]) / radius[1]) ** 2 + ((x - center[2]) / radius[2]) ** 2 < 1
+
+
+class MinimumDistanceTest(unittest.TestCase):
+
+    # computeDistanceFromAblationVolume() numbers the structures 1, 2, ... in the order of
+    # their labels, so the labels compared with it must be consecutive from 1.
+    def assertSameDistances(self, structureLabel, ablationLabel):
+        expected = ae.computeDistanceFromAblationVolume(structureLabel, ablationLabel)
+        actual = ae.computeMinimumDistances(structureLabel, ablationLabel)
+        self.assertEqual(sorted(expected.keys()), sorted(actual.keys()))
+        for key in expected:
+            self.assertAlmostEqual(expected[key], actual[key], delta=tolerance, msg='structure %d' % key)
+
+    def test_random_ellipsoids(self):
+        rng = np.random.default_rng(0)
+        for trial in range(40):
+            shape = (rng.integers(8, 30), rng.integers(20, 60), rng.integers(20, 60))
+            indices = np.indices(shape)
+            ablation = randomEllipsoid(rng, shape, indices)
+            structure = np.zeros(shape, np.uint16)
+            for i in ae.anatomDict:
+                structure[randomEllipsoid(rng, shape, indices)] = i
+            spacing = tuple(rng.uniform(0.5, 3.0, 3))
+            with self.subTest(trial=trial):
+                self.assertSameDistances(*createLabels(ablation, structure, spacing))
+
+    def test_separate_boxes(self):
+        ablation = np.zeros((20, 30, 30), bool)
+        ablation[5:15, 5:15, 5:15] = True
+        structure = np.zeros((20, 30, 30), np.uint16)
+        structure[5:15, 5:15, 20:25] = 1
+        (structureLabel, ablationLabel) = createLabels(ablation, structure)
+        self.assertEqual(ae.computeMinimumDistances(structureLabel, ablationLabel), {1 : 6.0})
+        self.assertSameDistances(structureLabel, ablationLabel)
+
+    def test_structure_inside(self):
+        ablation = np.zeros((20, 30, 30), bool)
+        ablation[2:18, 2:28, 2:28] = True
+        structure = np.zeros((20, 30, 30), np.uint16)
+        structure[8:12, 12:18, 12:18] = 1
+        (structureLabel, ablationLabel) = createLabels(ablation, structure)
+        # The deepest voxels (z = 9, 10) are 7 voxels from the inner boundary (z = 2, 17)
+        self.assertEqual(ae.computeMinimumDistances(structureLabel, ablationLabel), {1 : -7.0})
+        self.assertSameDistances(structureLabel, ablationLabel)
+
+    def test_mm(self):
+        ablation = np.zeros((20, 30, 30), bool)
+        ablation[5:15, 5:15, 5:15] = True
+        structure = np.zeros((20, 30, 30), np.uint16)
+        structure[5:15, 5:15, 20:25] = 3
+        (structureLabel, ablationLabel) = createLabels(ablation, structure, (0.5, 1.0, 2.0))
+        self.assertAlmostEqual(ae.computeMinimumDistances(structureLabel, ablationLabel, useImageSpacing=True)[3], 3.0, places=5)
+
+    def test_empty_ablation(self):
+        structure = np.zeros((10, 10, 10), np.uint16)
+        structure[2:5, 2:5, 2:5] = 1
+        self.assertSameDistances(*createLabels(np.zeros((10, 10, 10), bool), structure))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#! /usr/bin/python
+
+import unittest
+import numpy as np
+import ablation_metrics as am
+
+#
+# Tests of the vectorized group metrics of ablation_metrics on a table with interleaved
+# groups, against computeMetrics() applied to the rows of each (Case, Cycle) group.
+#
+# Run with 'python -m unittest test_ablation_metrics' (or 'python -m pytest') in this
+# directory.
+#
+
+
+def getReferenceTable(mesHeader, mesTable):
+    # Result rows of am.computeMetrics() for each group, sorted by (Case, Cycle)
+    resHeader = am.getResultHeader()
+    cases = mesTable[:,mesHeader.index('Case')]
+    cycles = mesTable[:,mesHeader.index('Cycle')]
+    rows = []
+    for (case, cycle) in sorted(set(zip(cases, cycles))):
+        metrics = am.computeMetrics(mesHeader, mesTable[(cases == case) & (cycles == cycle)],
+                                    am.volNamesAnatom, am.volNamesAblation, am.volNamesAblationDist)
+        rows.append([int(case), int(cycle)] + [metrics[name] for name in resHeader[2:]])
+    return rows
+
+
+def createMeasurementTable(rng, numberOfGroups, numberOfSeries):
+    # Measurement table with the rows of the groups interleaved
+    mesHeader = ['Case', 'Cycle', 'Time', 'Ser'] + am.volNamesAnatom + am.volNamesAblation + am.volNamesAblationDist
+    n = numberOfGroups * numberOfSeries
+    mesTable = np.zeros((n, len(mesHeader)))
+    group = np.tile(np.arange(numberOfGroups), numberOfSeries)
+    mesTable[:,0] = group // 2 + 1
+    mesTable[:,1] = group % 2 + 1
+    mesTable[:,2] = np.repeat(np.arange(1, numberOfSeries + 1) * 2.5, numberOfGroups) + rng.uniform(0.0, 1.0, n)
+    mesTable[:,3] = np.repeat(np.arange(numberOfSeries) + 10, numberOfGroups)
+    mesTable[:,4:7] = rng.uniform(0.5, 30.0, (n, 3))
+    nAblation = len(am.volNamesAblation)
+    mesTable[:,7:7+nAblation] = np.maximum(rng.normal(1.0, 3.0, (n, nAblation)), 0.0)
+    mesTable[:,7+nAblation:] = rng.normal(0.0, 5.0, (n, len(am.volNamesAblationDist)))
+    return (mesHeader, mesTable)
+
+
+class ComputeMetricsTest(unittest.TestCase):
+
+    def test_group(self):
+        mesHeader = ['Case', 'Cycle', 'Time', 'Ser'] + am.volNamesAnatom + am.volNamesAblation + am.volNamesAblationDist
+        mesTable = np.array([
+            [1, 2, 2.0, 10, 20.0, 1.0, 0.5, 0.0, 0.0, 0.0, 0.0,  4.0,  6.0, 8.0],
+            [1, 2, 5.0, 11, 21.0, 1.1, 0.6, 3.0, 1.0, 0.0, 0.0,  1.0,  5.0, 9.0],
+            [1, 2, 6.5, 12, 22.0, 1.2, 0.7, 2.0, 1.5, 0.0, 0.2, -1.0,  7.0, 2.0],
+            [1, 2, 9.0, 13, 23.0, 1.3, 0.8, 0.0, 0.0, 0.0, 0.0,  2.0, -3.0, 4.0],
+        ])
+        metrics = am.computeMetrics(mesHeader, mesTable, am.volNamesAnatom, am.volNamesAblation, am.volNamesAblationDist)
+        expected = {
+            'V_TG' : 20.0, 'V_EUS' : 1.0, 'V_NVB' : 0.5,
+            'V_ablation_max' : 3.0, 'V_ablation_duration' : 4.5,
+            'V_INV_TG_max' : 1.5, 'V_INV_TG_duration' : 4.5,
+            'V_INV_EUS_max' : 0.0, 'V_INV_EUS_duration' : 0.0,
+            'V_INV_NVB_max' : 0.2, 'V_INV_NVB_duration' : 1.5,
+            'MIN_DIST_TG' : -1.0, 'MIN_DIST_EUS' : -3.0, 'MIN_DIST_NVB' : 2.0,
+        }
+        self.assertEqual(sorted(metrics.keys()), sorted(expected.keys()))
+        for name in expected:
+            self.assertAlmostEqual(metrics[name], expected[name], msg=name)
+
+
+class GroupMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.mesHeader, self.mesTable) = createMeasurementTable(np.random.default_rng(0), 50, 12)
+        self.expected = getReferenceTable(self.mesHeader, self.mesTable)
+
+    def assertSameTable(self, table):
+        self.assertEqual(len(table), len(self.expected))
+        for (row, expectedRow) in zip(table, self.expected):
+            self.assertEqual(row[:2], expectedRow[:2])
+            # The durations are summed in a different order
+            np.testing.assert_allclose(row[2:], expectedRow[2:], rtol=1e-12, atol=1e-12)
+
+    def test_table(self):
+        (resHeader, table) = am.processMeasurementTable(self.mesHeader, self.mesTable, {})
+        self.assertEqual(resHeader, am.getResultHeader())
+        self.assertSameTable(table)
+
+    def test_chunks(self):
+        state = {}
+        for start in range(0, len(self.mesTable), 37):
+            am.updateGroupMetrics(self.mesHeader, self.mesTable[start:start+37], state)
+        self.assertSameTable(am.getGroupMetricsTable(state))
+
+    def test_rows(self):
+        columns = am.getMeasurementColumns(self.mesHeader)
+        state = {}
+        for row in self.mesTable:
+            am.updateRowMetrics(columns, row, state)
+        self.assertSameTable(am.getGroupMetricsTable(state))
+
+
+if __name__ == '__main__':
+    unittest.main()
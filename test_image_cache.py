@@ -0,0 +1,81 @@
+#! /usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+import numpy as np
+import SimpleITK as sitk
+import image_cache as icache
+import run_registration as rr
+
+#
+# Tests that the images are read from the image cache, in this process and in the
+# worker processes of run_registration.py and run_sweep.py (initialized by
+# run_registration.initWorker()).
+#
+# Run with 'python -m unittest test_image_cache' (or 'python -m pytest') in this
+# directory.
+#
+
+
+def readImageTask(path):
+    # Read 'path' in a worker process; return the cache directory and the hit count.
+    image = icache.readImage(path, sitk.sitkFloat32)
+    return (icache.cacheDir, icache.cacheStats['hits'], sitk.GetArrayFromImage(image))
+
+
+class ImageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.tmpDir, 'cache')
+        self.array = np.arange(4 * 5 * 6, dtype=np.int16).reshape((4, 5, 6))
+        image = sitk.GetImageFromArray(self.array)
+        image.SetSpacing((0.5, 0.75, 3.0))
+        image.SetOrigin((1.0, 2.0, 3.0))
+        self.path = os.path.join(self.tmpDir, 'image.nii.gz')
+        sitk.WriteImage(image, self.path)
+        self.savedCacheDir = icache.cacheDir
+
+    def tearDown(self):
+        icache.setCacheDir(self.savedCacheDir)
+        shutil.rmtree(self.tmpDir)
+
+    def test_read_cached(self):
+        self.assertTrue(icache.ingestImage(self.cacheDir, self.path))
+        self.assertFalse(icache.ingestImage(self.cacheDir, self.path))
+        icache.setCacheDir(self.cacheDir)
+        hits = icache.cacheStats['hits']
+        image = icache.readImage(self.path, sitk.sitkFloat32)
+        self.assertEqual(icache.cacheStats['hits'], hits + 1)
+        self.assertEqual(image.GetPixelID(), sitk.sitkFloat32)
+        self.assertEqual(image.GetSpacing(), (0.5, 0.75, 3.0))
+        self.assertEqual(image.GetOrigin(), (1.0, 2.0, 3.0))
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(image), self.array)
+
+    def test_stale_entry(self):
+        icache.ingestImage(self.cacheDir, self.path)
+        icache.setCacheDir(self.cacheDir)
+        # An updated source file is not taken from the cache
+        os.utime(self.path, (0, 0))
+        misses = icache.cacheStats['misses']
+        icache.readImage(self.path)
+        self.assertEqual(icache.cacheStats['misses'], misses + 1)
+
+    def test_worker(self):
+        # The workers must read from the cache also under the spawn start method, where
+        # they do not inherit the cache directory set in the main process.
+        icache.ingestImage(self.cacheDir, self.path)
+        icache.setCacheDir(None)
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(1, initializer=rr.initWorker, initargs=(1, 0, None, self.cacheDir)) as pool:
+            (cacheDir, hits, array) = pool.apply(readImageTask, (self.path,))
+        self.assertEqual(cacheDir, self.cacheDir)
+        self.assertEqual(hits, 1)
+        np.testing.assert_array_equal(array, self.array)
+
+
+if __name__ == '__main__':
+    unittest.main()
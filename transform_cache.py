@@ -0,0 +1,70 @@
+#! /usr/bin/python
+
+import os
+import hashlib
+import json
+import SimpleITK as sitk
+
+#
+# Content-addressed cache for registration transforms.
+#
+# Each transform is stored as '<key>.tfm' in the cache directory. The key is a hash of
+# the contents of the input files and the registration parameters, so a transform is
+# reused only if neither the images nor the settings have changed.
+#
+
+# Digests of the files that have already been hashed in this process,
+# keyed by (path, mtime, size).
+fileDigests = {}
+
+
+def fileDigest(path):
+
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+    if key in fileDigests:
+        return fileDigests[key]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    fileDigests[key] = digest
+    return digest
+
+
+def transformKey(inputFiles, settings):
+    # 'inputFiles' is a list of the paths of the files used for the registration.
+    # 'settings' is a dictionary of the parameters that affect the result. It must be
+    # serializable as JSON (transforms should be given by their parameters).
+
+    h = hashlib.sha256()
+    for path in inputFiles:
+        h.update(fileDigest(path).encode())
+    h.update(json.dumps(settings, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def transformPath(cacheDir, key):
+    return os.path.join(cacheDir, '%s.tfm' % key)
+
+
+def loadTransform(cacheDir, key):
+    # Return the cached transform, or None if it does not exist.
+    path = transformPath(cacheDir, key)
+    if not os.path.exists(path):
+        return None
+    return sitk.ReadTransform(path)
+
+
+def saveTransform(cacheDir, key, transform):
+
+    os.makedirs(cacheDir, exist_ok=True)
+    path = transformPath(cacheDir, key)
+
+    # Write to a temporary file first, so that an interrupted run (or another
+    # worker process) never sees a partially written transform.
+    tmpPath = '%s.%d.tmp.tfm' % (path[:-4], os.getpid())
+    sitk.WriteTransform(transform, tmpPath)
+    os.replace(tmpPath, path)